@@ -3,19 +3,35 @@ EduLingua AI Assistant API
 Backend em Python com FastAPI + OpenAI GPT-4.1-mini + Supabase
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 import os
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
+import openai
 from supabase import create_client, Client
 import json
 import httpx
 import base64
 import tempfile
 import uuid
+import asyncio
+import functools
+import hashlib
+import hmac
+import random
+import re
+import ssl
+import sys
+import unicodedata
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime, date, timedelta
 
 load_dotenv()
@@ -24,7 +40,27 @@ load_dotenv()
 # CONFIGURAÇÃO
 # ============================================
 
-app = FastAPI(title="EduLingua AI Assistant")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Ciclo de vida: abre os clientes HTTP compartilhados na subida e fecha no desligamento"""
+    if cora_configured():
+        try:
+            get_cora_client()
+            iniciar_renovacao_token_cora()
+        except HTTPException:
+            pass  # certificado inválido (já logado): só a Cora fica desativada
+    if UAZAPI_URL and UAZAPI_TOKEN:
+        get_uazapi_client()
+    await iniciar_workers_jobs()
+    iniciar_ingestao_webhooks()
+    yield
+    await parar_ingestao_webhooks()
+    await parar_workers_jobs()
+    await parar_renovacao_token_cora()
+    await close_http_clients()
+    db_executor.shutdown(wait=False)
+
+app = FastAPI(title="EduLingua AI Assistant", lifespan=lifespan)
 
 # CORS para permitir chamadas do React
 app.add_middleware(
@@ -35,13 +71,186 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Clientes
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Clientes (retries da OpenAI ficam na camada de resiliência abaixo)
+openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 supabase: Client = create_client(
     os.getenv("SUPABASE_URL"),
     os.getenv("SUPABASE_SERVICE_KEY")  # Use service key para acesso total
 )
 
+# Pool de threads para o cliente Supabase (síncrono) não bloquear o event loop.
+# O tamanho limita quantas consultas ao banco rodam em paralelo no processo.
+DB_THREADPOOL_SIZE = int(os.getenv("DB_THREADPOOL_SIZE", "16"))
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADPOOL_SIZE, thread_name_prefix="db")
+
+async def run_blocking(func, *args, **kwargs):
+    """Executa uma função bloqueante (ex: consultas Supabase) no pool de threads"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+# Clientes HTTP compartilhados (Cora, UAZAPI): keep-alive e TLS reaproveitados entre requests
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "20"))
+HTTP_POOL_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "10"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true"
+_http_clients: Dict[str, httpx.AsyncClient] = {}
+
+def http_pool_limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=HTTP_POOL_MAX_CONNECTIONS, max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE)
+
+async def close_http_clients():
+    """Fecha todos os clientes HTTP compartilhados"""
+    for client in list(_http_clients.values()):
+        await client.aclose()
+    _http_clients.clear()
+
+# ============================================
+# RESILIÊNCIA (timeouts, retries, circuit breaker)
+# ============================================
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class Dependencia:
+    """
+    Envolve chamadas a um serviço externo com:
+    - timeout por endpoint (prefixo do path mais longo em `timeouts`, senão `timeout_padrao`)
+    - até `max_tentativas` com backoff exponencial + jitter em 429/5xx/erros de conexão
+      (timeouts de leitura só são repetidos em chamadas idempotentes)
+    - circuit breaker: após `falhas_para_abrir` falhas seguidas (erros transitórios,
+      timeouts ou respostas 5xx), rejeita chamadas por `reset_seconds`; depois deixa
+      uma única chamada de teste passar (meio-aberto) e rejeita as demais até ela terminar
+    """
+
+    def __init__(self, nome: str, timeout_padrao: float, timeouts: Dict[str, float] = None,
+                 max_tentativas: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 falhas_para_abrir: int = 5, reset_seconds: float = 30.0):
+        self.nome = nome
+        self.timeout_padrao = timeout_padrao
+        self.timeouts = timeouts or {}
+        self.max_tentativas = max_tentativas
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.falhas_para_abrir = falhas_para_abrir
+        self.reset_seconds = reset_seconds
+        self.estado = "fechado"  # fechado, aberto, meio_aberto
+        self.falhas_consecutivas = 0
+        self.aberto_em = 0.0
+        self.sonda_em_andamento = False
+        self.contadores = {"chamadas": 0, "sucessos": 0, "falhas": 0, "retries": 0, "rejeitadas": 0}
+
+    def timeout_para(self, path: str = "") -> float:
+        prefixos = [p for p in self.timeouts if path.startswith(p)]
+        return self.timeouts[max(prefixos, key=len)] if prefixos else self.timeout_padrao
+
+    def _permitir(self) -> bool:
+        if self.estado == "aberto":
+            if time.monotonic() - self.aberto_em < self.reset_seconds:
+                return False
+            self.estado = "meio_aberto"
+        if self.estado == "meio_aberto":
+            if self.sonda_em_andamento:
+                return False
+            self.sonda_em_andamento = True
+        return True
+
+    def _registrar_sucesso(self):
+        self.contadores["sucessos"] += 1
+        self.falhas_consecutivas = 0
+        self.estado = "fechado"
+
+    def _registrar_falha(self):
+        self.contadores["falhas"] += 1
+        self.falhas_consecutivas += 1
+        if self.estado == "meio_aberto" or self.falhas_consecutivas >= self.falhas_para_abrir:
+            self.estado = "aberto"
+            self.aberto_em = time.monotonic()
+
+    def _espera(self, tentativa: int, retry_after: Optional[str] = None) -> float:
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** tentativa)))
+
+    @staticmethod
+    def _erro_transitorio(exc: Exception, idempotente: bool) -> bool:
+        if isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+            return True
+        if isinstance(exc, (httpx.TimeoutException, httpx.RemoteProtocolError)):
+            return idempotente
+        return False
+
+    async def executar(self, chamada, path: str = "", idempotente: bool = True):
+        """
+        Executa `chamada(timeout)` com retries e circuit breaker.
+        Se a chamada retorna um httpx.Response, status 429/5xx também são repetidos;
+        esgotadas as tentativas, a última resposta é devolvida ao chamador.
+        """
+        if not self._permitir():
+            self.contadores["rejeitadas"] += 1
+            raise HTTPException(status_code=503, detail=f"{self.nome} indisponível no momento (circuit breaker aberto)")
+
+        # No meio-aberto só esta chamada passa; o fim dela (qualquer que seja) libera a próxima sonda
+        sonda = self.estado == "meio_aberto"
+        try:
+            return await self._executar_tentativas(chamada, self.timeout_para(path), idempotente)
+        finally:
+            if sonda:
+                self.sonda_em_andamento = False
+
+    async def _executar_tentativas(self, chamada, timeout: float, idempotente: bool):
+        for tentativa in range(self.max_tentativas):
+            self.contadores["chamadas"] += 1
+            ultima = tentativa == self.max_tentativas - 1
+            try:
+                resultado = await chamada(timeout)
+            except Exception as e:
+                if not self._erro_transitorio(e, idempotente):
+                    if isinstance(e, httpx.TimeoutException):
+                        self._registrar_falha()
+                    raise
+                self._registrar_falha()
+                if ultima or self.estado == "aberto":
+                    raise
+                self.contadores["retries"] += 1
+                await asyncio.sleep(self._espera(tentativa))
+                continue
+
+            status = getattr(resultado, "status_code", None)
+            if status is not None and status >= 500:
+                # 5xx é falha do serviço mesmo quando a chamada não pode ser repetida
+                self._registrar_falha()
+            elif status != 429:
+                self._registrar_sucesso()
+
+            if status in RETRY_STATUS and (idempotente or status == 429) and not (ultima or self.estado == "aberto"):
+                self.contadores["retries"] += 1
+                await asyncio.sleep(self._espera(tentativa, resultado.headers.get("Retry-After")))
+                continue
+            return resultado
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "estado": self.estado,
+            "falhas_consecutivas": self.falhas_consecutivas,
+            **self.contadores,
+        }
+
+RESILIENCE_MAX_TENTATIVAS = int(os.getenv("RESILIENCE_MAX_TENTATIVAS", "3"))
+RESILIENCE_FALHAS_PARA_ABRIR = int(os.getenv("RESILIENCE_FALHAS_PARA_ABRIR", "5"))
+RESILIENCE_RESET_SECONDS = float(os.getenv("RESILIENCE_RESET_SECONDS", "30"))
+
+cora_dependencia = Dependencia(
+    "Cora", timeout_padrao=15.0, timeouts={"/token": 10.0, "/v2/invoices": 20.0},
+    max_tentativas=RESILIENCE_MAX_TENTATIVAS, falhas_para_abrir=RESILIENCE_FALHAS_PARA_ABRIR, reset_seconds=RESILIENCE_RESET_SECONDS,
+)
+uazapi_dependencia = Dependencia(
+    "UAZAPI", timeout_padrao=10.0, timeouts={"/api/sendFile": 60.0, "/api/messages": 20.0},
+    max_tentativas=RESILIENCE_MAX_TENTATIVAS, falhas_para_abrir=RESILIENCE_FALHAS_PARA_ABRIR, reset_seconds=RESILIENCE_RESET_SECONDS,
+)
+openai_dependencia = Dependencia(
+    "OpenAI", timeout_padrao=60.0,
+    max_tentativas=RESILIENCE_MAX_TENTATIVAS, falhas_para_abrir=RESILIENCE_FALHAS_PARA_ABRIR, reset_seconds=RESILIENCE_RESET_SECONDS,
+)
+DEPENDENCIAS = [cora_dependencia, uazapi_dependencia, openai_dependencia]
+
 # ============================================
 # MODELS
 # ============================================
@@ -208,6 +417,42 @@ def query_database(table: str, select: str = "*", filters: Dict = None, limit: i
         print(f"Erro na query: {e}")
         return []
 
+def buscar_por_nome(tabela: str, busca: str, ids: Optional[List[str]] = None, limite: int = 10) -> List[Dict]:
+    """
+    Busca por nome em alunos/turmas/usuarios via RPC (sem acento, por trigramas).
+    Retorna [{id, nome, score}] do melhor para o pior match. Serve para escolher
+    um registro; filtros de lista usam padrao_nome direto na query.
+    """
+    result = supabase.rpc("buscar_por_nome", {
+        "p_tabela": tabela,
+        "p_busca": busca,
+        "p_ids": ids,
+        "p_limite": limite,
+    }).execute()
+    return result.data or []
+
+def normalizar_busca(texto: str) -> str:
+    """Termo no formato da coluna nome_busca (minúsculas, sem acentos)"""
+    decomposto = unicodedata.normalize("NFKD", texto.strip().lower())
+    return "".join(c for c in decomposto if not unicodedata.combining(c))
+
+def escapar_like(termo: str) -> str:
+    """'%', '_' e '\\' digitados pelo usuário viram literais no LIKE"""
+    return termo.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def padrao_nome(texto: str) -> str:
+    """
+    Padrão LIKE de trecho do nome, para filtros de lista em nome_busca (sem limite de resultados).
+    Usa '*', o curinga do PostgREST: '%' vai cru na URL e '%ab...' seria decodificado como um byte.
+    O PostgREST troca todo '*' por '%', então um '*' digitado vira '_' (casa um caractere).
+    """
+    return f"*{escapar_like(normalizar_busca(texto)).replace('*', '_')}*"
+
+def melhor_id_por_nome(tabela: str, busca: str, ids: Optional[List[str]] = None) -> Optional[str]:
+    """ID do registro com o nome mais parecido com a busca, ou None"""
+    matches = buscar_por_nome(tabela, busca, ids, limite=1)
+    return matches[0]["id"] if matches else None
+
 # ============================================
 # FERRAMENTAS PARA O GPT (Function Calling)
 # ============================================
@@ -331,6 +576,10 @@ TOOLS = [
                     "apenas_faltas": {
                         "type": "boolean",
                         "description": "Se true, retorna apenas registros de falta (presente=false)"
+                    },
+                    "resumo": {
+                        "type": "boolean",
+                        "description": "Se true, retorna totais por aluno e turma (faltas, presenças, % de frequência) em vez de cada registro. Automático para períodos longos (ex.: semestre)"
                     }
                 }
             }
@@ -409,30 +658,72 @@ TOOLS = [
 # ESCOPO POR USUÁRIO (RBAC)
 # ============================================
 
-def compute_user_scope(user: Optional["ChatUser"]) -> Dict[str, Any]:
-    """
-    Retorna o escopo de dados que o usuário pode acessar.
-    - admin/None: sem restrição (allowed_turma_ids=None)
-    - supervisor: só as turmas vinculadas via supervisor_turmas
-    - professor: só as turmas onde ele é professor_id
-    """
-    if not user or not user.perfil or user.perfil == "admin":
-        return {"allowed_turma_ids": None, "perfil": "admin"}
+# Cache de escopo entre requests (por usuário), invalidado por TTL ou por mudança nos dados
+SCOPE_CACHE_TTL_SECONDS = float(os.getenv("SCOPE_CACHE_TTL_SECONDS", "60"))
+_scope_cache: Dict[str, Dict[str, Any]] = {}
+_scope_cache_lock = threading.Lock()
 
+def _load_user_scope(user: "ChatUser") -> Dict[str, Any]:
+    """Consulta no banco as turmas (ids e nomes) que o usuário pode acessar"""
     if user.perfil == "supervisor" and user.id:
         result = supabase.table("supervisor_turmas").select("turma_id").eq("usuario_id", user.id).execute()
         ids = [r["turma_id"] for r in (result.data or [])]
-        return {"allowed_turma_ids": ids, "perfil": "supervisor"}
+        nomes = []
+        if ids:
+            t = supabase.table("turmas").select("nome").in_("id", ids).execute()
+            nomes = [r["nome"] for r in (t.data or [])]
+        return {"allowed_turma_ids": ids, "turma_nomes": nomes, "perfil": "supervisor"}
 
     if user.perfil == "professor" and user.id:
-        result = supabase.table("turmas").select("id").eq("professor_id", user.id).execute()
+        result = supabase.table("turmas").select("id, nome").eq("professor_id", user.id).execute()
         ids = [r["id"] for r in (result.data or [])]
-        return {"allowed_turma_ids": ids, "perfil": "professor"}
+        nomes = [r["nome"] for r in (result.data or [])]
+        return {"allowed_turma_ids": ids, "turma_nomes": nomes, "perfil": "professor"}
 
     # fallback: nega tudo
-    return {"allowed_turma_ids": [], "perfil": user.perfil}
+    return {"allowed_turma_ids": [], "turma_nomes": [], "perfil": user.perfil}
+
+def compute_user_scope(user: Optional["ChatUser"]) -> Dict[str, Any]:
+    """
+    Retorna o escopo de dados que o usuário pode acessar.
+    - admin/None: sem restrição (allowed_turma_ids=None)
+    - supervisor: só as turmas vinculadas via supervisor_turmas
+    - professor: só as turmas onde ele é professor_id
+
+    O escopo é calculado uma vez por request e reaproveitado por
+    SCOPE_CACHE_TTL_SECONDS entre requests do mesmo usuário. O dict
+    retornado é compartilhado: não deve ser alterado por quem o recebe.
+    """
+    if not user or not user.perfil or user.perfil == "admin":
+        return {"allowed_turma_ids": None, "turma_nomes": None, "perfil": "admin"}
+
+    cache_key = f"{user.perfil}:{user.id}"
+    now = time.monotonic()
+    with _scope_cache_lock:
+        entry = _scope_cache.get(cache_key)
+        if entry and entry["expires_at"] > now:
+            return entry["scope"]
+
+    scope = _load_user_scope(user)
+    with _scope_cache_lock:
+        _scope_cache[cache_key] = {"scope": scope, "expires_at": now + SCOPE_CACHE_TTL_SECONDS}
+    return scope
+
+def invalidate_user_scope(user_id: Optional[str] = None):
+    """Remove do cache o escopo de um usuário (ou de todos, se user_id=None)"""
+    with _scope_cache_lock:
+        if user_id is None:
+            _scope_cache.clear()
+            _alunos_scope_cache.clear()
+        else:
+            for key in [k for k in _scope_cache if k.endswith(f":{user_id}")]:
+                del _scope_cache[key]
 
 
+# aluno_ids por conjunto de turmas (mesmo TTL do escopo). Fica fora do dict do
+# escopo, que é compartilhado entre requests e lido por várias threads.
+_alunos_scope_cache: Dict[tuple, Dict[str, Any]] = {}
+
 def _alunos_in_scope(scope: Dict[str, Any]) -> Optional[List[str]]:
     """Lista de aluno_ids matriculados em turmas do escopo. None = sem restrição."""
     allowed = scope.get("allowed_turma_ids")
@@ -440,18 +731,131 @@ def _alunos_in_scope(scope: Dict[str, Any]) -> Optional[List[str]]:
         return None
     if not allowed:
         return []
+    # Memorizado por conjunto de turmas: as ferramentas de um turno (e requests
+    # seguintes enquanto não expirar) não repetem a consulta
+    cache_key = tuple(sorted(allowed))
+    now = time.monotonic()
+    with _scope_cache_lock:
+        entry = _alunos_scope_cache.get(cache_key)
+        if entry and entry["expires_at"] > now:
+            return entry["aluno_ids"]
+
     matriculas = supabase.table("matriculas").select("aluno_id").in_("turma_id", allowed).execute()
-    return list({m["aluno_id"] for m in (matriculas.data or [])})
+    aluno_ids = list({m["aluno_id"] for m in (matriculas.data or [])})
+    with _scope_cache_lock:
+        _alunos_scope_cache[cache_key] = {"aluno_ids": aluno_ids, "expires_at": now + SCOPE_CACHE_TTL_SECONDS}
+    return aluno_ids
+
+
+# ============================================
+# INVALIDAÇÃO DE CACHES
+# ============================================
+
+# tabela -> funções chamadas quando os dados dessa tabela mudam
+_invalidation_hooks: Dict[str, List[Any]] = {}
+
+def on_data_change(*tables: str):
+    """Registra uma função para ser chamada quando alguma das tabelas mudar"""
+    def decorator(func):
+        for table in tables:
+            _invalidation_hooks.setdefault(table, []).append(func)
+        return func
+    return decorator
+
+def notify_data_change(tables: List[str]):
+    """Dispara os hooks de invalidação das tabelas alteradas"""
+    called = set()
+    for table in tables:
+        for hook in _invalidation_hooks.get(table, []):
+            if hook not in called:
+                called.add(hook)
+                try:
+                    hook()
+                except Exception as e:
+                    print(f"Erro ao invalidar cache ({table}): {e}")
+
+@on_data_change("turmas", "matriculas", "supervisor_turmas", "usuarios")
+def _invalidate_scope_cache():
+    invalidate_user_scope()
 
 
 # ============================================
 # IMPLEMENTAÇÃO DAS FERRAMENTAS
 # ============================================
 
-def tool_consultar_turmas(idioma: str = None, professor_nome: str = None, nome_turma: str = None, _scope: Dict = None) -> List[Dict]:
+# Colunas enviadas ao modelo (sem endereço/documentos)
+ALUNO_COLUNAS = (
+    "id, nome, telefone, email, cidade, estado, status_pedagogico, status_financeiro, "
+    "dia_vencimento, valor_mensalidade, forma_pagamento, desconto, usa_transporte, "
+    "aniversario_dia, aniversario_mes, data_inicio"
+)
+# Busca por nome/aluno específico: inclui o responsável
+ALUNO_COLUNAS_DETALHE = ALUNO_COLUNAS + ", responsavel_nome, responsavel_telefone"
+
+TURMA_COLUNAS = "id, nome, idioma, nivel, horario, dias_semana, professor_id"
+AULA_COLUNAS = "id, turma_id, data, unidade_livro, conteudo, observacoes"
+# Nunca senha/hash: só o que o modelo precisa para citar o professor
+PROFESSOR_COLUNAS = "id, nome, email"
+
+# Ferramentas de lista paginam na própria query: no máximo TOOL_PAGE_SIZE linhas
+# por chamada, em ordem estável, com cursor keyset para a página seguinte
+TOOL_PAGE_SIZE = int(os.getenv("TOOL_PAGE_SIZE", "50"))
+# Orçamento de tamanho de cada página (em caracteres JSON, ~4 por token)
+TOOL_RESULT_MAX_CHARS = int(os.getenv("TOOL_RESULT_MAX_CHARS", "12000"))
+
+def paginar_query(query, cursor: Optional[str] = None, ordem: Optional[str] = None, desc: bool = False, chave: str = "id"):
+    """
+    Aplica a página keyset na query: ordena por (ordem, chave), continua depois do
+    cursor e traz TOOL_PAGE_SIZE + 1 linhas (a extra indica que há próxima página).
+    O cursor é "chave" ou "ordem|chave" da última linha entregue (ver cursor_keyset).
+    """
+    if ordem:
+        query = query.order(ordem, desc=desc)
+    if cursor:
+        partes = str(cursor).split("|")
+        if len(partes) != (2 if ordem else 1) or not all(re.fullmatch(r"[\w:.+-]+", p) for p in partes):
+            raise ValueError("cursor inválido: use o 'proximo_cursor' retornado")
+        if ordem:
+            op = "lt" if desc else "gt"
+            query = query.or_(f"{ordem}.{op}.{partes[0]},and({ordem}.eq.{partes[0]},{chave}.gt.{partes[1]})")
+        else:
+            query = query.gt(chave, partes[0])
+    return query.order(chave).limit(TOOL_PAGE_SIZE + 1)
+
+def cursor_keyset(linha: Dict[str, Any], ordem: Optional[str] = None, chave: str = "id") -> str:
+    return f"{linha[ordem]}|{linha[chave]}" if ordem else str(linha[chave])
+
+def resultado_paginado(linhas: List[Dict], cursor_de=cursor_keyset, total: Optional[int] = None) -> Any:
+    """
+    Página enviada ao modelo: até TOOL_PAGE_SIZE linhas que caibam em
+    TOOL_RESULT_MAX_CHARS. Se há mais registros, devolve itens + proximo_cursor.
+    """
+    pagina = []
+    usado = 0
+    for linha in linhas[:TOOL_PAGE_SIZE]:
+        tamanho = len(json.dumps(linha, ensure_ascii=False, default=str))
+        if pagina and usado + tamanho > TOOL_RESULT_MAX_CHARS:
+            break
+        pagina.append(linha)
+        usado += tamanho
+
+    if len(pagina) == len(linhas):
+        return pagina
+
+    proximo = cursor_de(pagina[-1])
+    resultado = {"itens": pagina, "retornados": len(pagina)}
+    if total is not None:
+        resultado["total_registros"] = total
+    resultado["proximo_cursor"] = proximo
+    resultado["aviso"] = f"Resultado parcial. Chame de novo com cursor=\"{proximo}\" para ver os próximos registros."
+    return resultado
+
+def tool_consultar_turmas(idioma: str = None, professor_nome: str = None, nome_turma: str = None, cursor: str = None, _scope: Dict = None) -> Any:
     """Consulta turmas com filtros"""
     _scope = _scope or {}
-    query = supabase.table("turmas").select("*, professor:usuarios!turmas_professor_id_fkey(id, nome, email)")
+    # Com filtro por professor o embed vira inner join, e o filtro roda no banco
+    professor_embed = "usuarios!turmas_professor_id_fkey!inner" if professor_nome else "usuarios!turmas_professor_id_fkey"
+    query = supabase.table("turmas").select(f"{TURMA_COLUNAS}, professor:{professor_embed}({PROFESSOR_COLUNAS})", count="exact")
 
     allowed = _scope.get("allowed_turma_ids")
     if allowed is not None:
@@ -462,26 +866,26 @@ def tool_consultar_turmas(idioma: str = None, professor_nome: str = None, nome_t
     if idioma:
         query = query.eq("idioma", idioma)
     if nome_turma:
-        query = query.ilike("nome", f"%{nome_turma}%")
-
-    result = query.execute()
-    turmas = result.data if result.data else []
-
-    # Filtro por nome do professor (pós-query pois é relacionamento)
+        query = query.like("nome_busca", padrao_nome(nome_turma))
     if professor_nome:
-        turmas = [t for t in turmas if t.get("professor") and professor_nome.lower() in t["professor"].get("nome", "").lower()]
+        query = query.like("professor.nome_busca", padrao_nome(professor_nome))
+
+    result = paginar_query(query, cursor).execute()
+    turmas = (result.data or [])[:TOOL_PAGE_SIZE]
 
-    # Adiciona contagem de alunos
-    for turma in turmas:
-        matriculas = supabase.table("matriculas").select("id", count="exact").eq("turma_id", turma["id"]).eq("status", "ativo").execute()
-        turma["total_alunos"] = matriculas.count if matriculas.count else 0
+    # Adiciona contagem de alunos (uma única chamada agregada para as turmas da página)
+    if turmas:
+        contagens = supabase.rpc("contar_alunos_por_turma", {"p_turma_ids": [t["id"] for t in turmas]}).execute()
+        total_por_turma = {c["turma_id"]: c["total_alunos"] for c in (contagens.data or [])}
+        for turma in turmas:
+            turma["total_alunos"] = total_por_turma.get(turma["id"], 0)
 
-    return turmas
+    return resultado_paginado(turmas + (result.data or [])[TOOL_PAGE_SIZE:], total=result.count)
 
-def tool_consultar_alunos(nome: str = None, status_financeiro: str = None, status_pedagogico: str = None, usa_transporte: bool = None, _scope: Dict = None) -> List[Dict]:
+def tool_consultar_alunos(nome: str = None, status_financeiro: str = None, status_pedagogico: str = None, usa_transporte: bool = None, cursor: str = None, _scope: Dict = None) -> Any:
     """Consulta alunos com filtros"""
     _scope = _scope or {}
-    query = supabase.table("alunos").select("*")
+    query = supabase.table("alunos").select(ALUNO_COLUNAS_DETALHE if nome else ALUNO_COLUNAS, count="exact")
 
     aluno_ids = _alunos_in_scope(_scope)
     if aluno_ids is not None:
@@ -490,7 +894,7 @@ def tool_consultar_alunos(nome: str = None, status_financeiro: str = None, statu
         query = query.in_("id", aluno_ids)
 
     if nome:
-        query = query.ilike("nome", f"%{nome}%")
+        query = query.like("nome_busca", padrao_nome(nome))
     if status_financeiro:
         query = query.eq("status_financeiro", status_financeiro)
     if status_pedagogico:
@@ -498,10 +902,10 @@ def tool_consultar_alunos(nome: str = None, status_financeiro: str = None, statu
     if usa_transporte is not None:
         query = query.eq("usa_transporte", usa_transporte)
 
-    result = query.order("nome").execute()
-    return result.data if result.data else []
+    result = paginar_query(query, cursor).execute()
+    return resultado_paginado(result.data or [], total=result.count)
 
-def tool_consultar_alunos_turma(turma_nome: str = None, turma_id: str = None, _scope: Dict = None) -> Dict:
+def tool_consultar_alunos_turma(turma_nome: str = None, turma_id: str = None, cursor: str = None, _scope: Dict = None) -> Dict:
     """Lista alunos de uma turma"""
     _scope = _scope or {}
     allowed = _scope.get("allowed_turma_ids")
@@ -510,18 +914,14 @@ def tool_consultar_alunos_turma(turma_nome: str = None, turma_id: str = None, _s
     if turma_id:
         if allowed is not None and turma_id not in allowed:
             return {"erro": "Você não tem acesso a essa turma"}
-        turma_result = supabase.table("turmas").select("*").eq("id", turma_id).single().execute()
+        turma_result = supabase.table("turmas").select(TURMA_COLUNAS).eq("id", turma_id).single().execute()
     elif turma_nome:
-        q = supabase.table("turmas").select("*").ilike("nome", f"%{turma_nome}%")
-        if allowed is not None:
-            if not allowed:
-                return {"erro": "Você não tem turmas atribuídas"}
-            q = q.in_("id", allowed)
-        turma_result = q.execute()
-        if turma_result.data:
-            turma_result.data = turma_result.data[0]
-        else:
+        if allowed is not None and not allowed:
+            return {"erro": "Você não tem turmas atribuídas"}
+        melhor_id = melhor_id_por_nome("turmas", turma_nome, allowed)
+        if not melhor_id:
             return {"erro": f"Turma '{turma_nome}' não encontrada (ou fora do seu escopo)"}
+        turma_result = supabase.table("turmas").select(TURMA_COLUNAS).eq("id", melhor_id).single().execute()
     else:
         return {"erro": "Informe o nome ou ID da turma"}
 
@@ -530,32 +930,39 @@ def tool_consultar_alunos_turma(turma_nome: str = None, turma_id: str = None, _s
 
     turma = turma_result.data
 
-    # Busca matrículas com dados do aluno
-    matriculas = supabase.table("matriculas").select("*, aluno:alunos(*)").eq("turma_id", turma["id"]).eq("status", "ativo").execute()
+    # Busca matrículas com dados do aluno (uma página, em ordem de aluno_id)
+    query = supabase.table("matriculas").select(f"aluno_id, aluno:alunos({ALUNO_COLUNAS})", count="exact").eq("turma_id", turma["id"]).eq("status", "ativo")
+    matriculas = paginar_query(query, cursor, chave="aluno_id").execute()
 
     alunos = [m["aluno"] for m in (matriculas.data or []) if m.get("aluno")]
+    pagina = resultado_paginado(alunos)
 
-    return {
-        "turma": turma,
-        "total_alunos": len(alunos),
-        "alunos": alunos
-    }
+    resultado = {"turma": turma, "total_alunos": matriculas.count}
+    if isinstance(pagina, dict):
+        return {**resultado, "alunos": pagina["itens"], "proximo_cursor": pagina["proximo_cursor"], "aviso": pagina["aviso"]}
+    return {**resultado, "alunos": pagina}
 
 def tool_consultar_turmas_aluno(aluno_nome: str, _scope: Dict = None) -> Dict:
     """Lista turmas de um aluno"""
     _scope = _scope or {}
     allowed = _scope.get("allowed_turma_ids")
 
-    # Encontra o aluno
-    aluno_result = supabase.table("alunos").select("*").ilike("nome", f"%{aluno_nome}%").execute()
+    # Encontra o aluno (melhor match por nome, só entre os alunos do escopo)
+    aluno_ids = _alunos_in_scope(_scope)
+    aluno_id = melhor_id_por_nome("alunos", aluno_nome, aluno_ids) if aluno_ids != [] else None
+    if not aluno_id:
+        if aluno_ids is not None:
+            return {"erro": f"Aluno '{aluno_nome}' não encontrado nas turmas do seu escopo"}
+        return {"erro": f"Aluno '{aluno_nome}' não encontrado"}
 
+    aluno_result = supabase.table("alunos").select(ALUNO_COLUNAS_DETALHE).eq("id", aluno_id).execute()
     if not aluno_result.data:
         return {"erro": f"Aluno '{aluno_nome}' não encontrado"}
 
     aluno = aluno_result.data[0]
 
     # Busca matrículas com dados da turma
-    matriculas = supabase.table("matriculas").select("*, turma:turmas(*, professor:usuarios!turmas_professor_id_fkey(nome))").eq("aluno_id", aluno["id"]).eq("status", "ativo").execute()
+    matriculas = supabase.table("matriculas").select(f"turma:turmas({TURMA_COLUNAS}, professor:usuarios!turmas_professor_id_fkey(nome))").eq("aluno_id", aluno["id"]).eq("status", "ativo").execute()
 
     turmas = [m["turma"] for m in (matriculas.data or []) if m.get("turma")]
 
@@ -571,8 +978,32 @@ def tool_consultar_turmas_aluno(aluno_nome: str, _scope: Dict = None) -> Dict:
         "turmas": turmas
     }
 
-def tool_consultar_faltas(aluno_nome: str = None, turma_nome: str = None, data_inicio: str = None, data_fim: str = None, apenas_faltas: bool = True, _scope: Dict = None) -> List[Dict]:
-    """Consulta presenças/faltas"""
+# Acima disso, consultar_faltas responde com totais do rollup semanal (presencas_semanais)
+FALTAS_DETALHE_MAX_DIAS = 31
+
+def _resumo_faltas(aluno_nome: Optional[str], turma_nome: Optional[str], data_inicio: str, data_fim: str, apenas_faltas: bool, allowed: Optional[List[str]], cursor: Optional[str] = None) -> Any:
+    """Totais por aluno/turma via resumo_presencas (semanas inteiras lidas do rollup)"""
+    turma_ids = allowed
+    if turma_nome:
+        turma_id = melhor_id_por_nome("turmas", turma_nome, allowed)
+        if not turma_id:
+            return []
+        turma_ids = [turma_id]
+
+    query = supabase.rpc("resumo_presencas", {
+        "p_inicio": data_inicio,
+        "p_fim": data_fim,
+        "p_turma_ids": turma_ids,
+        "p_aluno_busca": escapar_like(normalizar_busca(aluno_nome)) if aluno_nome else None,
+    })
+    if apenas_faltas:
+        query = query.gt("faltas", 0)
+    # Uma linha por (aluno, turma): o par é a chave do cursor
+    result = paginar_query(query, cursor, ordem="aluno_id", chave="turma_id").execute()
+    return resultado_paginado(result.data or [], cursor_de=lambda l: cursor_keyset(l, "aluno_id", "turma_id"))
+
+def tool_consultar_faltas(aluno_nome: str = None, turma_nome: str = None, data_inicio: str = None, data_fim: str = None, apenas_faltas: bool = True, resumo: bool = False, cursor: str = None, _scope: Dict = None) -> Any:
+    """Consulta presenças/faltas (registros no período ou, em períodos longos, totais por aluno)"""
     _scope = _scope or {}
     allowed = _scope.get("allowed_turma_ids")
 
@@ -584,52 +1015,46 @@ def tool_consultar_faltas(aluno_nome: str = None, turma_nome: str = None, data_i
         today = datetime.now()
         data_fim = (today + timedelta(days=6-today.weekday())).strftime("%Y-%m-%d")
 
-    # Busca aulas no período
-    aulas_query = supabase.table("aulas").select("id, data, turma:turmas(id, nome), turma_id").gte("data", data_inicio).lte("data", data_fim)
+    if allowed is not None and not allowed:
+        return []
 
-    if allowed is not None:
-        if not allowed:
-            return []
-        aulas_query = aulas_query.in_("turma_id", allowed)
+    try:
+        dias = (date.fromisoformat(data_fim) - date.fromisoformat(data_inicio)).days
+    except ValueError:
+        dias = 0
+    if resumo or dias > FALTAS_DETALHE_MAX_DIAS:
+        return _resumo_faltas(aluno_nome, turma_nome, data_inicio, data_fim, apenas_faltas, allowed, cursor)
+
+    # Uma só query: período e turma filtram o embed aula (inner join), sem listar aula_ids
+    aluno_embed = "alunos!inner" if aluno_nome else "alunos"
+    presencas_query = (
+        supabase.table("presencas")
+        .select(f"id, presente, observacao, aluno:{aluno_embed}(id, nome), aula:aulas!inner(data, turma_id, turma:turmas(nome))", count="exact")
+        .gte("aula.data", data_inicio)
+        .lte("aula.data", data_fim)
+    )
 
+    if allowed is not None:
+        presencas_query = presencas_query.in_("aula.turma_id", allowed)
     if turma_nome:
-        turma_q = supabase.table("turmas").select("id").ilike("nome", f"%{turma_nome}%")
-        if allowed is not None:
-            turma_q = turma_q.in_("id", allowed)
-        turma = turma_q.execute()
-        if turma.data:
-            aulas_query = aulas_query.eq("turma_id", turma.data[0]["id"])
-        else:
+        turma_id = melhor_id_por_nome("turmas", turma_nome, allowed)
+        if not turma_id:
             return []
-
-    aulas = aulas_query.execute()
-
-    if not aulas.data:
-        return []
-
-    aula_ids = [a["id"] for a in aulas.data]
-
-    # Busca presenças
-    presencas_query = supabase.table("presencas").select("*, aluno:alunos(id, nome), aula:aulas(data, turma:turmas(nome))").in_("aula_id", aula_ids)
-
+        presencas_query = presencas_query.eq("aula.turma_id", turma_id)
     if apenas_faltas:
         presencas_query = presencas_query.eq("presente", False)
-
-    presencas = presencas_query.execute()
-
-    # Filtra por aluno se necessário
-    resultado = presencas.data or []
     if aluno_nome:
-        resultado = [p for p in resultado if p.get("aluno") and aluno_nome.lower() in p["aluno"].get("nome", "").lower()]
+        presencas_query = presencas_query.like("aluno.nome_busca", padrao_nome(aluno_nome))
 
-    return resultado
+    presencas = paginar_query(presencas_query, cursor).execute()
+    return resultado_paginado(presencas.data or [], total=presencas.count)
 
-def tool_consultar_aulas(turma_nome: str = None, data_inicio: str = None, data_fim: str = None, _scope: Dict = None) -> List[Dict]:
-    """Consulta aulas realizadas"""
+def tool_consultar_aulas(turma_nome: str = None, data_inicio: str = None, data_fim: str = None, cursor: str = None, _scope: Dict = None) -> Any:
+    """Consulta aulas realizadas (mais recentes primeiro)"""
     _scope = _scope or {}
     allowed = _scope.get("allowed_turma_ids")
 
-    query = supabase.table("aulas").select("*, turma:turmas(nome, idioma)")
+    query = supabase.table("aulas").select(f"{AULA_COLUNAS}, turma:turmas(nome, idioma)", count="exact")
 
     if allowed is not None:
         if not allowed:
@@ -637,28 +1062,27 @@ def tool_consultar_aulas(turma_nome: str = None, data_inicio: str = None, data_f
         query = query.in_("turma_id", allowed)
 
     if turma_nome:
-        turma_q = supabase.table("turmas").select("id").ilike("nome", f"%{turma_nome}%")
-        if allowed is not None:
-            turma_q = turma_q.in_("id", allowed)
-        turma = turma_q.execute()
-        if turma.data:
-            query = query.eq("turma_id", turma.data[0]["id"])
-        else:
+        turma_id = melhor_id_por_nome("turmas", turma_nome, allowed)
+        if not turma_id:
             return []
+        query = query.eq("turma_id", turma_id)
 
     if data_inicio:
         query = query.gte("data", data_inicio)
     if data_fim:
         query = query.lte("data", data_fim)
 
-    result = query.order("data", desc=True).limit(50).execute()
-    return result.data if result.data else []
+    result = paginar_query(query, cursor, ordem="data", desc=True).execute()
+    return resultado_paginado(result.data or [], cursor_de=lambda l: cursor_keyset(l, "data"), total=result.count)
 
-def tool_consultar_professores(nome: str = None, _scope: Dict = None) -> List[Dict]:
+def tool_consultar_professores(nome: str = None, cursor: str = None, _scope: Dict = None) -> Any:
     """Lista professores com suas turmas"""
     _scope = _scope or {}
     allowed = _scope.get("allowed_turma_ids")
 
+    # Turmas vêm embutidas na mesma query (sem uma consulta por professor)
+    select = f"{PROFESSOR_COLUNAS}, turmas:turmas!turmas_professor_id_fkey(id, nome, idioma, horario)"
+
     # Se há escopo, só lista professores das turmas permitidas
     if allowed is not None:
         if not allowed:
@@ -667,103 +1091,46 @@ def tool_consultar_professores(nome: str = None, _scope: Dict = None) -> List[Di
         prof_ids = list({t["professor_id"] for t in (turmas_res.data or []) if t.get("professor_id")})
         if not prof_ids:
             return []
-        query = supabase.table("usuarios").select("*").in_("id", prof_ids).eq("ativo", True)
+        query = supabase.table("usuarios").select(select, count="exact").in_("id", prof_ids).eq("ativo", True).in_("turmas.id", allowed)
     else:
-        query = supabase.table("usuarios").select("*").eq("perfil", "professor").eq("ativo", True)
+        query = supabase.table("usuarios").select(select, count="exact").eq("perfil", "professor").eq("ativo", True)
 
     if nome:
-        query = query.ilike("nome", f"%{nome}%")
+        query = query.like("nome_busca", padrao_nome(nome))
 
-    professores = query.execute()
-    resultado = []
+    professores = paginar_query(query, cursor).execute()
+    resultado = professores.data or []
 
-    for prof in (professores.data or []):
-        t_query = supabase.table("turmas").select("id, nome, idioma, horario").eq("professor_id", prof["id"])
-        if allowed is not None:
-            t_query = t_query.in_("id", allowed)
-        turmas = t_query.execute()
-        prof["turmas"] = turmas.data or []
+    for prof in resultado:
+        prof["turmas"] = prof.get("turmas") or []
         prof["total_turmas"] = len(prof["turmas"])
-        resultado.append(prof)
 
-    return resultado
+    return resultado_paginado(resultado, total=professores.count)
 
 def tool_estatisticas_gerais(_scope: Dict = None) -> Dict:
-    """Retorna estatísticas gerais"""
+    """Retorna estatísticas gerais (todos os contadores em uma única chamada agregada)"""
     _scope = _scope or {}
     allowed = _scope.get("allowed_turma_ids")
-    stats = {}
 
     # Modo restrito (supervisor): tudo escopado às turmas permitidas
-    if allowed is not None:
-        if not allowed:
-            return {"escopo": "restrito", "total_turmas": 0, "total_alunos": 0}
-
-        stats["escopo"] = "restrito (apenas suas turmas)"
-        stats["total_turmas"] = len(allowed)
-
-        aluno_ids = _alunos_in_scope(_scope) or []
-        stats["total_alunos"] = len(aluno_ids)
-
-        if aluno_ids:
-            ativos = supabase.table("alunos").select("id", count="exact").eq("status_pedagogico", "ativo").in_("id", aluno_ids).execute()
-            stats["alunos_ativos"] = ativos.count or 0
-            transporte = supabase.table("alunos").select("id", count="exact").eq("usa_transporte", True).in_("id", aluno_ids).execute()
-            stats["alunos_transporte"] = transporte.count or 0
-        return stats
-
-    # Total de turmas
-    turmas = supabase.table("turmas").select("id", count="exact").execute()
-    stats["total_turmas"] = turmas.count or 0
-
-    # Total de alunos
-    alunos = supabase.table("alunos").select("id", count="exact").execute()
-    stats["total_alunos"] = alunos.count or 0
-
-    # Alunos por status pedagógico
-    ativos = supabase.table("alunos").select("id", count="exact").eq("status_pedagogico", "ativo").execute()
-    stats["alunos_ativos"] = ativos.count or 0
-
-    trancados = supabase.table("alunos").select("id", count="exact").eq("status_pedagogico", "trancado").execute()
-    stats["alunos_trancados"] = trancados.count or 0
-
-    # Alunos por status financeiro
-    em_dia = supabase.table("alunos").select("id", count="exact").eq("status_financeiro", "em_dia").execute()
-    stats["alunos_em_dia"] = em_dia.count or 0
-
-    pendentes = supabase.table("alunos").select("id", count="exact").eq("status_financeiro", "pendente").execute()
-    stats["alunos_pendentes"] = pendentes.count or 0
-
-    inadimplentes = supabase.table("alunos").select("id", count="exact").eq("status_financeiro", "inadimplente").execute()
-    stats["alunos_inadimplentes"] = inadimplentes.count or 0
-
-    # Total de professores
-    professores = supabase.table("usuarios").select("id", count="exact").eq("perfil", "professor").eq("ativo", True).execute()
-    stats["total_professores"] = professores.count or 0
+    if allowed is not None and not allowed:
+        return {"escopo": "restrito", "total_turmas": 0, "total_alunos": 0}
 
-    # Turmas por idioma
-    turmas_ingles = supabase.table("turmas").select("id", count="exact").eq("idioma", "Inglês").execute()
-    stats["turmas_ingles"] = turmas_ingles.count or 0
+    result = supabase.rpc("estatisticas_escola", {"p_turma_ids": allowed}).execute()
+    stats = result.data or {}
 
-    turmas_espanhol = supabase.table("turmas").select("id", count="exact").eq("idioma", "Espanhol").execute()
-    stats["turmas_espanhol"] = turmas_espanhol.count or 0
-
-    turmas_frances = supabase.table("turmas").select("id", count="exact").eq("idioma", "Francês").execute()
-    stats["turmas_frances"] = turmas_frances.count or 0
-
-    # Alunos que usam transporte
-    transporte = supabase.table("alunos").select("id", count="exact").eq("usa_transporte", True).execute()
-    stats["alunos_transporte"] = transporte.count or 0
+    if allowed is not None:
+        stats = {"escopo": "restrito (apenas suas turmas)", **stats}
 
     return stats
 
-def tool_aniversariantes(mes: int = None, _scope: Dict = None) -> List[Dict]:
+def tool_aniversariantes(mes: int = None, cursor: str = None, _scope: Dict = None) -> Any:
     """Lista aniversariantes do mês"""
     _scope = _scope or {}
     if mes is None:
         mes = datetime.now().month
 
-    query = supabase.table("alunos").select("id, nome, aniversario_dia, aniversario_mes, telefone").eq("aniversario_mes", mes).eq("status_pedagogico", "ativo")
+    query = supabase.table("alunos").select("id, nome, aniversario_dia, aniversario_mes, telefone", count="exact").eq("aniversario_mes", mes).eq("status_pedagogico", "ativo")
 
     aluno_ids = _alunos_in_scope(_scope)
     if aluno_ids is not None:
@@ -771,8 +1138,8 @@ def tool_aniversariantes(mes: int = None, _scope: Dict = None) -> List[Dict]:
             return []
         query = query.in_("id", aluno_ids)
 
-    result = query.order("aniversario_dia").execute()
-    return result.data if result.data else []
+    result = paginar_query(query, cursor, ordem="aniversario_dia").execute()
+    return resultado_paginado(result.data or [], cursor_de=lambda l: cursor_keyset(l, "aniversario_dia"), total=result.count)
 
 # Mapeamento de ferramentas
 TOOL_FUNCTIONS = {
@@ -787,6 +1154,60 @@ TOOL_FUNCTIONS = {
     "aniversariantes": tool_aniversariantes,
 }
 
+# Ferramentas que retornam listas aceitam "cursor" para paginar o resultado
+TOOLS_PAGINADAS = {
+    "consultar_turmas", "consultar_alunos", "consultar_alunos_turma",
+    "consultar_faltas", "consultar_aulas", "consultar_professores", "aniversariantes",
+}
+for _tool in TOOLS:
+    if _tool["function"]["name"] in TOOLS_PAGINADAS:
+        _tool["function"]["parameters"]["properties"]["cursor"] = {
+            "type": "string",
+            "description": "Continuação de um resultado parcial. Use o 'proximo_cursor' retornado pela chamada anterior com os mesmos filtros."
+        }
+
+# Execução paralela das tool_calls de um mesmo turno
+TOOL_MAX_CONCURRENCY = int(os.getenv("TOOL_MAX_CONCURRENCY", "4"))
+TOOL_TIMEOUT_SECONDS = float(os.getenv("TOOL_TIMEOUT_SECONDS", "20"))
+
+async def execute_tool_call(tool_call: Dict[str, Any], scope: Dict[str, Any], semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    """Executa uma tool_call (com escopo e prazo) e retorna a mensagem 'tool' correspondente"""
+    function_name = tool_call["function"]["name"]
+
+    try:
+        function_args = json.loads(tool_call["function"]["arguments"] or "{}")
+    except json.JSONDecodeError:
+        function_args = None
+
+    print(f"Executando: {function_name}({function_args}) | escopo: {scope.get('perfil')}")
+
+    if function_args is None:
+        result = {"erro": f"Argumentos inválidos para {function_name}"}
+    elif function_name in TOOL_FUNCTIONS:
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(
+                    run_blocking(TOOL_FUNCTIONS[function_name], _scope=scope, **function_args),
+                    timeout=TOOL_TIMEOUT_SECONDS,
+                )
+            except asyncio.TimeoutError:
+                result = {"erro": f"Tempo esgotado ao executar {function_name}"}
+            except Exception as e:
+                result = {"erro": str(e)}
+    else:
+        result = {"erro": f"Função {function_name} não encontrada"}
+
+    return {
+        "role": "tool",
+        "tool_call_id": tool_call["id"],
+        "content": json.dumps(result, ensure_ascii=False, default=str)
+    }
+
+async def execute_tool_calls(tool_calls: List[Dict[str, Any]], scope: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Executa as tool_calls de um turno concorrentemente, limitado a TOOL_MAX_CONCURRENCY"""
+    semaphore = asyncio.Semaphore(TOOL_MAX_CONCURRENCY)
+    return await asyncio.gather(*(execute_tool_call(tc, scope, semaphore) for tc in tool_calls))
+
 # ============================================
 # ENDPOINT PRINCIPAL
 # ============================================
@@ -794,14 +1215,10 @@ TOOL_FUNCTIONS = {
 def build_system_prompt(scope: Dict[str, Any]) -> str:
     """Constrói o system prompt baseado no escopo do usuário"""
     perfil = scope.get("perfil", "admin")
-    allowed = scope.get("allowed_turma_ids")
 
     if perfil == "supervisor":
-        # Busca nomes das turmas para contexto
-        turma_nomes = []
-        if allowed:
-            t = supabase.table("turmas").select("nome").in_("id", allowed).execute()
-            turma_nomes = [r["nome"] for r in (t.data or [])]
+        # Nomes das turmas já vêm no escopo
+        turma_nomes = scope.get("turma_nomes") or []
         turmas_str = ", ".join(turma_nomes) if turma_nomes else "(nenhuma turma vinculada)"
 
         return f"""Você é o assistente virtual da EduLingua, atendendo um SUPERVISOR de turmas.
@@ -852,141 +1269,391 @@ Seja prestativo, claro e direto nas respostas!
 """
 
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+# Loop do agente: até MAX_TOOL_ROUNDS rodadas de ferramentas antes da resposta final
+CHAT_MODEL = "gpt-4.1-mini"
+MAX_TOOL_ROUNDS = int(os.getenv("MAX_TOOL_ROUNDS", "3"))
+
+async def build_chat_messages(request: ChatRequest, scope: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Monta system prompt + histórico + mensagem atual"""
+    messages = [{"role": "system", "content": build_system_prompt(scope)}]
+
+    # Adiciona histórico
+    for msg in request.history[-10:]:  # Últimas 10 mensagens
+        messages.append({"role": msg.role, "content": msg.content})
+
+    # Adiciona mensagem atual
+    messages.append({"role": "user", "content": request.message})
+    return messages
+
+async def stream_completion(messages: List[Dict[str, Any]], with_tools: bool):
     """
-    Endpoint principal do chat
+    Faz uma chamada em streaming ao modelo.
+    Gera ("token", texto) para cada pedaço da resposta e, ao final,
+    ("tool_calls", [...]) se o modelo pediu ferramentas.
     """
-    try:
-        # Determina escopo do usuário
-        scope = compute_user_scope(request.user)
+    params = {"model": CHAT_MODEL, "messages": messages, "temperature": 0.3, "stream": True}
+    if with_tools:
+        params["tools"] = TOOLS
+        params["tool_choice"] = "auto"
+
+    stream = await openai_dependencia.executar(
+        lambda timeout: openai_client.chat.completions.create(**params, timeout=timeout)
+    )
+
+    # tool_calls chegam fragmentadas por índice
+    tool_calls: Dict[int, Dict[str, Any]] = {}
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            yield "token", delta.content
+        for tc in (delta.tool_calls or []):
+            entry = tool_calls.setdefault(tc.index, {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+            if tc.id:
+                entry["id"] = tc.id
+            if tc.function and tc.function.name:
+                entry["function"]["name"] += tc.function.name
+            if tc.function and tc.function.arguments:
+                entry["function"]["arguments"] += tc.function.arguments
+
+    if tool_calls:
+        yield "tool_calls", [tool_calls[i] for i in sorted(tool_calls)]
+
+async def run_agent(messages: List[Dict[str, Any]], scope: Dict[str, Any]):
+    """
+    Executa o agente e gera eventos:
+    - {"type": "tool_start", "tools": [...], "round": n}
+    - {"type": "tool_end", "tools": [...], "round": n}
+    - {"type": "token", "content": "..."}
+    A última rodada é feita sem ferramentas para forçar a resposta final.
+
+    Numa rodada com ferramentas o texto fica retido até o fim: se ela terminar
+    em tool_calls, o texto é só o preâmbulo da chamada e não vai para o cliente.
+    A rodada final (sem ferramentas) é transmitida token a token.
+    """
+    for round_num in range(MAX_TOOL_ROUNDS + 1):
+        with_tools = round_num < MAX_TOOL_ROUNDS
+        content_parts = []
+        tool_calls = None
+
+        async for kind, payload in stream_completion(messages, with_tools):
+            if kind == "token":
+                content_parts.append(payload)
+                if not with_tools:
+                    yield {"type": "token", "content": payload}
+            else:
+                tool_calls = payload
+
+        if not tool_calls:
+            if with_tools and content_parts:
+                yield {"type": "token", "content": "".join(content_parts)}
+            return
+
+        # Adiciona resposta do assistente com tool_calls
+        messages.append({
+            "role": "assistant",
+            "content": "".join(content_parts) or None,
+            "tool_calls": tool_calls,
+        })
 
-        # Monta histórico de mensagens
-        messages = [{"role": "system", "content": build_system_prompt(scope)}]
+        names = [tc["function"]["name"] for tc in tool_calls]
+        yield {"type": "tool_start", "tools": names, "round": round_num + 1}
 
-        # Adiciona histórico
-        for msg in request.history[-10:]:  # Últimas 10 mensagens
-            messages.append({"role": msg.role, "content": msg.content})
+        # Executa as ferramentas em paralelo (ordem dos resultados preservada)
+        tool_messages = await execute_tool_calls(tool_calls, scope)
+        messages.extend(tool_messages)
 
-        # Adiciona mensagem atual
-        messages.append({"role": "user", "content": request.message})
+        yield {"type": "tool_end", "tools": names, "round": round_num + 1}
 
-        # Primeira chamada - pode solicitar tools
-        response = openai_client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=messages,
-            tools=TOOLS,
-            tool_choice="auto",
-            temperature=0.3
-        )
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Formata um evento Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
 
-        assistant_message = response.choices[0].message
 
-        # Se precisar executar ferramentas
-        if assistant_message.tool_calls:
-            # Adiciona resposta do assistente com tool_calls
-            messages.append(assistant_message)
+# ============================================
+# CACHE DE RESPOSTAS DO CHAT
+# ============================================
 
-            # Executa cada ferramenta
-            for tool_call in assistant_message.tool_calls:
-                function_name = tool_call.function.name
-                function_args = json.loads(tool_call.function.arguments)
+# Só perguntas sem histórico (a resposta não depende da conversa). A chave é a
+# mensagem normalizada + escopo + dia; a entrada guarda a versão das tabelas
+# que as ferramentas usadas leram e expira se alguma delas mudar.
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "500"))
+CHAT_CACHE_TTL_SECONDS = float(os.getenv("CHAT_CACHE_TTL_SECONDS", "600"))
+CHAT_CACHE_SEMANTIC = os.getenv("CHAT_CACHE_SEMANTIC", "false").lower() in ("1", "true", "yes")
+CHAT_CACHE_SEMANTIC_THRESHOLD = float(os.getenv("CHAT_CACHE_SEMANTIC_THRESHOLD", "0.95"))
+CHAT_CACHE_EMBEDDING_MODEL = "text-embedding-3-small"
+CHAT_CACHE_EMBEDDING_DIMENSIONS = 256
+
+# Tabelas lidas por cada ferramenta (ferramenta desconhecida → todas)
+TABELAS_DADOS = ("alunos", "turmas", "matriculas", "aulas", "presencas", "usuarios", "supervisor_turmas")
+TOOL_TABELAS = {
+    "consultar_turmas": ("turmas", "matriculas", "usuarios"),
+    "consultar_alunos": ("alunos", "matriculas"),
+    "consultar_alunos_turma": ("alunos", "matriculas", "turmas"),
+    "consultar_turmas_aluno": ("turmas", "matriculas", "alunos"),
+    "consultar_faltas": ("presencas", "aulas", "alunos", "turmas"),
+    "consultar_aulas": ("aulas", "turmas"),
+    "consultar_professores": ("usuarios", "turmas"),
+    "estatisticas_gerais": ("turmas", "alunos", "matriculas", "usuarios"),
+    "aniversariantes": ("alunos",),
+}
+# Tabelas que mudam ao longo do dia encurtam o TTL das respostas que dependem delas
+CHAT_CACHE_TTL_POR_TABELA = {"presencas": 300, "aulas": 300}
 
-                print(f"Executando: {function_name}({function_args}) | escopo: {scope.get('perfil')}")
+_versoes_dados: Dict[str, int] = {tabela: 0 for tabela in TABELAS_DADOS}
 
-                # Executa a função (com escopo)
-                if function_name in TOOL_FUNCTIONS:
-                    try:
-                        result = TOOL_FUNCTIONS[function_name](_scope=scope, **function_args)
-                    except Exception as e:
-                        result = {"erro": str(e)}
-                else:
-                    result = {"erro": f"Função {function_name} não encontrada"}
-                
-                # Adiciona resultado da ferramenta
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": json.dumps(result, ensure_ascii=False, default=str)
-                })
-            
-            # Segunda chamada - gera resposta final
-            final_response = openai_client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=messages,
-                temperature=0.3
-            )
-            
-            return ChatResponse(
-                response=final_response.choices[0].message.content,
-                data=None
+def incrementar_versao_dados(tabela: str):
+    _versoes_dados[tabela] = _versoes_dados.get(tabela, 0) + 1
+
+for _tabela in TABELAS_DADOS:
+    on_data_change(_tabela)(functools.partial(incrementar_versao_dados, _tabela))
+
+def escopo_cache_key(scope: Dict[str, Any]) -> str:
+    """
+    Usuários com o mesmo perfil e as mesmas turmas compartilham entradas de cache
+    (o perfil muda o prompt e as ferramentas, então professor e supervisor não se misturam)
+    """
+    allowed = scope.get("allowed_turma_ids")
+    turmas = "todas" if allowed is None else hashlib.sha1(",".join(sorted(allowed)).encode()).hexdigest()
+    return f"{scope.get('perfil') or 'admin'}:{turmas}"
+
+def normalizar_pergunta(texto: str) -> str:
+    """Minúsculas, sem acentos, sem pontuação e com espaços colapsados"""
+    sem_acento = unicodedata.normalize("NFKD", texto.lower()).encode("ascii", "ignore").decode()
+    return " ".join("".join(c if c.isalnum() else " " for c in sem_acento).split())
+
+class ChatCache:
+    """LRU de respostas do chat com TTL por entrada e validação pela versão das tabelas"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entradas: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.stats = {"hits": 0, "hits_semanticos": 0, "misses": 0, "segundos_economizados": 0.0}
+
+    def _valida(self, entrada: Dict[str, Any], agora: float) -> bool:
+        return entrada["expires_at"] > agora and all(
+            _versoes_dados.get(t, 0) == v for t, v in entrada["versoes"].items()
+        )
+
+    def _hit(self, chave: str, entrada: Dict[str, Any], semantico: bool = False) -> str:
+        self._entradas.move_to_end(chave)
+        self.stats["hits"] += 1
+        if semantico:
+            self.stats["hits_semanticos"] += 1
+        self.stats["segundos_economizados"] += entrada["duracao"]
+        return entrada["resposta"]
+
+    def buscar(self, chave: str) -> Optional[str]:
+        entrada = self._entradas.get(chave)
+        if entrada and self._valida(entrada, time.monotonic()):
+            return self._hit(chave, entrada)
+        if entrada:
+            del self._entradas[chave]
+        return None
+
+    def buscar_similar(self, embedding: List[float], grupo: str) -> Optional[str]:
+        """Entrada válida do mesmo escopo/dia com cosseno >= CHAT_CACHE_SEMANTIC_THRESHOLD"""
+        agora = time.monotonic()
+        melhor, melhor_chave = CHAT_CACHE_SEMANTIC_THRESHOLD, None
+        for chave, entrada in self._entradas.items():
+            if entrada["grupo"] != grupo or not entrada.get("embedding") or not self._valida(entrada, agora):
+                continue
+            # Embeddings da OpenAI são normalizados: produto interno = cosseno
+            similaridade = sum(a * b for a, b in zip(embedding, entrada["embedding"]))
+            if similaridade >= melhor:
+                melhor, melhor_chave = similaridade, chave
+        return self._hit(melhor_chave, self._entradas[melhor_chave], semantico=True) if melhor_chave else None
+
+    def registrar_miss(self):
+        self.stats["misses"] += 1
+
+    def salvar(self, chave: str, grupo: str, resposta: str, tools: List[str], versoes: Dict[str, int],
+               duracao: float, embedding: Optional[List[float]] = None):
+        tabelas = set()
+        for tool in tools:
+            tabelas.update(TOOL_TABELAS.get(tool, TABELAS_DADOS))
+        ttl = min([CHAT_CACHE_TTL_SECONDS] + [CHAT_CACHE_TTL_POR_TABELA[t] for t in tabelas if t in CHAT_CACHE_TTL_POR_TABELA])
+        self._entradas[chave] = {
+            "resposta": resposta,
+            "grupo": grupo,
+            "versoes": {t: versoes.get(t, 0) for t in tabelas},
+            "expires_at": time.monotonic() + ttl,
+            "duracao": duracao,
+            "embedding": embedding,
+        }
+        self._entradas.move_to_end(chave)
+        while len(self._entradas) > self.max_entries:
+            self._entradas.popitem(last=False)
+
+    def resumo(self) -> Dict[str, Any]:
+        consultas = self.stats["hits"] + self.stats["misses"]
+        return {
+            "entradas": len(self._entradas),
+            "max_entradas": self.max_entries,
+            **self.stats,
+            "segundos_economizados": round(self.stats["segundos_economizados"], 2),
+            "hit_rate": round(self.stats["hits"] / consultas, 3) if consultas else 0.0,
+            "semantico": CHAT_CACHE_SEMANTIC,
+        }
+
+chat_cache = ChatCache(CHAT_CACHE_MAX_ENTRIES)
+
+async def _embedding_pergunta(texto: str) -> Optional[List[float]]:
+    try:
+        result = await openai_dependencia.executar(
+            lambda timeout: openai_client.embeddings.create(
+                model=CHAT_CACHE_EMBEDDING_MODEL, input=texto,
+                dimensions=CHAT_CACHE_EMBEDDING_DIMENSIONS, timeout=timeout,
             )
-        
-        # Resposta direta (sem tools)
+        )
+        return result.data[0].embedding
+    except Exception as e:
+        print(f"Erro ao gerar embedding do cache do chat: {e}")
+        return None
+
+async def consultar_cache_chat(request: ChatRequest, scope: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Procura a resposta no cache. Retorna o contexto para salvar depois (chave, grupo,
+    versões no início do cálculo, embedding) e, em caso de hit, "resposta".
+    Perguntas com histórico não usam cache (contexto: {"cacheavel": False}).
+    """
+    if request.history:
+        return {"cacheavel": False}
+    pergunta = normalizar_pergunta(request.message)
+    grupo = f"{escopo_cache_key(scope)}:{date.today().isoformat()}"
+    contexto = {
+        "cacheavel": bool(pergunta),
+        "chave": f"{grupo}:{hashlib.sha1(pergunta.encode()).hexdigest()}",
+        "grupo": grupo,
+        "versoes": dict(_versoes_dados),
+        "embedding": None,
+        "inicio": time.monotonic(),
+    }
+    if not contexto["cacheavel"]:
+        return contexto
+
+    resposta = chat_cache.buscar(contexto["chave"])
+    if resposta is None and CHAT_CACHE_SEMANTIC:
+        contexto["embedding"] = await _embedding_pergunta(pergunta)
+        if contexto["embedding"]:
+            resposta = chat_cache.buscar_similar(contexto["embedding"], grupo)
+    if resposta is None:
+        chat_cache.registrar_miss()
+    else:
+        contexto["resposta"] = resposta
+    return contexto
+
+def salvar_cache_chat(contexto: Dict[str, Any], resposta: str, tools: List[str]):
+    if contexto.get("cacheavel") and resposta:
+        chat_cache.salvar(
+            contexto["chave"], contexto["grupo"], resposta, tools, contexto["versoes"],
+            time.monotonic() - contexto["inicio"], contexto["embedding"],
+        )
+
+@app.get("/chat/cache/stats")
+async def chat_cache_stats():
+    """Hit rate do cache de respostas do chat e tempo economizado"""
+    return chat_cache.resumo()
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest):
+    """
+    Endpoint principal do chat
+    """
+    try:
+        # Determina escopo do usuário
+        scope = await run_blocking(compute_user_scope, request.user)
+        cache = await consultar_cache_chat(request, scope)
+        if "resposta" in cache:
+            return ChatResponse(response=cache["resposta"], data=None)
+
+        messages = await build_chat_messages(request, scope)
+
+        parts, tools = [], []
+        async for event in run_agent(messages, scope):
+            if event["type"] == "token":
+                parts.append(event["content"])
+            elif event["type"] == "tool_start":
+                tools.extend(event["tools"])
+
+        resposta = "".join(parts)
+        salvar_cache_chat(cache, resposta, tools)
         return ChatResponse(
-            response=assistant_message.content,
+            response=resposta,
             data=None
         )
-    
+
+    except HTTPException:
+        # Ex.: 503 do circuit breaker (dependência fora): o cliente distingue fail-fast de erro interno
+        raise
     except Exception as e:
         print(f"Erro no chat: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Chat em streaming (SSE): eventos 'tool_start'/'tool_end' enquanto as
+    ferramentas rodam, 'token' para cada pedaço da resposta e 'done' ao final
+    """
+    async def event_generator():
+        try:
+            scope = await run_blocking(compute_user_scope, request.user)
+            cache = await consultar_cache_chat(request, scope)
+            if "resposta" in cache:
+                yield sse_event("token", {"type": "token", "content": cache["resposta"]})
+                yield sse_event("done", {"type": "done", "cache": True})
+                return
+
+            messages = await build_chat_messages(request, scope)
+
+            parts, tools = [], []
+            async for event in run_agent(messages, scope):
+                if event["type"] == "token":
+                    parts.append(event["content"])
+                elif event["type"] == "tool_start":
+                    tools.extend(event["tools"])
+                yield sse_event(event["type"], event)
+
+            salvar_cache_chat(cache, "".join(parts), tools)
+            yield sse_event("done", {"type": "done"})
+        except Exception as e:
+            print(f"Erro no chat (stream): {e}")
+            yield sse_event("error", {"type": "error", "detail": str(e)})
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # ============================================
 # ALERTAS (Faltas + Inadimplência)
 # ============================================
 
-@app.get("/alertas")
-async def get_alertas():
-    """Retorna alertas de faltas da semana e alunos inadimplentes"""
-    today = datetime.now()
-    inicio_semana = (today - timedelta(days=today.weekday())).strftime("%Y-%m-%d")
-    fim_semana = (today + timedelta(days=6 - today.weekday())).strftime("%Y-%m-%d")
-
-    # Faltas da semana
-    aulas = supabase.table("aulas").select("id, data, turma:turmas(id, nome)").gte("data", inicio_semana).lte("data", fim_semana).execute()
-    aula_ids = [a["id"] for a in (aulas.data or [])]
-
-    faltas_por_aluno = {}
-    if aula_ids:
-        presencas = supabase.table("presencas").select("*, aluno:alunos(id, nome, telefone), aula:aulas(data, turma:turmas(nome))").in_("aula_id", aula_ids).eq("presente", False).execute()
-        for p in (presencas.data or []):
-            aluno = p.get("aluno", {})
-            aid = aluno.get("id", "")
-            if aid not in faltas_por_aluno:
-                faltas_por_aluno[aid] = {"aluno": aluno, "total": 0, "turmas": set(), "datas": []}
-            faltas_por_aluno[aid]["total"] += 1
-            turma_nome = p.get("aula", {}).get("turma", {}).get("nome", "")
-            if turma_nome:
-                faltas_por_aluno[aid]["turmas"].add(turma_nome)
-            faltas_por_aluno[aid]["datas"].append(p.get("aula", {}).get("data", ""))
-
-    faltas_lista = []
-    for aid, info in faltas_por_aluno.items():
-        faltas_lista.append({
-            "aluno_id": aid,
-            "nome": info["aluno"].get("nome", ""),
-            "telefone": info["aluno"].get("telefone", ""),
-            "total_faltas": info["total"],
-            "turmas": list(info["turmas"]),
-            "datas": info["datas"],
-        })
-    faltas_lista.sort(key=lambda x: x["total_faltas"], reverse=True)
-
-    # Inadimplentes
-    inadimplentes_result = supabase.table("alunos").select("id, nome, telefone, email, status_financeiro, valor_mensalidade, dia_vencimento").in_("status_financeiro", ["pendente", "inadimplente"]).eq("status_pedagogico", "ativo").order("nome").execute()
-
-    inadimplentes = []
-    for aluno in (inadimplentes_result.data or []):
-        inadimplentes.append({
-            "aluno_id": aluno["id"],
-            "nome": aluno.get("nome", ""),
-            "telefone": aluno.get("telefone", ""),
-            "email": aluno.get("email", ""),
-            "status": aluno.get("status_financeiro", ""),
-            "valor_mensalidade": aluno.get("valor_mensalidade"),
-            "dia_vencimento": aluno.get("dia_vencimento"),
-        })
+# Snapshot de alertas por semana e escopo (usuários com as mesmas turmas compartilham a entrada),
+# com TTL; invalidado quando presenças, alunos ou pagamentos mudam
+ALERTAS_CACHE_TTL_SECONDS = float(os.getenv("ALERTAS_CACHE_TTL_SECONDS", "300"))
+_alertas_cache: Dict[str, Dict[str, Any]] = {}
+_alertas_cache_lock = threading.Lock()
+_alertas_geracao = 0  # incrementada a cada invalidação: snapshot calculado antes dela não é salvo
+
+@on_data_change("presencas", "aulas", "alunos", "matriculas", "turmas", "supervisor_turmas")
+def invalidate_alertas_cache():
+    global _alertas_geracao
+    with _alertas_cache_lock:
+        _alertas_geracao += 1
+        _alertas_cache.clear()
+
+def _calcular_alertas(inicio_semana: str, fim_semana: str, allowed: Optional[List[str]]) -> Dict[str, Any]:
+    # Faltas agregadas por aluno e inadimplentes, calculados no banco (só nas turmas do escopo)
+    alertas = {}
+    if allowed is None or allowed:
+        result = supabase.rpc("alertas_semana", {"p_inicio": inicio_semana, "p_fim": fim_semana, "p_turma_ids": allowed}).execute()
+        alertas = result.data or {}
+    faltas_lista = alertas.get("faltas") or []
+    inadimplentes = alertas.get("inadimplentes") or []
 
     return {
         "faltas": faltas_lista,
@@ -999,6 +1666,46 @@ async def get_alertas():
         "periodo": {"inicio": inicio_semana, "fim": fim_semana},
     }
 
+def _etag_confere(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+@app.get("/alertas")
+async def get_alertas(request: Request, user_id: Optional[str] = None, perfil: Optional[str] = None):
+    """
+    Retorna alertas de faltas da semana e alunos inadimplentes (304 se o ETag não mudou).
+    user_id/perfil: mesmo contexto do chat (ChatUser); professor/supervisor só veem suas turmas.
+    """
+    today = datetime.now()
+    inicio_semana = (today - timedelta(days=today.weekday())).strftime("%Y-%m-%d")
+    fim_semana = (today + timedelta(days=6 - today.weekday())).strftime("%Y-%m-%d")
+
+    scope = await run_blocking(compute_user_scope, ChatUser(id=user_id, perfil=perfil) if perfil else None)
+    allowed = scope["allowed_turma_ids"]
+
+    cache_key = f"{inicio_semana}:{escopo_cache_key(scope)}"
+    now = time.monotonic()
+    with _alertas_cache_lock:
+        entry = _alertas_cache.get(cache_key)
+        geracao = _alertas_geracao
+    if not entry or entry["expires_at"] <= now:
+        payload = await run_blocking(_calcular_alertas, inicio_semana, fim_semana, allowed)
+        corpo = json.dumps(payload, sort_keys=True, default=str).encode()
+        entry = {"payload": payload, "etag": f'"{hashlib.sha1(corpo).hexdigest()}"', "expires_at": now + ALERTAS_CACHE_TTL_SECONDS}
+        with _alertas_cache_lock:
+            if geracao == _alertas_geracao:
+                for key in [k for k, v in _alertas_cache.items() if v["expires_at"] <= now]:
+                    del _alertas_cache[key]
+                _alertas_cache[cache_key] = entry
+
+    # no-cache: o navegador guarda a resposta mas revalida sempre com If-None-Match
+    headers = {"ETag": entry["etag"], "Cache-Control": "no-cache"}
+    if _etag_confere(request.headers.get("if-none-match"), entry["etag"]):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(entry["payload"], headers=headers)
+
 # ============================================
 # INTEGRAÇÃO BANCO CORA
 # ============================================
@@ -1014,85 +1721,223 @@ CORA_BASE_URLS = {
 }
 
 _cora_token_cache = {"token": None, "expires_at": 0}
+_cora_token_lock = asyncio.Lock()
+_cora_token_refresher: Optional[asyncio.Task] = None
+
+# Token: margem mínima de validade para uso, antecedência da renovação em background
+# e onde compartilhar o token entre workers (memoria, arquivo ou banco)
+CORA_TOKEN_MARGIN_SECONDS = int(os.getenv("CORA_TOKEN_MARGIN_SECONDS", "60"))
+CORA_TOKEN_REFRESH_AHEAD_SECONDS = int(os.getenv("CORA_TOKEN_REFRESH_AHEAD_SECONDS", "300"))
+CORA_TOKEN_STORE = os.getenv("CORA_TOKEN_STORE", "memoria")
+CORA_TOKEN_FILE = os.getenv("CORA_TOKEN_FILE", os.path.join(tempfile.gettempdir(), "cora_token.json"))
+
+# Lote de mensalidades: concorrência, rate limit (quota da Cora) e tamanho dos inserts
+CORA_BATCH_CONCURRENCY = int(os.getenv("CORA_BATCH_CONCURRENCY", "8"))
+CORA_RATE_LIMIT_PER_SECOND = float(os.getenv("CORA_RATE_LIMIT_PER_SECOND", "5"))
+CORA_RATE_LIMIT_BURST = int(os.getenv("CORA_RATE_LIMIT_BURST", "10"))
+COBRANCAS_INSERT_CHUNK = int(os.getenv("COBRANCAS_INSERT_CHUNK", "200"))
+
+class TokenBucket:
+    """Rate limiter (token bucket): até `burst` chamadas imediatas, depois `rate` por segundo"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+cora_rate_limiter = TokenBucket(CORA_RATE_LIMIT_PER_SECOND, CORA_RATE_LIMIT_BURST)
+
+def cora_configured() -> bool:
+    return bool(CORA_CLIENT_ID and CORA_CERT_B64 and CORA_KEY_B64)
+
+def _cora_ssl_context() -> ssl.SSLContext:
+    """Monta o SSLContext mTLS da Cora (os arquivos temporários só existem durante o carregamento)"""
+    cert_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pem")
+    key_file = tempfile.NamedTemporaryFile(delete=False, suffix=".key")
+    try:
+        cert_file.write(base64.b64decode(CORA_CERT_B64))
+        cert_file.close()
+        key_file.write(base64.b64decode(CORA_KEY_B64))
+        key_file.close()
+        context = ssl.create_default_context()
+        context.load_cert_chain(certfile=cert_file.name, keyfile=key_file.name)
+        return context
+    finally:
+        os.unlink(cert_file.name)
+        os.unlink(key_file.name)
 
-async def cora_get_token() -> str:
-    """Obtém access token da Cora via mTLS"""
-    now = datetime.now().timestamp()
-    if _cora_token_cache["token"] and _cora_token_cache["expires_at"] > now:
-        return _cora_token_cache["token"]
+# Erro ao carregar certificado/chave: a Cora fica desativada até corrigir o .env e reiniciar
+_cora_config_erro: Optional[str] = None
 
-    if not CORA_CLIENT_ID or not CORA_CERT_B64 or not CORA_KEY_B64:
+def get_cora_client() -> httpx.AsyncClient:
+    """Cliente mTLS compartilhado da Cora (criado uma vez, com pool de conexões)"""
+    global _cora_config_erro
+    if not cora_configured():
         raise HTTPException(status_code=503, detail="Cora não configurada. Defina CORA_CLIENT_ID, CORA_CERTIFICATE_BASE64 e CORA_PRIVATE_KEY_BASE64")
+    if _cora_config_erro:
+        raise HTTPException(status_code=503, detail=f"Cora desativada: {_cora_config_erro}")
+    if "cora" not in _http_clients:
+        try:
+            verify = _cora_ssl_context()
+        except (ValueError, ssl.SSLError, OSError) as e:
+            _cora_config_erro = f"certificado/chave inválidos ({e})"
+            print(f"Cora desativada: {_cora_config_erro}")
+            raise HTTPException(status_code=503, detail=f"Cora desativada: {_cora_config_erro}")
+        _http_clients["cora"] = httpx.AsyncClient(
+            base_url=CORA_BASE_URLS.get(CORA_ENV, CORA_BASE_URLS["stage"]),
+            verify=verify,
+            http2=HTTP2_ENABLED,
+            limits=http_pool_limits(),
+            timeout=30.0,
+        )
+    return _http_clients["cora"]
 
-    # Decodifica certificados de base64 para arquivos temporários
-    cert_bytes = base64.b64decode(CORA_CERT_B64)
-    key_bytes = base64.b64decode(CORA_KEY_B64)
-
-    cert_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pem")
-    key_file = tempfile.NamedTemporaryFile(delete=False, suffix=".key")
-    cert_file.write(cert_bytes)
-    cert_file.close()
-    key_file.write(key_bytes)
-    key_file.close()
+def _cora_token_valido(entrada: Optional[dict], margem: int = CORA_TOKEN_MARGIN_SECONDS) -> bool:
+    return bool(entrada and entrada.get("token") and entrada.get("expires_at", 0) - margem > time.time())
 
-    base_url = CORA_BASE_URLS.get(CORA_ENV, CORA_BASE_URLS["stage"])
+def _ler_token_compartilhado() -> Optional[dict]:
+    """Lê o token salvo por outro worker (arquivo ou tabela integracao_tokens)"""
+    try:
+        if CORA_TOKEN_STORE == "arquivo":
+            with open(CORA_TOKEN_FILE) as f:
+                return json.load(f)
+        if CORA_TOKEN_STORE == "banco":
+            result = supabase.table("integracao_tokens").select("access_token, expires_at").eq("servico", "cora").execute()
+            if result.data:
+                row = result.data[0]
+                return {"token": row["access_token"], "expires_at": datetime.fromisoformat(row["expires_at"]).timestamp()}
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Erro ao ler token compartilhado da Cora: {e}")
+    return None
 
+def _salvar_token_compartilhado(entrada: dict):
     try:
-        async with httpx.AsyncClient(cert=(cert_file.name, key_file.name), timeout=30.0) as client:
-            resp = await client.post(
-                f"{base_url}/token",
-                data={"grant_type": "client_credentials", "client_id": CORA_CLIENT_ID},
-                headers={"Content-Type": "application/x-www-form-urlencoded"},
-            )
-            if resp.status_code != 200:
-                raise HTTPException(status_code=resp.status_code, detail=f"Erro auth Cora: {resp.text}")
-            data = resp.json()
-            _cora_token_cache["token"] = data["access_token"]
-            _cora_token_cache["expires_at"] = now + data.get("expires_in", 86400) - 300
-            return data["access_token"]
-    finally:
-        import os as _os
-        _os.unlink(cert_file.name)
-        _os.unlink(key_file.name)
+        if CORA_TOKEN_STORE == "arquivo":
+            # Escrita atômica: outros workers nunca leem um arquivo pela metade
+            tmp = f"{CORA_TOKEN_FILE}.{os.getpid()}.tmp"
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(entrada, f)
+            os.replace(tmp, CORA_TOKEN_FILE)
+        elif CORA_TOKEN_STORE == "banco":
+            supabase.table("integracao_tokens").upsert({
+                "servico": "cora",
+                "access_token": entrada["token"],
+                "expires_at": datetime.fromtimestamp(entrada["expires_at"]).astimezone().isoformat(),
+            }).execute()
+    except Exception as e:
+        print(f"Erro ao salvar token compartilhado da Cora: {e}")
+
+async def _buscar_token_cora() -> dict:
+    client = get_cora_client()
+    resp = await cora_dependencia.executar(
+        lambda timeout: client.post(
+            "/token",
+            data={"grant_type": "client_credentials", "client_id": CORA_CLIENT_ID},
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            timeout=timeout,
+        ),
+        path="/token",
+    )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=f"Erro auth Cora: {resp.text}")
+    data = resp.json()
+    return {"token": data["access_token"], "expires_at": time.time() + data.get("expires_in", 86400)}
+
+async def cora_get_token(renovar_antes: int = CORA_TOKEN_MARGIN_SECONDS) -> str:
+    """
+    Obtém access token da Cora via mTLS (single-flight: só uma corrotina chama /token,
+    as demais aguardam o lock e reaproveitam o resultado)
+    """
+    if _cora_token_valido(_cora_token_cache, renovar_antes):
+        return _cora_token_cache["token"]
+
+    async with _cora_token_lock:
+        if _cora_token_valido(_cora_token_cache, renovar_antes):
+            return _cora_token_cache["token"]
+
+        entrada = None
+        if CORA_TOKEN_STORE != "memoria":
+            compartilhado = await run_blocking(_ler_token_compartilhado)
+            if _cora_token_valido(compartilhado, renovar_antes):
+                entrada = compartilhado
+        if entrada is None:
+            entrada = await _buscar_token_cora()
+            if CORA_TOKEN_STORE != "memoria":
+                await run_blocking(_salvar_token_compartilhado, entrada)
+
+        _cora_token_cache.update(entrada)
+        return entrada["token"]
+
+async def _renovar_token_cora_loop():
+    """Renova o token antes de expirar para que nenhuma requisição espere por /token"""
+    while True:
+        try:
+            await cora_get_token(renovar_antes=CORA_TOKEN_REFRESH_AHEAD_SECONDS)
+            espera = _cora_token_cache["expires_at"] - CORA_TOKEN_REFRESH_AHEAD_SECONDS - time.time()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Erro ao renovar token da Cora: {e}")
+            espera = 30
+        await asyncio.sleep(max(espera, 5))
+
+def iniciar_renovacao_token_cora():
+    global _cora_token_refresher
+    if cora_configured() and _cora_token_refresher is None:
+        _cora_token_refresher = asyncio.create_task(_renovar_token_cora_loop())
+
+async def parar_renovacao_token_cora():
+    global _cora_token_refresher
+    if _cora_token_refresher:
+        _cora_token_refresher.cancel()
+        await asyncio.gather(_cora_token_refresher, return_exceptions=True)
+        _cora_token_refresher = None
+
+async def cora_request(method: str, path: str, data: dict = None, idempotency_key: Optional[str] = None) -> dict:
+    """Request autenticado à API Cora (POSTs com Idempotency-Key; use uma chave determinística para retries seguros)"""
+    if method not in ("POST", "GET", "DELETE"):
+        raise ValueError(f"Método {method} não suportado")
 
-async def cora_request(method: str, path: str, data: dict = None) -> dict:
-    """Request autenticado à API Cora"""
     token = await cora_get_token()
-    base_url = CORA_BASE_URLS.get(CORA_ENV, CORA_BASE_URLS["stage"])
+    client = get_cora_client()
 
-    # Decodifica certificados novamente para mTLS
-    cert_bytes = base64.b64decode(CORA_CERT_B64)
-    key_bytes = base64.b64decode(CORA_KEY_B64)
-    cert_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pem")
-    key_file = tempfile.NamedTemporaryFile(delete=False, suffix=".key")
-    cert_file.write(cert_bytes)
-    cert_file.close()
-    key_file.write(key_bytes)
-    key_file.close()
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    if method == "POST":
+        headers["Idempotency-Key"] = idempotency_key or str(uuid.uuid4())
 
-    try:
-        async with httpx.AsyncClient(cert=(cert_file.name, key_file.name), timeout=30.0) as client:
-            headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-            if method == "POST":
-                headers["Idempotency-Key"] = str(uuid.uuid4())
-                resp = await client.post(f"{base_url}{path}", headers=headers, json=data or {})
-            elif method == "GET":
-                resp = await client.get(f"{base_url}{path}", headers=headers, params=data)
-            elif method == "DELETE":
-                resp = await client.delete(f"{base_url}{path}", headers=headers)
-            else:
-                raise ValueError(f"Método {method} não suportado")
+    async def enviar(timeout: float) -> httpx.Response:
+        await cora_rate_limiter.acquire()
+        if method == "POST":
+            return await client.post(path, headers=headers, json=data or {}, timeout=timeout)
+        if method == "GET":
+            return await client.get(path, headers=headers, params=data, timeout=timeout)
+        return await client.delete(path, headers=headers, timeout=timeout)
 
-            if resp.status_code >= 400:
-                return {"error": True, "status": resp.status_code, "detail": resp.text}
-            try:
-                return resp.json()
-            except Exception:
-                return {"raw": resp.text}
-    finally:
-        import os as _os
-        _os.unlink(cert_file.name)
-        _os.unlink(key_file.name)
+    # POST só é repetido com chave de idempotência determinística
+    resp = await cora_dependencia.executar(enviar, path=path, idempotente=method != "POST" or bool(idempotency_key))
+
+    if resp.status_code >= 400:
+        return {"error": True, "status": resp.status_code, "detail": resp.text}
+    try:
+        return resp.json()
+    except Exception:
+        return {"raw": resp.text}
 
 class GerarBoletoRequest(BaseModel):
     aluno_id: str
@@ -1102,8 +1947,7 @@ class GerarBoletoRequest(BaseModel):
 @app.get("/cora/status")
 async def cora_status():
     """Verifica se a integração Cora está configurada"""
-    configured = bool(CORA_CLIENT_ID and CORA_CERT_B64 and CORA_KEY_B64)
-    if not configured:
+    if not cora_configured():
         return {"configured": False, "environment": CORA_ENV}
     try:
         await cora_get_token()
@@ -1111,17 +1955,24 @@ async def cora_status():
     except Exception as e:
         return {"configured": True, "authenticated": False, "error": str(e), "environment": CORA_ENV}
 
-@app.post("/cora/gerar-boleto")
-async def cora_gerar_boleto(req: GerarBoletoRequest):
-    """Gera boleto para um aluno via Cora"""
-    # Busca dados do aluno
-    aluno_result = supabase.table("alunos").select("*").eq("id", req.aluno_id).single().execute()
-    if not aluno_result.data:
-        raise HTTPException(status_code=404, detail="Aluno não encontrado")
-    aluno = aluno_result.data
+# Colunas do aluno usadas para montar a cobrança
+ALUNO_COLUNAS_COBRANCA = "id, nome, email, cpf, rua, numero, bairro, cidade, estado, cep, valor_mensalidade, desconto, dia_vencimento"
 
+def calcular_vencimento(aluno: Dict[str, Any], referencia: Optional[date] = None) -> str:
+    """Próximo vencimento do aluno a partir da data de referência (padrão: hoje)"""
+    dia = aluno.get("dia_vencimento", 10) or 10
+    hoje = referencia or date.today()
+    mes = hoje.month + 1 if hoje.day > dia else hoje.month
+    ano = hoje.year + (1 if mes > 12 else 0)
+    mes = mes if mes <= 12 else 1
+    try:
+        return date(ano, mes, min(dia, 28)).isoformat()
+    except ValueError:
+        return date(ano, mes, 28).isoformat()
+
+def preparar_cobranca(aluno: Dict[str, Any], valor: Optional[int] = None, vencimento: Optional[str] = None, referencia: Optional[date] = None):
+    """Calcula valor/vencimento e monta o payload da invoice Cora. Retorna (invoice_data, valor, vencimento)"""
     # Calcula valor (em centavos)
-    valor = req.valor
     if not valor:
         if not aluno.get("valor_mensalidade"):
             raise HTTPException(status_code=400, detail="Aluno sem valor de mensalidade configurado")
@@ -1131,21 +1982,12 @@ async def cora_gerar_boleto(req: GerarBoletoRequest):
         valor = int(valor_final * 100)  # converte para centavos
 
     # Calcula vencimento
-    vencimento = req.vencimento
     if not vencimento:
-        dia = aluno.get("dia_vencimento", 10) or 10
-        hoje = date.today()
-        mes = hoje.month + 1 if hoje.day > dia else hoje.month
-        ano = hoje.year + (1 if mes > 12 else 0)
-        mes = mes if mes <= 12 else 1
-        try:
-            vencimento = date(ano, mes, min(dia, 28)).isoformat()
-        except ValueError:
-            vencimento = date(ano, mes, 28).isoformat()
+        vencimento = calcular_vencimento(aluno, referencia)
 
     # Monta payload para Cora
     invoice_data = {
-        "code": f"EDLNG-{aluno['id'][:8]}-{vencimento}",
+        "code": f"EDLNG-{aluno['id']}-{vencimento}",
         "customer": {
             "name": aluno.get("nome", ""),
             "email": aluno.get("email", "aluno@edulingua.com"),
@@ -1184,56 +2026,193 @@ async def cora_gerar_boleto(req: GerarBoletoRequest):
             }],
         }
 
-    result = await cora_request("POST", "/v2/invoices/", invoice_data)
+    return invoice_data, valor, vencimento
+
+async def emitir_boleto(aluno: Dict[str, Any], valor: Optional[int] = None, vencimento: Optional[str] = None, referencia: Optional[date] = None) -> Dict[str, Any]:
+    """Emite a invoice na Cora e retorna a linha de 'cobrancas' correspondente (sem salvar)"""
+    invoice_data, valor, vencimento = preparar_cobranca(aluno, valor, vencimento, referencia)
+
+    # A chave de idempotência é o code determinístico (aluno_id completo + vencimento):
+    # retries e lotes repetidos não criam invoices duplicadas na Cora
+    result = await cora_request("POST", "/v2/invoices/", invoice_data, idempotency_key=invoice_data["code"])
 
     if result.get("error"):
         raise HTTPException(status_code=result.get("status", 500), detail=result.get("detail", "Erro ao gerar boleto"))
 
-    # Salva cobrança no Supabase
-    try:
-        boleto_url = result.get("payment_options", {}).get("bank_slip", {}).get("url", "")
-        boleto_barcode = result.get("payment_options", {}).get("bank_slip", {}).get("digitable", "")
-        pix_emv = result.get("pix", {}).get("emv", "")
-
-        supabase.table("cobrancas").insert({
-            "aluno_id": req.aluno_id,
-            "cora_invoice_id": result.get("id", ""),
-            "valor": valor,
-            "vencimento": vencimento,
-            "status": "aberto",
-            "boleto_url": boleto_url,
-            "boleto_barcode": boleto_barcode,
-            "pix_emv": pix_emv,
-        }).execute()
-    except Exception as e:
-        print(f"Erro ao salvar cobrança: {e}")
-
     return {
-        "success": True,
-        "invoice_id": result.get("id"),
-        "boleto_url": boleto_url,
-        "boleto_barcode": boleto_barcode,
-        "pix_emv": pix_emv,
+        "aluno_id": aluno["id"],
+        "cora_invoice_id": result.get("id", ""),
         "valor": valor,
         "vencimento": vencimento,
+        "status": "aberto",
+        "boleto_url": result.get("payment_options", {}).get("bank_slip", {}).get("url", ""),
+        "boleto_barcode": result.get("payment_options", {}).get("bank_slip", {}).get("digitable", ""),
+        "pix_emv": result.get("pix", {}).get("emv", ""),
     }
 
-@app.post("/cora/gerar-mensalidades")
-async def cora_gerar_mensalidades():
-    """Gera boletos em lote para todos alunos ativos"""
-    alunos_result = supabase.table("alunos").select("id, nome, valor_mensalidade, dia_vencimento").eq("status_pedagogico", "ativo").execute()
-    alunos = [a for a in (alunos_result.data or []) if a.get("valor_mensalidade")]
+def salvar_cobrancas(cobrancas: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Insere cobranças no Supabase em lotes de COBRANCAS_INSERT_CHUNK. Se um lote
+    falha, tenta linha a linha para salvar as demais. Retorna as que não foram
+    salvas ({aluno_id, cora_invoice_id, erro}).
+    """
+    falhas = []
+    for i in range(0, len(cobrancas), COBRANCAS_INSERT_CHUNK):
+        chunk = cobrancas[i:i + COBRANCAS_INSERT_CHUNK]
+        try:
+            supabase.table("cobrancas").insert(chunk).execute()
+            continue
+        except Exception as e:
+            print(f"Erro ao salvar lote de cobranças ({len(chunk)}), tentando uma a uma: {e}")
+        for cobranca in chunk:
+            try:
+                supabase.table("cobrancas").insert(cobranca).execute()
+            except Exception as e:
+                if getattr(e, "code", None) == "23505":
+                    continue  # já salva antes (índice único aluno + vencimento)
+                print(f"Erro ao salvar cobrança {cobranca['cora_invoice_id']}: {e}")
+                falhas.append({"aluno_id": cobranca["aluno_id"], "cora_invoice_id": cobranca["cora_invoice_id"], "erro": str(e)})
+    return falhas
+
+@app.post("/cora/gerar-boleto")
+async def cora_gerar_boleto(req: GerarBoletoRequest):
+    """Gera boleto para um aluno via Cora"""
+    # Busca dados do aluno
+    aluno_result = await run_blocking(
+        lambda: supabase.table("alunos").select(ALUNO_COLUNAS_COBRANCA).eq("id", req.aluno_id).limit(1).execute()
+    )
+    if not aluno_result.data:
+        raise HTTPException(status_code=404, detail="Aluno não encontrado")
+    aluno = aluno_result.data[0]
+
+    # Já existe cobrança para esse vencimento? Devolve a existente sem chamar a Cora
+    vencimento = req.vencimento or calcular_vencimento(aluno)
+    existente = await run_blocking(
+        lambda: supabase.table("cobrancas").select("*").eq("aluno_id", aluno["id"]).eq("vencimento", vencimento).neq("status", "cancelado").limit(1).execute()
+    )
+    if existente.data:
+        cobranca = existente.data[0]
+        return {
+            "success": True,
+            "existente": True,
+            "invoice_id": cobranca.get("cora_invoice_id"),
+            "boleto_url": cobranca.get("boleto_url"),
+            "boleto_barcode": cobranca.get("boleto_barcode"),
+            "pix_emv": cobranca.get("pix_emv"),
+            "valor": cobranca.get("valor"),
+            "vencimento": cobranca.get("vencimento"),
+        }
+
+    cobranca = await emitir_boleto(aluno, req.valor, vencimento)
+
+    # Salva cobrança no Supabase. Se falhar, repetir é seguro: a Cora devolve a mesma invoice
+    if await run_blocking(salvar_cobrancas, [cobranca]):
+        raise HTTPException(status_code=500, detail=f"Boleto {cobranca['cora_invoice_id']} emitido, mas não foi salvo. Tente novamente.")
+
+    return {
+        "success": True,
+        "invoice_id": cobranca["cora_invoice_id"],
+        "boleto_url": cobranca["boleto_url"],
+        "boleto_barcode": cobranca["boleto_barcode"],
+        "pix_emv": cobranca["pix_emv"],
+        "valor": cobranca["valor"],
+        "vencimento": cobranca["vencimento"],
+    }
+
+async def gerar_boletos_em_lote(alunos: List[Dict[str, Any]], referencia: Optional[date] = None, progresso: Optional[Dict[str, int]] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Emite boletos para os alunos (já carregados) com concorrência limitada
+    (CORA_BATCH_CONCURRENCY) e salva as cobranças em lotes conforme ficam prontas.
+    O rate limit da Cora é aplicado em cora_request.
+    Se `progresso` for informado, seus contadores "gerados"/"falhas" são atualizados a cada boleto.
+    Boletos emitidos que não puderam ser salvos contam como falha (e são
+    reemitidos, sem duplicar na Cora, numa nova execução).
+    """
+    semaphore = asyncio.Semaphore(CORA_BATCH_CONCURRENCY)
+    nomes = {a["id"]: a["nome"] for a in alunos}
+
+    async def emitir(aluno):
+        async with semaphore:
+            try:
+                return aluno, await emitir_boleto(aluno, referencia=referencia), None
+            except Exception as e:
+                return aluno, None, str(e)
 
     gerados = []
     erros = []
-    for aluno in alunos:
-        try:
-            result = await cora_gerar_boleto(GerarBoletoRequest(aluno_id=aluno["id"]))
-            gerados.append({"aluno_id": aluno["id"], "nome": aluno["nome"], "invoice_id": result.get("invoice_id")})
-        except Exception as e:
-            erros.append({"aluno_id": aluno["id"], "nome": aluno["nome"], "erro": str(e)})
+    pendentes = []
+
+    async def salvar(lote):
+        for falha in await run_blocking(salvar_cobrancas, lote):
+            gerados[:] = [g for g in gerados if g["invoice_id"] != falha["cora_invoice_id"]]
+            erros.append({"aluno_id": falha["aluno_id"], "nome": nomes.get(falha["aluno_id"]), "erro": f"boleto emitido mas não salvo: {falha['erro']}"})
+            if progresso is not None:
+                progresso["gerados"] -= 1
+                progresso["falhas"] += 1
+
+    for future in asyncio.as_completed([emitir(a) for a in alunos]):
+        aluno, cobranca, erro = await future
+        if cobranca:
+            gerados.append({"aluno_id": aluno["id"], "nome": aluno["nome"], "invoice_id": cobranca["cora_invoice_id"]})
+            pendentes.append(cobranca)
+        else:
+            erros.append({"aluno_id": aluno["id"], "nome": aluno["nome"], "erro": erro})
+        if progresso is not None:
+            progresso["gerados" if cobranca else "falhas"] += 1
+
+        if len(pendentes) >= COBRANCAS_INSERT_CHUNK:
+            await salvar(pendentes)
+            pendentes = []
+
+    if pendentes:
+        await salvar(pendentes)
+
+    return {"gerados": gerados, "erros": erros}
+
+# O PostgREST devolve no máximo 1000 linhas por resposta: leituras completas paginam
+LEITURA_PAGINA = 1000
+
+def ler_todas_as_linhas(montar_query) -> List[Dict[str, Any]]:
+    """Lê todas as páginas de montar_query() (que deve trazer uma ordem estável)"""
+    linhas, inicio = [], 0
+    while True:
+        pagina = montar_query().range(inicio, inicio + LEITURA_PAGINA - 1).execute().data or []
+        linhas.extend(pagina)
+        if len(pagina) < LEITURA_PAGINA:
+            return linhas
+        inicio += LEITURA_PAGINA
+
+def carregar_alunos_mensalidade() -> List[Dict[str, Any]]:
+    """Alunos ativos com mensalidade configurada"""
+    return ler_todas_as_linhas(
+        lambda: supabase.table("alunos").select(ALUNO_COLUNAS_COBRANCA).eq("status_pedagogico", "ativo").gt("valor_mensalidade", 0).order("id")
+    )
+
+def filtrar_alunos_ja_cobrados(alunos: List[Dict[str, Any]], referencia: Optional[date] = None) -> List[Dict[str, Any]]:
+    """Remove alunos que já têm cobrança (não cancelada) no vencimento que seria gerado"""
+    vencimentos = {a["id"]: calcular_vencimento(a, referencia) for a in alunos}
+    if not vencimentos:
+        return []
+    existentes = ler_todas_as_linhas(
+        lambda: supabase.table("cobrancas").select("id, aluno_id, vencimento").in_("vencimento", sorted(set(vencimentos.values()))).neq("status", "cancelado").order("id")
+    )
+    ja_cobrados = {(c["aluno_id"], c["vencimento"]) for c in existentes}
+    return [a for a in alunos if (a["id"], vencimentos[a["id"]]) not in ja_cobrados]
 
-    return {"gerados": len(gerados), "erros": len(erros), "detalhes_gerados": gerados, "detalhes_erros": erros}
+@app.post("/cora/gerar-mensalidades", status_code=202)
+async def cora_gerar_mensalidades():
+    """Enfileira a geração de boletos em lote para todos alunos ativos (acompanhe em GET /jobs/{id})"""
+    referencia = date.today().isoformat()
+
+    # Clique duplo / reenvio: reaproveita o job do dia que ainda está na fila ou rodando
+    em_andamento = await run_blocking(
+        lambda: supabase.table("jobs").select("id, status").eq("tipo", "gerar_mensalidades").eq("parametros->>referencia", referencia).in_("status", ["pendente", "executando"]).limit(1).execute()
+    )
+    if em_andamento.data:
+        job = em_andamento.data[0]
+    else:
+        job = await criar_job("gerar_mensalidades", {"referencia": referencia})
+    return {"job_id": job["id"], "status": job["status"]}
 
 @app.get("/cora/boletos")
 async def cora_boletos(aluno_id: str = None, status: str = None):
@@ -1243,37 +2222,280 @@ async def cora_boletos(aluno_id: str = None, status: str = None):
         query = query.eq("aluno_id", aluno_id)
     if status:
         query = query.eq("status", status)
-    result = query.order("created_at", desc=True).limit(100).execute()
+    result = await run_blocking(query.order("created_at", desc=True).limit(100).execute)
     return {"boletos": result.data or []}
 
+# Status que um evento atrasado não pode desfazer (ex.: OPEN chegando depois de PAID)
+COBRANCA_STATUS_FINAIS = {
+    "aberto": ["pago", "cancelado"],
+    "vencido": ["pago", "cancelado"],
+    "cancelado": ["pago", "cancelado"],
+    "pago": ["pago"],
+}
+
+def _aplicar_status_cora(invoice_id: str, status: str) -> int:
+    """
+    Atualiza a cobrança (um update que já devolve aluno_id) e, se paga, o status financeiro do aluno.
+    Retorna quantas cobranças mudaram, ou None se o boleto ainda não existe em cobrancas.
+    """
+    update_data = {"status": status}
+    if status == "pago":
+        update_data["pago_em"] = datetime.now().isoformat()
+    result = supabase.table("cobrancas").update(update_data).eq("cora_invoice_id", invoice_id).not_.in_("status", COBRANCA_STATUS_FINAIS[status]).execute()
+
+    if status == "pago":
+        alunos_pagos = {c["aluno_id"] for c in (result.data or []) if c.get("aluno_id")}
+        for aluno_id in alunos_pagos:
+            supabase.table("alunos").update({"status_financeiro": "em_dia"}).eq("id", aluno_id).execute()
+        if alunos_pagos:
+            # Aluno sai da lista de inadimplentes (e respostas do chat sobre inadimplência expiram)
+            invalidate_alertas_cache()
+            incrementar_versao_dados("alunos")
+    if result.data:
+        return len(result.data)
+    # Nada mudou: boleto já em status final (evento atrasado) ou ainda não gravado
+    existe = supabase.table("cobrancas").select("id").eq("cora_invoice_id", invoice_id).limit(1).execute()
+    return 0 if existe.data else None
+
 @app.post("/cora/webhook")
-async def cora_webhook(data: dict = {}):
-    """Webhook do Cora — atualiza status de cobranças"""
+async def cora_webhook(request: Request, data: dict = {}):
+    """Webhook do Cora — atualiza status de cobranças (deduplicado por evento, em ordem por boleto)"""
     print(f"Webhook Cora: {json.dumps(data, ensure_ascii=False, default=str)[:500]}")
+    # Cora envia eventos de mudança de status
+    dados = data.get("data") if isinstance(data.get("data"), dict) else {}
+    invoice_id = data.get("id", data.get("invoice_id", dados.get("id", "")))
+    new_status = data.get("status", data.get("state", dados.get("status", "")))
+
+    status_map = {"PAID": "pago", "CANCELLED": "cancelado", "OVERDUE": "vencido", "OPEN": "aberto"}
+    mapped = status_map.get(new_status.upper() if isinstance(new_status, str) else "", None)
+    if not (invoice_id and mapped):
+        return {"status": "ok"}
+
+    # Sem id do evento, a própria transição (boleto + status) na janela atual é a chave de
+    # idempotência: redeliveries próximas são descartadas, e a mesma transição dias depois
+    # (ex.: boleto reaberto) não fica bloqueada para sempre em webhook_eventos
+    event_id = request.headers.get("webhook-event-id")
+    if not event_id:
+        janela = int(time.time() // CORA_DEDUP_JANELA_SECONDS)
+        event_id = f"{invoice_id}:{mapped}:{janela}"
+    # O evento só é registrado (LRU e webhook_eventos) depois de aplicado: uma cópia que chega
+    # enquanto a primeira ainda está em andamento espera o lock do boleto e decide depois dela
+    if dedup_webhooks.contem("cora", event_id):
+        return {"status": "ok", "duplicado": True}
+
+    async with em_ordem(f"cora:{invoice_id}"):
+        if dedup_webhooks.contem("cora", event_id):
+            return {"status": "ok", "duplicado": True}
+        try:
+            if await run_blocking(evento_registrado, "cora", event_id):
+                dedup_webhooks.registrar("cora", event_id)
+                return {"status": "ok", "duplicado": True}
+            alteradas = await run_blocking(_aplicar_status_cora, invoice_id, mapped)
+        except Exception as e:
+            # Não-2xx: a Cora só reenvia o evento se a entrega falhar
+            print(f"Erro webhook Cora: {e}")
+            raise HTTPException(status_code=503, detail="Falha ao aplicar o evento, reenvie")
+        if alteradas is None:
+            # Webhook antes da cobrança ser gravada (ex.: lote ainda salvando): pede reenvio
+            raise HTTPException(status_code=503, detail=f"Cobrança {invoice_id} ainda não registrada, reenvie")
+
+        try:
+            await run_blocking(registrar_evento, "cora", event_id)
+        except Exception as e:
+            # Já aplicado: sem o registro, uma redelivery só reaplica um update idempotente
+            print(f"Erro ao registrar evento Cora {event_id}: {e}")
+        dedup_webhooks.registrar("cora", event_id)
+
+    return {"status": "ok"}
+
+# ============================================
+# JOBS EM BACKGROUND (lotes longos)
+# ============================================
+
+# Estado persistido na tabela "jobs"; workers asyncio no próprio processo.
+# Jobs interrompidos (restart) são retomados na subida, sem duplicar boletos.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+JOB_PROGRESS_INTERVAL_SECONDS = float(os.getenv("JOB_PROGRESS_INTERVAL_SECONDS", "5"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ERROS_SALVOS = 100
+
+_job_queue: Optional[asyncio.Queue] = None
+_job_workers: List[asyncio.Task] = []
+_jobs_em_execucao: Dict[str, Dict[str, Any]] = {}  # job_id -> progresso em memória
+
+async def criar_job(tipo: str, parametros: Dict[str, Any]) -> Dict[str, Any]:
+    """Cria o job na tabela e coloca na fila"""
+    result = await run_blocking(
+        lambda: supabase.table("jobs").insert({"tipo": tipo, "status": "pendente", "parametros": parametros}).execute()
+    )
+    job = result.data[0]
+    await _job_queue.put(job["id"])
+    return job
+
+def _reivindicar_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Marca o job como 'executando' se ele estiver pendente ou parado (sem
+    atualização há JOB_LEASE_SECONDS). Evita que dois processos rodem o mesmo job.
+    """
+    limite = (datetime.utcnow() - timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()
+    result = supabase.table("jobs").update({"status": "executando"}).eq("id", job_id).or_(
+        f"status.eq.pendente,and(status.eq.executando,updated_at.lt.{limite})"
+    ).execute()
+    return result.data[0] if result.data else None
+
+def _salvar_progresso_job(job_id: str, campos: Dict[str, Any]):
+    supabase.table("jobs").update(campos).eq("id", job_id).execute()
+
+async def _executar_job_mensalidades(job: Dict[str, Any], progresso: Dict[str, Any]):
+    """Gera as mensalidades do job, pulando alunos que já têm boleto no vencimento (retomada)"""
+    referencia = date.fromisoformat(job["parametros"]["referencia"])
+    alunos = await run_blocking(carregar_alunos_mensalidade)
+    pendentes = await run_blocking(filtrar_alunos_ja_cobrados, alunos, referencia)
+
+    progresso["total"] = len(alunos)
+    progresso["gerados"] = len(alunos) - len(pendentes)
+    progresso["falhas"] = 0
+    await run_blocking(_salvar_progresso_job, job["id"], {"total": progresso["total"], "gerados": progresso["gerados"], "falhas": 0})
+
+    resultado = await gerar_boletos_em_lote(pendentes, referencia=referencia, progresso=progresso)
+    progresso["erros"] = resultado["erros"][:JOB_MAX_ERROS_SALVOS]
+
+JOB_HANDLERS = {
+    "gerar_mensalidades": _executar_job_mensalidades,
+}
+
+async def _executar_job(job_id: str):
+    job = await run_blocking(_reivindicar_job, job_id)
+    if not job:
+        # Concluído, ou ainda com lease ativo (outro processo / restart recente): verifica de novo depois
+        atual = await run_blocking(lambda: supabase.table("jobs").select("status").eq("id", job_id).execute())
+        if atual.data and atual.data[0]["status"] in ("pendente", "executando"):
+            asyncio.get_running_loop().call_later(JOB_LEASE_SECONDS, _job_queue.put_nowait, job_id)
+        return
+
+    progresso = {"total": job.get("total") or 0, "gerados": job.get("gerados") or 0, "falhas": job.get("falhas") or 0, "erros": []}
+    _jobs_em_execucao[job_id] = progresso
+
+    async def heartbeat():
+        # Persiste o progresso periodicamente (também renova o lease via updated_at)
+        while True:
+            await asyncio.sleep(JOB_PROGRESS_INTERVAL_SECONDS)
+            await run_blocking(_salvar_progresso_job, job_id, {"gerados": progresso["gerados"], "falhas": progresso["falhas"]})
+
+    heartbeat_task = asyncio.create_task(heartbeat())
     try:
-        # Cora envia eventos de mudança de status
-        invoice_id = data.get("id", data.get("invoice_id", data.get("data", {}).get("id", "")))
-        new_status = data.get("status", data.get("state", data.get("data", {}).get("status", "")))
-
-        if invoice_id:
-            status_map = {"PAID": "pago", "CANCELLED": "cancelado", "OVERDUE": "vencido", "OPEN": "aberto"}
-            mapped = status_map.get(new_status.upper() if new_status else "", None)
-
-            if mapped:
-                # Atualiza cobrança
-                update_data = {"status": mapped}
-                if mapped == "pago":
-                    update_data["pago_em"] = datetime.now().isoformat()
-                supabase.table("cobrancas").update(update_data).eq("cora_invoice_id", invoice_id).execute()
-
-                # Se pago, atualiza status financeiro do aluno
-                if mapped == "pago":
-                    cobranca = supabase.table("cobrancas").select("aluno_id").eq("cora_invoice_id", invoice_id).execute()
-                    if cobranca.data:
-                        supabase.table("alunos").update({"status_financeiro": "em_dia"}).eq("id", cobranca.data[0]["aluno_id"]).execute()
+        await JOB_HANDLERS[job["tipo"]](job, progresso)
+        final = {"status": "concluido", "erros": progresso["erros"]}
+    except asyncio.CancelledError:
+        raise  # shutdown: o job fica 'executando' e é retomado na próxima subida
+    except Exception as e:
+        print(f"Erro no job {job_id}: {e}")
+        final = {"status": "erro", "erros": progresso["erros"] + [{"erro": str(e)}]}
+    finally:
+        heartbeat_task.cancel()
+        _jobs_em_execucao.pop(job_id, None)
+
+    final.update({"gerados": progresso["gerados"], "falhas": progresso["falhas"], "concluido_em": datetime.now().isoformat()})
+    await run_blocking(_salvar_progresso_job, job_id, final)
+
+async def _job_worker():
+    while True:
+        job_id = await _job_queue.get()
+        try:
+            await _executar_job(job_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Erro no worker de jobs ({job_id}): {e}")
+        finally:
+            _job_queue.task_done()
+
+async def iniciar_workers_jobs():
+    """Sobe os workers e reenfileira jobs pendentes/interrompidos"""
+    global _job_queue
+    _job_queue = asyncio.Queue()
+    for _ in range(JOB_WORKERS):
+        _job_workers.append(asyncio.create_task(_job_worker()))
+    try:
+        result = await run_blocking(
+            lambda: supabase.table("jobs").select("id").in_("status", ["pendente", "executando"]).order("created_at").execute()
+        )
+        for job in (result.data or []):
+            await _job_queue.put(job["id"])
     except Exception as e:
-        print(f"Erro webhook Cora: {e}")
+        print(f"Erro ao retomar jobs: {e}")
+
+async def parar_workers_jobs():
+    for task in _job_workers:
+        task.cancel()
+    await asyncio.gather(*_job_workers, return_exceptions=True)
+    _job_workers.clear()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Progresso de um job: gerados, falhas e restantes"""
+    result = await run_blocking(lambda: supabase.table("jobs").select("*").eq("id", job_id).execute())
+    if not result.data:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    job = result.data[0]
+
+    # Se o job roda neste processo, o progresso em memória é mais recente
+    progresso = _jobs_em_execucao.get(job_id)
+    if progresso:
+        job.update({"total": progresso["total"], "gerados": progresso["gerados"], "falhas": progresso["falhas"]})
+
+    total = job.get("total") or 0
+    gerados = job.get("gerados") or 0
+    falhas = job.get("falhas") or 0
+    return {
+        "id": job["id"],
+        "tipo": job["tipo"],
+        "status": job["status"],
+        "total": total,
+        "gerados": gerados,
+        "falhas": falhas,
+        "restantes": max(total - gerados - falhas, 0),
+        "erros": job.get("erros") or [],
+        "created_at": job.get("created_at"),
+        "concluido_em": job.get("concluido_em"),
+    }
+
+class CacheInvalidateRequest(BaseModel):
+    tables: List[str] = []
+    usuario_id: Optional[str] = None
+
+# Tabelas que professores/supervisores alteram pelo diário de classe
+TABELAS_DIARIO = {"aulas", "presencas"}
 
+def _autorizar_invalidacao(request: Request, req: CacheInvalidateRequest):
+    """
+    Aceita a service key (Authorization: Bearer ...) ou um usuário ativo informado
+    em X-Usuario-Id: admin invalida qualquer tabela; os demais só as do diário.
+    """
+    service_key = os.getenv("SUPABASE_SERVICE_KEY") or ""
+    auth = request.headers.get("authorization", "")
+    if service_key and hmac.compare_digest(auth.encode(), f"Bearer {service_key}".encode()):
+        return
+
+    usuario_id = request.headers.get("x-usuario-id")
+    if not usuario_id:
+        raise HTTPException(status_code=401, detail="Credenciais ausentes")
+    result = supabase.table("usuarios").select("perfil, ativo").eq("id", usuario_id).execute()
+    usuario = (result.data or [None])[0]
+    if not usuario or not usuario.get("ativo"):
+        raise HTTPException(status_code=403, detail="Usuário não autorizado")
+    if usuario.get("perfil") == "admin":
+        return
+    if req.usuario_id or not set(req.tables) <= TABELAS_DIARIO:
+        raise HTTPException(status_code=403, detail="Usuário não autorizado")
+
+@app.post("/cache/invalidate")
+async def cache_invalidate(request: Request, req: CacheInvalidateRequest):
+    """Invalida caches do backend após alterações feitas direto no Supabase pelo frontend"""
+    await run_blocking(_autorizar_invalidacao, request, req)
+    if req.usuario_id:
+        invalidate_user_scope(req.usuario_id)
+    notify_data_change(req.tables)
     return {"status": "ok"}
 
 @app.get("/health")
@@ -1281,6 +2503,11 @@ async def health():
     """Health check"""
     return {"status": "ok", "timestamp": datetime.now().isoformat()}
 
+@app.get("/health/dependencias")
+async def health_dependencias():
+    """Estado dos circuit breakers e contadores de chamadas/retries por serviço externo"""
+    return {d.nome: d.status() for d in DEPENDENCIAS}
+
 # ============================================
 # WHATSAPP VIA UAZAPI (v2 - uazapiGO)
 # ============================================
@@ -1288,38 +2515,51 @@ async def health():
 UAZAPI_URL = os.getenv("UAZAPI_URL", "").rstrip("/")
 UAZAPI_TOKEN = os.getenv("UAZAPI_TOKEN", "")
 
-async def uazapi_request(method: str, path: str, data: dict = None) -> dict:
-    """Helper para fazer requests à UAZAPI"""
+def get_uazapi_client() -> httpx.AsyncClient:
+    """Cliente compartilhado da UAZAPI (criado uma vez, com pool de conexões)"""
     if not UAZAPI_URL or not UAZAPI_TOKEN:
         raise HTTPException(status_code=503, detail="UAZAPI não configurada. Defina UAZAPI_URL e UAZAPI_TOKEN no .env")
+    if "uazapi" not in _http_clients:
+        _http_clients["uazapi"] = httpx.AsyncClient(
+            base_url=UAZAPI_URL,
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "application/json",
+                "token": UAZAPI_TOKEN,
+            },
+            http2=HTTP2_ENABLED,
+            limits=http_pool_limits(),
+            timeout=30.0,
+        )
+    return _http_clients["uazapi"]
 
-    url = f"{UAZAPI_URL}{path}"
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "token": UAZAPI_TOKEN,
-    }
+async def uazapi_request(method: str, path: str, data: dict = None) -> dict:
+    """Helper para fazer requests à UAZAPI"""
+    if method not in ("GET", "POST"):
+        raise ValueError(f"Método {method} não suportado")
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            if method == "GET":
-                resp = await client.get(url, headers=headers)
-            elif method == "POST":
-                resp = await client.post(url, headers=headers, json=data or {})
-            else:
-                raise ValueError(f"Método {method} não suportado")
+    client = get_uazapi_client()
 
-            if resp.status_code >= 400:
-                return {"error": True, "status": resp.status_code, "detail": resp.text}
+    async def enviar(timeout: float) -> httpx.Response:
+        if method == "GET":
+            return await client.get(path, timeout=timeout)
+        return await client.post(path, json=data or {}, timeout=timeout)
 
-            try:
-                return resp.json()
-            except Exception:
-                return {"raw": resp.text}
-        except httpx.ConnectError:
-            raise HTTPException(status_code=503, detail="Não foi possível conectar à UAZAPI. Verifique a URL.")
-        except httpx.TimeoutException:
-            raise HTTPException(status_code=504, detail="Timeout ao conectar à UAZAPI.")
+    try:
+        # Envios (POST) não são idempotentes: só repetem se a conexão nem chegou a abrir
+        resp = await uazapi_dependencia.executar(enviar, path=path, idempotente=method == "GET")
+
+        if resp.status_code >= 400:
+            return {"error": True, "status": resp.status_code, "detail": resp.text}
+
+        try:
+            return resp.json()
+        except Exception:
+            return {"raw": resp.text}
+    except httpx.ConnectError:
+        raise HTTPException(status_code=503, detail="Não foi possível conectar à UAZAPI. Verifique a URL.")
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="Timeout ao conectar à UAZAPI.")
 
 class SendMessageRequest(BaseModel):
     phone: str
@@ -1355,6 +2595,160 @@ async def whatsapp_qrcode():
     result = await uazapi_request("GET", "/api/qrcode")
     return result
 
+def normalizar_telefone(valor: Any) -> str:
+    """Só os dígitos do telefone/JID (ex.: '5511987654321@s.whatsapp.net' → '5511987654321')"""
+    return ''.join(c for c in str(valor or "").split("@")[0] if c.isdigit())
+
+# Abaixo disso o número é ambíguo demais para vincular (ramal, número incompleto)
+TELEFONE_MIN_DIGITOS = 8
+
+def sufixo_telefone(valor: Any) -> str:
+    """Chave de vínculo: últimos 10 dígitos (ignora código do país); igual à coluna alunos.telefone_sufixo"""
+    return normalizar_telefone(valor)[-10:]
+
+def buscar_aluno_por_telefone(telefone: Any) -> Optional[dict]:
+    """
+    Aluno pelo telefone via índices em alunos.telefone_sufixo/telefone_digits (sem varrer a tabela).
+    Mesma regra do vínculo antigo por endswith: DDD + número iguais, telefone cadastrado sem DDD
+    (8-9 dígitos) no final do recebido, ou recebido sem DDD no final do cadastrado.
+    """
+    digitos = normalizar_telefone(telefone)
+    if len(digitos) < TELEFONE_MIN_DIGITOS:
+        return None
+    query = supabase.table("alunos").select(DIRETORIO_COLUNAS)
+    if len(digitos) >= 10:
+        curtos = ",".join(digitos[-n:] for n in range(TELEFONE_MIN_DIGITOS, 10))
+        query = query.or_(f"telefone_sufixo.eq.{digitos[-10:]},telefone_digits.in.({curtos})")
+    else:
+        # '*' é o curinga do PostgREST na URL ('%98...' seria decodificado como um byte)
+        query = query.like("telefone_digits", f"*{digitos}")
+    result = query.limit(1).execute()
+    return result.data[0] if result.data else None
+
+# Diretório de telefones: carregado uma vez e atualizado incrementalmente por updated_at
+DIRETORIO_COLUNAS = "id, nome, telefone, email, status_pedagogico"
+DIRETORIO_REFRESH_SECONDS = float(os.getenv("DIRETORIO_REFRESH_SECONDS", "30"))
+DIRETORIO_FULL_RELOAD_SECONDS = float(os.getenv("DIRETORIO_FULL_RELOAD_SECONDS", "3600"))
+DIRETORIO_MAX_ALUNOS = int(os.getenv("DIRETORIO_MAX_ALUNOS", "100000"))
+DIRETORIO_PAGINA = 1000  # limite padrão de linhas por request do PostgREST
+
+class DiretorioTelefones:
+    """
+    Índice em memória aluno ↔ telefone, compartilhado pelo processo:
+    - carga completa na primeira consulta, a cada DIRETORIO_FULL_RELOAD_SECONDS e após notify_data_change("alunos")
+    - entre cargas, só busca alunos com updated_at >= último visto (a cada DIRETORIO_REFRESH_SECONDS)
+    - guarda só DIRETORIO_COLUNAS e no máximo DIRETORIO_MAX_ALUNOS; acima disso `completo` fica False
+      e quem consulta deve cair no lookup indexado (buscar_aluno_por_telefone)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._por_id: Dict[str, dict] = {}
+        # Sufixo → {aluno_id: aluno}: irmãos/responsável em comum dividem o mesmo telefone
+        self._por_sufixo: Dict[str, Dict[str, dict]] = {}
+        self._ultimo_updated_at: Optional[str] = None
+        self._atualizado_em = 0.0
+        self._carga_completa_em = 0.0
+        self.completo = False
+
+    def _indexar(self, aluno: dict, por_id: Dict[str, dict], por_sufixo: Dict[str, Dict[str, dict]]) -> bool:
+        """Indexa um aluno; retorna False se o limite de memória foi atingido"""
+        anterior = por_id.get(aluno["id"])
+        if anterior:
+            sufixo_antigo = sufixo_telefone(anterior.get("telefone"))
+            # Tira só este aluno do grupo antigo; os demais com o mesmo telefone continuam.
+            # Grupos são trocados, nunca alterados: leitores sem lock não veem o dict mudando
+            grupo = {k: v for k, v in por_sufixo.get(sufixo_antigo, {}).items() if k != aluno["id"]}
+            if grupo:
+                por_sufixo[sufixo_antigo] = grupo
+            else:
+                por_sufixo.pop(sufixo_antigo, None)
+        elif len(por_id) >= DIRETORIO_MAX_ALUNOS:
+            return False
+        entrada = {k: aluno.get(k) for k in ("id", "nome", "telefone", "email", "status_pedagogico")}
+        por_id[aluno["id"]] = entrada
+        sufixo = sufixo_telefone(entrada.get("telefone"))
+        if len(sufixo) >= TELEFONE_MIN_DIGITOS:
+            por_sufixo[sufixo] = {**por_sufixo.get(sufixo, {}), aluno["id"]: entrada}
+        updated_at = aluno.get("updated_at")
+        if updated_at and (self._ultimo_updated_at is None or updated_at > self._ultimo_updated_at):
+            self._ultimo_updated_at = updated_at
+        return True
+
+    def _carregar(self, desde: Optional[str]) -> List[dict]:
+        linhas, inicio = [], 0
+        while True:
+            query = supabase.table("alunos").select(f"{DIRETORIO_COLUNAS}, updated_at")
+            if desde:
+                # gte (não gt): reaplicar a última linha é inofensivo e não perde updates no mesmo instante
+                query = query.gte("updated_at", desde)
+            pagina = query.order("updated_at").order("id").range(inicio, inicio + DIRETORIO_PAGINA - 1).execute().data or []
+            linhas.extend(pagina)
+            if len(pagina) < DIRETORIO_PAGINA:
+                return linhas
+            inicio += DIRETORIO_PAGINA
+
+    def atualizar(self, forcar: bool = False):
+        """Garante o diretório atualizado (bloqueante: chame via run_blocking)"""
+        agora = time.monotonic()
+        if not forcar and agora - self._atualizado_em < DIRETORIO_REFRESH_SECONDS:
+            return
+        with self._lock:
+            if not forcar and agora - self._atualizado_em < DIRETORIO_REFRESH_SECONDS:
+                return
+            if self._ultimo_updated_at is None or agora - self._carga_completa_em > DIRETORIO_FULL_RELOAD_SECONDS:
+                # Monta em dicionários novos e troca de uma vez: leitores nunca veem carga parcial
+                por_id, por_sufixo, completo = {}, {}, True
+                self._ultimo_updated_at = None
+                for aluno in self._carregar(None):
+                    completo = self._indexar(aluno, por_id, por_sufixo) and completo
+                self._por_id, self._por_sufixo, self.completo = por_id, por_sufixo, completo
+                self._carga_completa_em = agora
+            else:
+                for aluno in self._carregar(self._ultimo_updated_at):
+                    if not self._indexar(aluno, self._por_id, self._por_sufixo):
+                        self.completo = False
+            self._atualizado_em = time.monotonic()
+
+    def invalidar(self):
+        """Força carga completa na próxima consulta (ex.: aluno excluído, que updated_at não captura)"""
+        with self._lock:
+            self._ultimo_updated_at = None
+            self._atualizado_em = 0.0
+
+    def por_telefone(self, telefone: Any) -> Optional[dict]:
+        """DDD + número, ou cadastro sem DDD (chaveado pelos próprios 8-9 dígitos) no final do recebido"""
+        digitos = normalizar_telefone(telefone)
+        if len(digitos) < 10:
+            return None
+        for n in range(10, TELEFONE_MIN_DIGITOS - 1, -1):
+            grupo = self._por_sufixo.get(digitos[-n:])
+            if grupo:
+                return next(iter(grupo.values()))
+        return None
+
+    def cobre(self, telefone: Any) -> bool:
+        """O diretório responde sozinho? Recebido sem DDD exige busca por sufixo, feita no banco"""
+        return self.completo and len(normalizar_telefone(telefone)) >= 10
+
+    def por_id(self, aluno_id: str) -> Optional[dict]:
+        return self._por_id.get(aluno_id)
+
+diretorio_telefones = DiretorioTelefones()
+
+@on_data_change("alunos")
+def _invalidar_diretorio_telefones():
+    diretorio_telefones.invalidar()
+
+async def aluno_por_telefone(telefone: Any) -> Optional[dict]:
+    """Aluno pelo telefone: diretório em memória, com fallback indexado se o diretório estiver truncado
+    ou o número vier sem DDD"""
+    await run_blocking(diretorio_telefones.atualizar)
+    aluno = diretorio_telefones.por_telefone(telefone)
+    if aluno is None and not diretorio_telefones.cobre(telefone):
+        aluno = await run_blocking(buscar_aluno_por_telefone, telefone)
+    return aluno
+
 @app.get("/whatsapp/chats")
 async def whatsapp_chats():
     """Lista conversas do WhatsApp, enriquecidas com dados de alunos"""
@@ -1362,28 +2756,17 @@ async def whatsapp_chats():
 
     chats = result if isinstance(result, list) else result.get("chats", result.get("data", []))
 
-    # Busca todos os alunos para cruzar por telefone
-    alunos_result = supabase.table("alunos").select("id, nome, telefone, email, status_pedagogico").execute()
-    alunos_by_phone = {}
-    for aluno in (alunos_result.data or []):
-        if aluno.get("telefone"):
-            # Normaliza telefone: remove tudo que não é dígito
-            phone_clean = ''.join(c for c in aluno["telefone"] if c.isdigit())
-            alunos_by_phone[phone_clean] = aluno
-            # Também mapeia sem código do país (últimos 10-11 dígitos)
-            if len(phone_clean) > 10:
-                alunos_by_phone[phone_clean[-11:]] = aluno
-                alunos_by_phone[phone_clean[-10:]] = aluno
+    # Cruza por telefone com o diretório em memória (sem recarregar a tabela de alunos)
+    await run_blocking(diretorio_telefones.atualizar)
 
     # Enriquece chats com dados de alunos
     enriched = []
     for chat in (chats if isinstance(chats, list) else []):
         chat_phone = chat.get("id", chat.get("jid", chat.get("phone", "")))
-        phone_clean = ''.join(c for c in str(chat_phone) if c.isdigit())
-
-        aluno = alunos_by_phone.get(phone_clean)
-        if not aluno and len(phone_clean) > 10:
-            aluno = alunos_by_phone.get(phone_clean[-11:]) or alunos_by_phone.get(phone_clean[-10:])
+        phone_clean = normalizar_telefone(chat_phone)
+        aluno = diretorio_telefones.por_telefone(phone_clean)
+        if aluno is None and not diretorio_telefones.cobre(phone_clean):
+            aluno = await aluno_por_telefone(phone_clean)
 
         enriched.append({
             "phone": phone_clean,
@@ -1509,42 +2892,390 @@ async def whatsapp_presence(phone: str):
         last_seen = result.get("lastSeen", result.get("last_seen", None))
     return {"online": online, "lastSeen": last_seen}
 
+# ============================================
+# INGESTÃO DE WEBHOOKS (deduplicação, ordem, fila + inserts em lote)
+# ============================================
+
+WEBHOOK_DEDUP_LRU_SIZE = int(os.getenv("WEBHOOK_DEDUP_LRU_SIZE", "50000"))
+# Validade da chave boleto:status usada quando a Cora não manda webhook-event-id
+CORA_DEDUP_JANELA_SECONDS = int(os.getenv("CORA_DEDUP_JANELA_SECONDS", "86400"))
+
+class DedupEventos:
+    """
+    Ids de eventos já vistos, em LRU limitado: redeliveries recentes são rejeitadas em O(1),
+    sem tocar no banco. A garantia entre processos/restarts fica no banco (webhook_eventos
+    para a Cora, índice único em whatsapp_mensagens.message_id para a UAZAPI).
+    """
+
+    def __init__(self, tamanho: int):
+        self.tamanho = tamanho
+        self._vistos: "OrderedDict[tuple, None]" = OrderedDict()
+        self.duplicados = 0
+
+    def contem(self, origem: str, event_id: str) -> bool:
+        """True (e conta como duplicado) se o evento já foi registrado"""
+        chave = (origem, event_id)
+        if chave in self._vistos:
+            self._vistos.move_to_end(chave)
+            self.duplicados += 1
+            return True
+        return False
+
+    def registrar(self, origem: str, event_id: str):
+        self._vistos[(origem, event_id)] = None
+        if len(self._vistos) > self.tamanho:
+            self._vistos.popitem(last=False)
+
+    def visto(self, origem: str, event_id: str) -> bool:
+        """True se o evento já passou por aqui; senão registra e devolve False"""
+        if self.contem(origem, event_id):
+            return True
+        self.registrar(origem, event_id)
+        return False
+
+    def esquecer(self, origem: str, event_id: str):
+        self._vistos.pop((origem, event_id), None)
+
+dedup_webhooks = DedupEventos(WEBHOOK_DEDUP_LRU_SIZE)
+
+def evento_registrado(origem: str, event_id: str) -> bool:
+    """O evento já foi aplicado (por este ou outro processo)?"""
+    result = supabase.table("webhook_eventos").select("event_id").eq("origem", origem).eq("event_id", event_id).limit(1).execute()
+    return bool(result.data)
+
+def registrar_evento(origem: str, event_id: str):
+    """Marca o evento como aplicado em webhook_eventos (idempotente)"""
+    supabase.table("webhook_eventos").upsert(
+        {"origem": origem, "event_id": event_id}, on_conflict="origem,event_id", ignore_duplicates=True
+    ).execute()
+
+_locks_ordem: Dict[str, list] = {}
+
+@asynccontextmanager
+async def em_ordem(chave: str):
+    """Serializa o processamento por chave (boleto, telefone); o lock some quando ninguém mais espera"""
+    entrada = _locks_ordem.setdefault(chave, [asyncio.Lock(), 0])
+    entrada[1] += 1
+    try:
+        async with entrada[0]:
+            yield
+    finally:
+        entrada[1] -= 1
+        if entrada[1] == 0:
+            _locks_ordem.pop(chave, None)
+
+# O webhook só enfileira e responde; um flusher em background grava em lote
+# (por tamanho ou tempo). Fila cheia ou Supabase fora → lotes vão para disco
+# (JSONL) e são reenviados quando o banco voltar.
+WEBHOOK_QUEUE_MAX = int(os.getenv("WEBHOOK_QUEUE_MAX", "10000"))
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "200"))
+WEBHOOK_FLUSH_INTERVAL_SECONDS = float(os.getenv("WEBHOOK_FLUSH_INTERVAL_SECONDS", "1"))
+WEBHOOK_SPILL_DIR = os.getenv("WEBHOOK_SPILL_DIR", os.path.join(tempfile.gettempdir(), "webhook_spill"))
+WEBHOOK_SPILL_RETRY_SECONDS = 30
+WEBHOOK_SPILL_MAX_TENTATIVAS = int(os.getenv("WEBHOOK_SPILL_MAX_TENTATIVAS", "5"))
+
+WEBHOOK_SHUTDOWN_DRAIN_SECONDS = 10
+
+_webhook_fila: Optional[asyncio.Queue] = None
+_webhook_tasks: List[asyncio.Task] = []
+_webhook_stats = {"recebidas": 0, "gravadas": 0, "lotes": 0, "em_disco": 0, "reenviadas": 0, "quarentena": 0}
+
+def _gravar_jsonl(caminho: str, mensagens: List[dict]):
+    """Escreve o arquivo inteiro de uma vez (tmp + rename): quem lista o diretório nunca vê metade"""
+    with open(caminho + ".tmp", "w") as f:
+        for msg in mensagens:
+            f.write(json.dumps(msg, ensure_ascii=False) + "\n")
+    os.replace(caminho + ".tmp", caminho)
+
+def _spill_para_disco(mensagens: List[dict]):
+    """Grava mensagens não persistidas em um arquivo JSONL próprio (nome único por processo/lote)"""
+    os.makedirs(WEBHOOK_SPILL_DIR, exist_ok=True)
+    caminho = os.path.join(WEBHOOK_SPILL_DIR, f"{int(time.time() * 1000)}-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl")
+    _gravar_jsonl(caminho, mensagens)
+    _webhook_stats["em_disco"] += len(mensagens)
+
+def _inserir_mensagens(mensagens: List[dict]):
+    """Vincula ao aluno pelo diretório de telefones e insere o lote em um único request"""
+    try:
+        diretorio_telefones.atualizar()
+    except Exception as e:
+        print(f"Erro ao atualizar diretório de telefones: {e}")
+    rows = []
+    for msg in mensagens:
+        aluno = diretorio_telefones.por_telefone(msg["phone"])
+        if aluno is None and not diretorio_telefones.cobre(msg["phone"]):
+            aluno = buscar_aluno_por_telefone(msg["phone"])
+        rows.append({**msg, "aluno_id": aluno["id"] if aluno else None})
+    # Duplicatas que escaparam do LRU (outro worker, reenvio do disco) são ignoradas pelo índice único
+    supabase.table("whatsapp_mensagens").upsert(rows, on_conflict="message_id", ignore_duplicates=True).execute()
+
+async def _gravar_lote(mensagens: List[dict]):
+    try:
+        await run_blocking(_inserir_mensagens, mensagens)
+        _webhook_stats["gravadas"] += len(mensagens)
+        _webhook_stats["lotes"] += 1
+    except Exception as e:
+        print(f"Erro ao gravar lote de webhooks ({len(mensagens)}), salvando em disco: {e}")
+        await run_blocking(_spill_para_disco, mensagens)
+
+def _banco_disponivel() -> bool:
+    try:
+        supabase.table("whatsapp_mensagens").select("id").limit(1).execute()
+        return True
+    except Exception:
+        return False
+
+def _reenviar_mensagens(mensagens: List[dict]) -> Tuple[int, List[dict]]:
+    """
+    Insere em lotes; um lote recusado com o banco no ar é refeito linha a linha e só as linhas
+    recusadas voltam (com _tentativas + 1). Com o banco fora, propaga a exceção.
+    Retorna (inseridas, recusadas).
+    """
+    inseridas, recusadas = 0, []
+    for i in range(0, len(mensagens), WEBHOOK_BATCH_SIZE):
+        lote = mensagens[i:i + WEBHOOK_BATCH_SIZE]
+        try:
+            _inserir_mensagens([{k: v for k, v in m.items() if not k.startswith("_")} for m in lote])
+            inseridas += len(lote)
+            continue
+        except Exception:
+            if not _banco_disponivel():
+                raise
+        for msg in lote:
+            try:
+                _inserir_mensagens([{k: v for k, v in msg.items() if not k.startswith("_")}])
+                inseridas += 1
+            except Exception as e:
+                recusadas.append({**msg, "_tentativas": msg.get("_tentativas", 0) + 1, "_erro": str(e)[:500]})
+    return inseridas, recusadas
+
+def _reenviar_spill() -> int:
+    """
+    Reenvia arquivos do disco; cada arquivo é reivindicado por rename (seguro com vários workers).
+    Linhas recusadas pelo banco (ex.: FK inválida) não travam os arquivos seguintes: voltam ao
+    disco e, após WEBHOOK_SPILL_MAX_TENTATIVAS, vão para a subpasta quarentena/.
+    """
+    if not os.path.isdir(WEBHOOK_SPILL_DIR):
+        return 0
+    quarentena = os.path.join(WEBHOOK_SPILL_DIR, "quarentena")
+    reenviadas = 0
+    for nome in sorted(os.listdir(WEBHOOK_SPILL_DIR)):
+        if not nome.endswith(".jsonl"):
+            continue
+        origem = os.path.join(WEBHOOK_SPILL_DIR, nome)
+        reivindicado = f"{origem}.{os.getpid()}.reenviando"
+        try:
+            os.rename(origem, reivindicado)
+        except OSError:
+            continue
+        try:
+            with open(reivindicado) as f:
+                mensagens = [json.loads(linha) for linha in f if linha.strip()]
+        except (OSError, ValueError) as e:
+            print(f"Arquivo de webhooks ilegível ({nome}), movido para quarentena: {e}")
+            os.makedirs(quarentena, exist_ok=True)
+            os.replace(reivindicado, os.path.join(quarentena, nome))
+            continue
+        try:
+            inseridas, recusadas = _reenviar_mensagens(mensagens)
+        except Exception as e:
+            # Banco fora: devolve o arquivo inteiro (o que já entrou é ignorado no próximo reenvio)
+            os.rename(reivindicado, origem)
+            print(f"Erro ao reenviar webhooks em disco ({nome}): {e}")
+            break
+        reenviadas += inseridas
+        esgotadas = [m for m in recusadas if m["_tentativas"] >= WEBHOOK_SPILL_MAX_TENTATIVAS]
+        restantes = [m for m in recusadas if m["_tentativas"] < WEBHOOK_SPILL_MAX_TENTATIVAS]
+        if esgotadas:
+            os.makedirs(quarentena, exist_ok=True)
+            _gravar_jsonl(os.path.join(quarentena, nome), esgotadas)
+            _webhook_stats["quarentena"] += len(esgotadas)
+            print(f"{len(esgotadas)} webhooks recusados {WEBHOOK_SPILL_MAX_TENTATIVAS}x movidos para quarentena ({nome}): {esgotadas[0]['_erro']}")
+        if restantes:
+            # Mesmo nome: as recusadas seguem na sua posição da fila do disco
+            _gravar_jsonl(origem, restantes)
+        os.unlink(reivindicado)
+    _webhook_stats["reenviadas"] += reenviadas
+    return reenviadas
+
+async def _flusher_webhooks():
+    """Agrupa mensagens até WEBHOOK_BATCH_SIZE ou WEBHOOK_FLUSH_INTERVAL_SECONDS e grava em lote"""
+    while True:
+        lote = [await _webhook_fila.get()]
+        try:
+            prazo = time.monotonic() + WEBHOOK_FLUSH_INTERVAL_SECONDS
+            while len(lote) < WEBHOOK_BATCH_SIZE:
+                restante = prazo - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(await asyncio.wait_for(_webhook_fila.get(), timeout=restante))
+                except asyncio.TimeoutError:
+                    break
+            await _gravar_lote(lote)
+        except asyncio.CancelledError:
+            # Desligamento no meio de um lote: não perde o que já saiu da fila
+            _spill_para_disco(lote)
+            raise
+        except Exception as e:
+            # Banco e disco falharam juntos: perde este lote, mas o flusher segue drenando a fila
+            print(f"Erro no flusher de webhooks, {len(lote)} mensagens perdidas: {e}")
+        finally:
+            for _ in lote:
+                _webhook_fila.task_done()
+
+async def _reenviar_spill_periodico():
+    while True:
+        await asyncio.sleep(WEBHOOK_SPILL_RETRY_SECONDS)
+        try:
+            await run_blocking(_reenviar_spill)
+        except Exception as e:
+            print(f"Erro ao reenviar webhooks em disco: {e}")
+
+def _processo_vivo(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # existe, de outro usuário
+    return True
+
+def _recuperar_reenvios_orfaos() -> int:
+    """
+    Devolve para a fila do disco os arquivos .reenviando de processos que morreram no meio do
+    reenvio (o rename de volta nunca aconteceu). Arquivos de outros workers vivos são mantidos.
+    """
+    if not os.path.isdir(WEBHOOK_SPILL_DIR):
+        return 0
+    recuperados = 0
+    for nome in os.listdir(WEBHOOK_SPILL_DIR):
+        if not nome.endswith(".reenviando"):
+            continue
+        origem, pid, _ = nome.rsplit(".", 2)
+        # Mesmo pid de agora = processo anterior reiniciado com o mesmo número
+        if pid.isdigit() and int(pid) != os.getpid() and _processo_vivo(int(pid)):
+            continue
+        try:
+            os.rename(os.path.join(WEBHOOK_SPILL_DIR, nome), os.path.join(WEBHOOK_SPILL_DIR, origem))
+            recuperados += 1
+        except OSError as e:
+            print(f"Erro ao recuperar webhooks em disco ({nome}): {e}")
+    if recuperados:
+        print(f"Webhooks em disco: {recuperados} arquivo(s) de reenvio interrompido recuperado(s)")
+    return recuperados
+
+def iniciar_ingestao_webhooks():
+    global _webhook_fila
+    try:
+        _recuperar_reenvios_orfaos()
+    except OSError as e:
+        print(f"Erro ao verificar webhooks em disco: {e}")
+    _webhook_fila = asyncio.Queue(maxsize=WEBHOOK_QUEUE_MAX)
+    _webhook_tasks.append(asyncio.create_task(_flusher_webhooks()))
+    _webhook_tasks.append(asyncio.create_task(_reenviar_spill_periodico()))
+
+async def parar_ingestao_webhooks():
+    """Espera o flusher esvaziar a fila (com prazo); o que sobrar vai para disco"""
+    if _webhook_fila is None:
+        return
+    try:
+        await asyncio.wait_for(_webhook_fila.join(), timeout=WEBHOOK_SHUTDOWN_DRAIN_SECONDS)
+    except asyncio.TimeoutError:
+        pass
+    for task in _webhook_tasks:
+        task.cancel()
+    await asyncio.gather(*_webhook_tasks, return_exceptions=True)
+    _webhook_tasks.clear()
+    pendentes = []
+    while not _webhook_fila.empty():
+        pendentes.append(_webhook_fila.get_nowait())
+    if pendentes:
+        _spill_para_disco(pendentes)
+
+async def enfileirar_mensagem(mensagem: dict):
+    """
+    Coloca a mensagem na fila sem esperar o banco. Fila cheia → disco; se nem o disco
+    aceitar, responde 503 para a UAZAPI reenviar (backpressure).
+    """
+    _webhook_stats["recebidas"] += 1
+    if _webhook_fila is None:
+        await _gravar_lote([mensagem])
+        return
+    try:
+        _webhook_fila.put_nowait(mensagem)
+    except asyncio.QueueFull:
+        try:
+            await run_blocking(_spill_para_disco, [mensagem])
+        except OSError as e:
+            print(f"Fila de webhooks cheia e disco indisponível: {e}")
+            raise HTTPException(status_code=503, detail="Fila de webhooks cheia, tente novamente")
+
+@app.get("/health/webhooks")
+async def health_webhooks():
+    """Tamanho da fila de webhooks, lotes gravados e mensagens pendentes em disco"""
+    pendentes_disco = 0
+    if os.path.isdir(WEBHOOK_SPILL_DIR):
+        pendentes_disco = sum(1 for nome in os.listdir(WEBHOOK_SPILL_DIR) if nome.endswith(".jsonl"))
+    return {
+        "fila": _webhook_fila.qsize() if _webhook_fila else 0,
+        "fila_max": WEBHOOK_QUEUE_MAX,
+        "arquivos_em_disco": pendentes_disco,
+        "duplicados_descartados": dedup_webhooks.duplicados,
+        **_webhook_stats,
+    }
+
 @app.post("/whatsapp/webhook")
 async def whatsapp_webhook(data: dict = {}):
-    """Receptor de webhooks da UAZAPI (mensagens recebidas)"""
+    """Receptor de webhooks da UAZAPI (mensagens recebidas): enfileira e responde na hora"""
     # Log para debug
     print(f"Webhook UAZAPI: {json.dumps(data, ensure_ascii=False, default=str)[:500]}")
 
-    # Tenta salvar mensagem recebida no Supabase
+    msg_data = data.get("data", data)
+    if not isinstance(msg_data, dict):
+        raise HTTPException(status_code=400, detail="Evento inválido: 'data' deve ser um objeto")
+
     try:
         event = data.get("event", "")
-        msg_data = data.get("data", data)
-
         if event in ("message", "messages.upsert", ""):
             phone = msg_data.get("from", msg_data.get("phone", ""))
             body = msg_data.get("body", msg_data.get("message", msg_data.get("text", "")))
 
             if phone and body:
-                phone_clean = ''.join(c for c in str(phone) if c.isdigit())
-
-                # Tenta vincular a um aluno
-                aluno_id = None
-                alunos = supabase.table("alunos").select("id, telefone").execute()
-                for aluno in (alunos.data or []):
-                    if aluno.get("telefone"):
-                        aluno_phone = ''.join(c for c in aluno["telefone"] if c.isdigit())
-                        if phone_clean.endswith(aluno_phone[-10:]) or aluno_phone.endswith(phone_clean[-10:]):
-                            aluno_id = aluno["id"]
-                            break
-
-                supabase.table("whatsapp_mensagens").insert({
-                    "phone": phone_clean,
-                    "message": body[:2000],
-                    "direction": "incoming",
-                    "aluno_id": aluno_id,
-                }).execute()
+                phone_clean = normalizar_telefone(phone)
+                # Hora de envio da própria mensagem (segundos ou ms): mantém a ordem por telefone
+                # mesmo quando lotes chegam fora de ordem (ex.: reenvio do disco)
+                enviado_em = msg_data.get("messageTimestamp", msg_data.get("timestamp", msg_data.get("t")))
+                try:
+                    enviado_em = float(enviado_em)
+                    timestamp = datetime.fromtimestamp(enviado_em / 1000 if enviado_em > 1e11 else enviado_em).astimezone()
+                except (TypeError, ValueError, OverflowError, OSError):
+                    enviado_em, timestamp = None, datetime.now().astimezone()
+
+                key = msg_data.get("key")
+                message_id = msg_data.get("id", msg_data.get("messageid", key.get("id") if isinstance(key, dict) else None))
+                if not message_id and enviado_em is not None:
+                    message_id = hashlib.sha1(f"{phone_clean}|{enviado_em}|{body}".encode()).hexdigest()
+                if message_id and dedup_webhooks.visto("uazapi", str(message_id)):
+                    return {"status": "ok", "duplicado": True}
+
+                # Vínculo com aluno é feito no flusher, em lote
+                try:
+                    await enfileirar_mensagem({
+                        "message_id": str(message_id) if message_id else None,
+                        "phone": phone_clean,
+                        "message": str(body)[:2000],
+                        "direction": "incoming",
+                        "timestamp": timestamp.isoformat(),
+                    })
+                except HTTPException:
+                    if message_id:
+                        dedup_webhooks.esquecer("uazapi", str(message_id))
+                    raise
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Erro ao salvar webhook: {e}")
+        print(f"Erro ao processar webhook: {e}")
 
     return {"status": "ok"}
 
@@ -1553,5 +3284,12 @@ async def whatsapp_webhook(data: dict = {}):
 # ============================================
 
 if __name__ == "__main__":
+    # python main.py backfill-presencas [YYYY-MM-DD]: reconstrói o rollup semanal de presenças
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill-presencas":
+        desde = sys.argv[2] if len(sys.argv) > 2 else None
+        result = supabase.rpc("backfill_presencas_semanais", {"p_desde": desde}).execute()
+        print(f"presencas_semanais: {result.data} linhas geradas" + (f" a partir de {desde}" if desde else ""))
+        sys.exit(0)
+
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,365 @@
+"""
+Configuração dos testes do backend.
+
+Os testes rodam sem Supabase/OpenAI reais: as variáveis de ambiente abaixo só
+permitem importar o main, e a fixture `db` troca o cliente supabase por um
+PostgREST em memória que conta as idas ao banco e as linhas transferidas.
+"""
+import os
+import sys
+
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.x")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import re
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+import httpx
+import pytest
+from postgrest import SyncPostgrestClient
+from postgrest.utils import SyncClient
+
+import main
+
+
+class Resposta:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+def _compara(valor, cond: Callable[[Any], bool]) -> bool:
+    return valor is not None and cond(valor)
+
+
+def _tipado(valor_linha, texto: str):
+    """Converte o valor textual de um filtro or=(...) para o tipo da coluna"""
+    if isinstance(valor_linha, bool):
+        return texto == "true"
+    if isinstance(valor_linha, int):
+        return int(texto)
+    return texto
+
+
+def _dividir(expr: str) -> List[str]:
+    """Separa 'a,and(b,c),d' nas vírgulas de primeiro nível"""
+    partes, nivel, atual = [], 0, ""
+    for c in expr:
+        if c == "," and nivel == 0:
+            partes.append(atual)
+            atual = ""
+            continue
+        nivel += (c == "(") - (c == ")")
+        atual += c
+    return partes + [atual]
+
+
+_OPERADORES = {
+    "eq": lambda a, b: a == b, "neq": lambda a, b: a != b,
+    "gt": lambda a, b: a > b, "gte": lambda a, b: a >= b,
+    "lt": lambda a, b: a < b, "lte": lambda a, b: a <= b,
+}
+
+
+def _condicao_or(expr: str) -> Callable[[Dict], bool]:
+    """Filtro lógico do PostgREST: 'col.op.valor' combinados com and(...)/or(...)"""
+    for conector, agregador in (("and(", all), ("or(", any)):
+        if expr.startswith(conector):
+            termos = [_condicao_or(t) for t in _dividir(expr[len(conector):-1])]
+            return lambda l, termos=termos, agregador=agregador: agregador(t(l) for t in termos)
+    coluna, op, valor = expr.split(".", 2)
+    if op == "in":
+        valores = _dividir(valor[1:-1])
+        return lambda l: _compara(l.get(coluna), lambda x: x in [_tipado(x, v) for v in valores])
+    return lambda l: _compara(l.get(coluna), lambda x: _OPERADORES[op](x, _tipado(x, valor)))
+
+
+def _regex_like(padrao: str, flags: int = 0) -> "re.Pattern":
+    """LIKE como o PostgREST aplica: '*' vira '%', '%'/'_' são curingas e '\\' escapa o caractere seguinte"""
+    partes, escapado = [], False
+    for c in padrao.replace("*", "%"):
+        if escapado:
+            partes.append(re.escape(c))
+            escapado = False
+        elif c == "\\":
+            escapado = True
+        else:
+            partes.append({"%": ".*", "_": "."}.get(c) or re.escape(c))
+    return re.compile("".join(partes), flags | re.DOTALL)
+
+
+def _inner(colunas: str, embed: str) -> bool:
+    """O embed foi pedido com !inner (ex: 'professor:usuarios!fk!inner(nome)')?"""
+    return re.search(rf"(^|[\s,(]){re.escape(embed)}(:[\w!]*)?!inner\(", colunas) is not None
+
+
+class FakeQuery:
+    """Subconjunto do query builder do postgrest-py usado pelo main"""
+
+    def __init__(self, db: "FakePostgrest", tabela: str):
+        self.db = db
+        self.tabela = tabela
+        self.operacao = "select"
+        self.colunas = "*"
+        self.filtros: List[Callable[[Dict], bool]] = []
+        self.filtros_embed: List[tuple] = []
+        self.ordem: List[tuple] = []
+        self.limite: Optional[int] = None
+        self.inicio = 0
+        self.um = False
+        self.payload: Any = None
+        self.on_conflict: Optional[str] = None
+        self.ignore_duplicates = False
+        self._negar = False
+        self.contar = False
+
+    # --- operações ---
+    def select(self, colunas: str = "*", count: Optional[str] = None, **_):
+        self.colunas = colunas
+        self.contar = count is not None
+        return self
+
+    def insert(self, payload, **_):
+        self.operacao, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload, on_conflict: Optional[str] = None, ignore_duplicates: bool = False, **_):
+        self.operacao, self.payload = "upsert", payload
+        self.on_conflict, self.ignore_duplicates = on_conflict, ignore_duplicates
+        return self
+
+    def update(self, payload, **_):
+        self.operacao, self.payload = "update", payload
+        return self
+
+    def delete(self, **_):
+        self.operacao = "delete"
+        return self
+
+    # --- filtros ---
+    def _filtro(self, chave: str, cond: Callable[[Any], bool]):
+        negar, self._negar = self._negar, False
+        if negar:
+            cond = lambda x, c=cond: not c(x)
+        if "." in chave:
+            # Filtro em recurso embutido: filtra o embed e, com !inner, a linha pai
+            embed, coluna = chave.split(".", 1)
+            self.filtros_embed.append((embed, coluna, cond))
+        else:
+            self.filtros.append(lambda l: _compara(l.get(chave), cond))
+        return self
+
+    @property
+    def not_(self):
+        self._negar = True
+        return self
+
+    def eq(self, c, v): return self._filtro(c, lambda x: x == v)
+    def neq(self, c, v): return self._filtro(c, lambda x: x != v)
+    def gt(self, c, v): return self._filtro(c, lambda x: x > v)
+    def gte(self, c, v): return self._filtro(c, lambda x: x >= v)
+    def lt(self, c, v): return self._filtro(c, lambda x: x < v)
+    def lte(self, c, v): return self._filtro(c, lambda x: x <= v)
+    def in_(self, c, vs): return self._filtro(c, lambda x, vs=set(vs): x in vs)
+
+    def like(self, c, padrao):
+        regex = _regex_like(padrao)
+        return self._filtro(c, lambda x: regex.fullmatch(str(x)) is not None)
+
+    def ilike(self, c, padrao):
+        regex = _regex_like(padrao, re.IGNORECASE)
+        return self._filtro(c, lambda x: regex.fullmatch(str(x)) is not None)
+
+    def or_(self, expr: str):
+        self.filtros.append(_condicao_or(f"or({expr})"))
+        return self
+
+    # --- modificadores ---
+    def order(self, coluna: str, desc: bool = False, **_):
+        self.ordem.append((coluna, desc))
+        return self
+
+    def limit(self, n: int):
+        self.limite = n
+        return self
+
+    def range(self, inicio: int, fim: int):
+        self.inicio, self.limite = inicio, fim - inicio + 1
+        return self
+
+    def single(self):
+        self.um = True
+        return self
+
+    # --- execução ---
+    def _aplicar_embeds(self, linha: Dict) -> Optional[Dict]:
+        linha = dict(linha)
+        for embed, coluna, cond in self.filtros_embed:
+            valor = linha.get(embed)
+            if isinstance(valor, list):
+                valor = [v for v in valor if _compara(v.get(coluna), cond)]
+                vazio = not valor
+            else:
+                if valor is not None and not _compara(valor.get(coluna), cond):
+                    valor = None
+                vazio = valor is None
+            if vazio and _inner(self.colunas, embed):
+                return None
+            linha[embed] = valor
+        return linha
+
+    def _fonte(self) -> List[Dict]:
+        return self.db.tabelas.get(self.tabela, [])
+
+    def _filtrar(self) -> List[Dict]:
+        linhas = []
+        for linha in self._fonte():
+            if all(f(linha) for f in self.filtros):
+                linha = self._aplicar_embeds(linha)
+                if linha is not None:
+                    linhas.append(linha)
+        for coluna, desc in reversed(self.ordem):
+            linhas.sort(key=lambda l: (l.get(coluna) is None, l.get(coluna)), reverse=desc)
+        return linhas
+
+    def _pagina(self, linhas: List[Dict]) -> List[Dict]:
+        # Sem limite explícito o PostgREST devolve no máximo max_rows linhas
+        limite = self.limite if self.limite is not None else self.db.max_rows
+        return linhas[self.inicio:self.inicio + min(limite, self.db.max_rows)]
+
+    def execute(self):
+        self.db.chamadas.append((self.operacao, self.tabela))
+        if self.db.falhar and self.db.falhar(self):
+            raise RuntimeError(f"falha simulada em {self.operacao} {self.tabela}")
+
+        tabela = self.db.tabelas.setdefault(self.tabela, [])
+        if self.operacao == "select":
+            todas = self._filtrar()
+            data = self._pagina(todas)
+            self.db.linhas_transferidas += len(data)
+            if self.um:
+                return Resposta(data[0] if data else None)
+            return Resposta(data, len(todas) if self.contar else None)
+
+        if self.operacao in ("insert", "upsert"):
+            novas = self.payload if isinstance(self.payload, list) else [self.payload]
+            chaves = (self.on_conflict or "id").split(",")
+            gravadas = []
+            for nova in novas:
+                existente = None
+                if self.operacao == "upsert":
+                    existente = next((l for l in tabela if all(l.get(k) == nova.get(k) for k in chaves)), None)
+                if existente is not None:
+                    if not self.ignore_duplicates:
+                        existente.update(nova)
+                        gravadas.append(dict(existente))
+                    continue
+                linha = dict(nova)
+                linha.setdefault("id", f"{self.tabela}-{len(tabela) + 1}")
+                tabela.append(linha)
+                gravadas.append(dict(linha))
+            return Resposta(gravadas)
+
+        afetadas = [l for l in tabela if all(f(l) for f in self.filtros)]
+        if self.operacao == "update":
+            for linha in afetadas:
+                linha.update(self.payload)
+        else:
+            self.db.tabelas[self.tabela] = [l for l in tabela if l not in afetadas]
+        return Resposta([dict(l) for l in afetadas])
+
+
+class FakeRpc(FakeQuery):
+    """RPC: o resultado da função Python passa pelos mesmos filtros/ordem/limite da query"""
+
+    def __init__(self, db: "FakePostgrest", nome: str, params: Dict[str, Any]):
+        super().__init__(db, nome)
+        self.params = params
+
+    def _fonte(self) -> List[Dict]:
+        return self._resultado
+
+    def execute(self):
+        self.db.chamadas.append(("rpc", self.tabela))
+        if self.db.falhar and self.db.falhar(self):
+            raise RuntimeError(f"falha simulada na rpc {self.tabela}")
+        funcao = self.db.rpcs.get(self.tabela)
+        if funcao is None:
+            raise RuntimeError(f"RPC não simulada: {self.tabela}")
+        data = funcao(self.params)
+        if not isinstance(data, list):
+            self.db.linhas_transferidas += 1
+            return Resposta(data)
+        self._resultado = data
+        data = self._pagina(self._filtrar())
+        self.db.linhas_transferidas += len(data)
+        return Resposta(data)
+
+
+class FakePostgrest:
+    """Cliente supabase em memória: tabelas como listas de dicts, RPCs como funções Python"""
+
+    def __init__(self):
+        self.tabelas: Dict[str, List[Dict[str, Any]]] = {}
+        self.rpcs: Dict[str, Callable[[Dict[str, Any]], Any]] = {}
+        self.chamadas: List[tuple] = []
+        self.linhas_transferidas = 0
+        self.max_rows = 1000
+        self.falhar: Optional[Callable[[FakeQuery], bool]] = None
+
+    def table(self, nome: str) -> FakeQuery:
+        return FakeQuery(self, nome)
+
+    def rpc(self, nome: str, params: Optional[Dict[str, Any]] = None) -> FakeRpc:
+        return FakeRpc(self, nome, params or {})
+
+    def zerar_contadores(self):
+        self.chamadas.clear()
+        self.linhas_transferidas = 0
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakePostgrest()
+    monkeypatch.setattr(main, "supabase", fake)
+    main.invalidate_user_scope()
+    yield fake
+    main.invalidate_user_scope()
+
+
+class PostgrestHttp:
+    """Cliente postgrest-py de verdade sobre um transporte falso: guarda os requests como sairiam pela rede"""
+
+    def __init__(self):
+        self.requests: List[httpx.Request] = []
+        self.resposta: Any = []
+        cliente = SyncPostgrestClient("http://postgrest.teste/rest/v1")
+        cliente.session = SyncClient(
+            base_url="http://postgrest.teste/rest/v1",
+            headers=dict(cliente.session.headers),
+            transport=httpx.MockTransport(self._responder),
+        )
+        self.table = cliente.from_
+        self.rpc = cliente.rpc
+
+    def _responder(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        corpo = self.resposta(request) if callable(self.resposta) else self.resposta
+        return httpx.Response(200, json=corpo)
+
+    def parametros(self, indice: int = -1) -> List[tuple]:
+        """Query string decodificada como o PostgREST decodifica (%XX → byte)"""
+        return parse_qsl(self.requests[indice].url.query.decode(), errors="replace")
+
+
+@pytest.fixture
+def postgrest_http(monkeypatch):
+    fake = PostgrestHttp()
+    monkeypatch.setattr(main, "supabase", fake)
+    main.invalidate_user_scope()
+    yield fake
+    main.invalidate_user_scope()
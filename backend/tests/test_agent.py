@@ -0,0 +1,176 @@
+import asyncio
+import json
+import threading
+import time
+
+import httpx
+import pytest
+from openai import AsyncOpenAI
+
+import main
+
+
+def _rodadas(respostas):
+    """stream_completion falso: cada chamada consome a próxima rodada roteirizada"""
+    chamadas = []
+
+    async def stream_completion(messages, with_tools):
+        chamadas.append(with_tools)
+        tokens, tool_calls = respostas[len(chamadas) - 1]
+        for token in tokens:
+            yield "token", token
+        if tool_calls:
+            yield "tool_calls", tool_calls
+
+    return stream_completion, chamadas
+
+
+def _coletar(messages):
+    async def coletar():
+        return [evento async for evento in main.run_agent(messages, {"perfil": "admin"})]
+    return asyncio.run(coletar())
+
+
+def test_preambulo_de_rodada_com_ferramentas_nao_vai_para_o_cliente(monkeypatch):
+    tool_call = {"id": "c1", "type": "function", "function": {"name": "estatisticas_gerais", "arguments": "{}"}}
+    stream, _ = _rodadas([
+        (["Vou ", "consultar..."], [tool_call]),
+        (["Há ", "10 alunos."], None),
+    ])
+    monkeypatch.setattr(main, "stream_completion", stream)
+
+    async def execute_tool_calls(tool_calls, scope):
+        return [{"role": "tool", "tool_call_id": "c1", "content": "{}"}]
+    monkeypatch.setattr(main, "execute_tool_calls", execute_tool_calls)
+
+    messages = [{"role": "user", "content": "quantos alunos?"}]
+    eventos = _coletar(messages)
+
+    texto = "".join(e["content"] for e in eventos if e["type"] == "token")
+    assert texto == "Há 10 alunos."
+    assert [e["type"] for e in eventos] == ["tool_start", "tool_end", "token"]
+    # O preâmbulo continua no histórico enviado ao modelo
+    assert messages[1]["content"] == "Vou consultar..."
+
+
+def test_rodada_final_sem_ferramentas_transmite_token_a_token(monkeypatch):
+    stream, chamadas = _rodadas([(["a", "b", "c"], None)])
+    monkeypatch.setattr(main, "stream_completion", stream)
+    monkeypatch.setattr(main, "MAX_TOOL_ROUNDS", 0)
+
+    eventos = _coletar([{"role": "user", "content": "oi"}])
+
+    assert chamadas == [False]
+    assert [e["content"] for e in eventos] == ["a", "b", "c"]
+
+
+LATENCIA_LLM = 0.1
+LATENCIA_BANCO = 0.2
+
+
+def _sse(*deltas):
+    linhas = [
+        "data: " + json.dumps({
+            "id": "c", "object": "chat.completion.chunk", "created": 0, "model": "m",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+        })
+        for delta in deltas
+    ]
+    return ("\n\n".join(linhas + ["data: [DONE]"]) + "\n\n").encode()
+
+
+@pytest.fixture
+def openai_lento(monkeypatch):
+    """AsyncOpenAI de verdade sobre um transporte que demora LATENCIA_LLM por rodada"""
+    async def responder(request):
+        await asyncio.sleep(LATENCIA_LLM)
+        corpo = json.loads(request.content)
+        # Primeira rodada pede a ferramenta; depois do resultado, responde
+        if "tools" in corpo and not any(m["role"] == "tool" for m in corpo["messages"]):
+            corpo = _sse({"tool_calls": [{"index": 0, "id": "c1", "type": "function",
+                                          "function": {"name": "estatisticas_gerais", "arguments": "{}"}}]})
+        else:
+            corpo = _sse({"content": "Há 10 alunos."})
+        return httpx.Response(200, content=corpo, headers={"content-type": "text/event-stream"})
+
+    cliente = AsyncOpenAI(api_key="sk-test", max_retries=0,
+                          http_client=httpx.AsyncClient(transport=httpx.MockTransport(responder)))
+    monkeypatch.setattr(main, "openai_client", cliente)
+    monkeypatch.setattr(main, "chat_cache", main.ChatCache(main.CHAT_CACHE_MAX_ENTRIES))
+
+
+def _chats_simultaneos(n):
+    async def rodar():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://teste", timeout=30) as cliente:
+            inicio = time.perf_counter()
+            respostas = await asyncio.gather(*[
+                cliente.post("/chat", json={"message": f"quantos alunos? ({i})"}) for i in range(n)
+            ])
+            return respostas, time.perf_counter() - inicio
+
+    return asyncio.run(rodar())
+
+
+def test_chats_simultaneos_nao_serializam(db, openai_lento):
+    # Banco síncrono e lento: cada consulta bloqueia LATENCIA_BANCO (roda no pool de threads)
+    db.rpcs["estatisticas_escola"] = lambda params: {"total_alunos": 10}
+    db.falhar = lambda query: time.sleep(LATENCIA_BANCO) or False
+
+    respostas, um_so = _chats_simultaneos(1)
+    assert respostas[0].json()["response"] == "Há 10 alunos."
+
+    n = 8
+    respostas, varios = _chats_simultaneos(n)
+
+    assert all(r.status_code == 200 and r.json()["response"] == "Há 10 alunos." for r in respostas)
+    # Em série seriam ~n vezes o tempo de um; em paralelo fica perto de um só
+    assert um_so >= 2 * LATENCIA_LLM + LATENCIA_BANCO
+    assert varios < 2 * um_so < n * um_so / 2
+
+
+def _tool_call(i, nome="lenta", argumentos=None):
+    return {"id": f"call_{i}", "type": "function",
+            "function": {"name": nome, "arguments": json.dumps(argumentos if argumentos is not None else {"i": i})}}
+
+
+def test_tool_calls_do_turno_rodam_em_paralelo_com_limite(monkeypatch):
+    monkeypatch.setattr(main, "TOOL_MAX_CONCURRENCY", 2)
+    em_voo, pico, trava = [0], [0], threading.Lock()
+
+    def lenta(i, _scope=None):
+        with trava:
+            em_voo[0] += 1
+            pico[0] = max(pico[0], em_voo[0])
+        time.sleep(0.1)
+        with trava:
+            em_voo[0] -= 1
+        return {"i": i}
+
+    monkeypatch.setitem(main.TOOL_FUNCTIONS, "lenta", lenta)
+
+    inicio = time.perf_counter()
+    mensagens = asyncio.run(main.execute_tool_calls([_tool_call(i) for i in range(6)], {"perfil": "admin"}))
+    duracao = time.perf_counter() - inicio
+
+    # 6 chamadas de 0.1s, 2 por vez: ~0.3s (em série seriam 0.6s), nunca mais de 2 juntas
+    assert pico[0] == 2
+    assert duracao < 0.5
+    # Resultados na ordem das tool_calls
+    assert [m["tool_call_id"] for m in mensagens] == [f"call_{i}" for i in range(6)]
+    assert [json.loads(m["content"])["i"] for m in mensagens] == list(range(6))
+
+
+def test_tool_call_lenta_ou_malformada_vira_erro_sem_derrubar_o_turno(monkeypatch):
+    monkeypatch.setattr(main, "TOOL_TIMEOUT_SECONDS", 0.05)
+    monkeypatch.setitem(main.TOOL_FUNCTIONS, "lenta", lambda _scope=None: time.sleep(0.3))
+    monkeypatch.setitem(main.TOOL_FUNCTIONS, "rapida", lambda _scope=None: {"ok": True})
+    chamadas = [_tool_call(0, "lenta", {}), _tool_call(1, "rapida", {}), _tool_call(2, "inexistente", {})]
+    chamadas.append({"id": "call_3", "type": "function", "function": {"name": "rapida", "arguments": "{quebrado"}})
+
+    conteudos = [json.loads(m["content"]) for m in asyncio.run(main.execute_tool_calls(chamadas, {"perfil": "admin"}))]
+
+    assert "Tempo esgotado" in conteudos[0]["erro"]
+    assert conteudos[1] == {"ok": True}
+    assert "não encontrada" in conteudos[2]["erro"]
+    assert "Argumentos inválidos" in conteudos[3]["erro"]
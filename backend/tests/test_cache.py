@@ -0,0 +1,182 @@
+import asyncio
+import os
+
+import httpx
+import pytest
+
+import main
+
+
+def _post(path, json, headers=None):
+    async def enviar():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://teste") as client:
+            return await client.post(path, json=json, headers=headers or {})
+    return asyncio.run(enviar())
+
+
+def test_alunos_in_scope_nao_altera_o_escopo_compartilhado(db):
+    db.tabelas["turmas"] = [{"id": "t1", "nome": "A", "professor_id": "p1"}]
+    db.tabelas["matriculas"] = [{"turma_id": "t1", "aluno_id": "a1"}, {"turma_id": "t1", "aluno_id": "a2"}]
+    usuario = main.ChatUser(id="p1", perfil="professor")
+
+    scope = main.compute_user_scope(usuario)
+    antes = dict(scope)
+    assert sorted(main._alunos_in_scope(scope)) == ["a1", "a2"]
+    assert sorted(main._alunos_in_scope(main.compute_user_scope(usuario))) == ["a1", "a2"]
+
+    assert scope == antes
+    # Escopo e aluno_ids vêm do cache na segunda vez
+    assert db.chamadas == [("select", "turmas"), ("select", "matriculas")]
+
+
+def test_invalidacao_de_matriculas_recalcula_aluno_ids(db):
+    db.tabelas["matriculas"] = [{"turma_id": "t1", "aluno_id": "a1"}]
+    scope = {"allowed_turma_ids": ["t1"]}
+    assert main._alunos_in_scope(scope) == ["a1"]
+
+    db.tabelas["matriculas"].append({"turma_id": "t1", "aluno_id": "a2"})
+    main.notify_data_change(["matriculas"])
+
+    assert sorted(main._alunos_in_scope(scope)) == ["a1", "a2"]
+
+
+def test_cache_invalidate_exige_credenciais(db):
+    assert _post("/cache/invalidate", {"tables": ["alunos"]}).status_code == 401
+
+
+def test_cache_invalidate_aceita_service_key(db):
+    versao = main._versoes_dados["alunos"]
+    r = _post("/cache/invalidate", {"tables": ["alunos"]},
+              {"Authorization": f"Bearer {os.environ['SUPABASE_SERVICE_KEY']}"})
+    assert r.status_code == 200
+    assert main._versoes_dados["alunos"] == versao + 1
+
+
+def test_cache_invalidate_por_perfil(db):
+    db.tabelas["usuarios"] = [
+        {"id": "adm", "perfil": "admin", "ativo": True},
+        {"id": "prof", "perfil": "professor", "ativo": True},
+        {"id": "ex", "perfil": "admin", "ativo": False},
+    ]
+    assert _post("/cache/invalidate", {"tables": ["turmas"]}, {"X-Usuario-Id": "adm"}).status_code == 200
+    assert _post("/cache/invalidate", {"tables": ["aulas", "presencas"]}, {"X-Usuario-Id": "prof"}).status_code == 200
+    assert _post("/cache/invalidate", {"tables": ["alunos"]}, {"X-Usuario-Id": "prof"}).status_code == 403
+    assert _post("/cache/invalidate", {"tables": ["aulas"]}, {"X-Usuario-Id": "ex"}).status_code == 403
+    assert _post("/cache/invalidate", {"tables": ["aulas"]}, {"X-Usuario-Id": "desconhecido"}).status_code == 403
+
+
+def test_chave_de_cache_separa_perfis_com_as_mesmas_turmas():
+    professor = {"allowed_turma_ids": ["t2", "t1"], "perfil": "professor"}
+    supervisor = {"allowed_turma_ids": ["t1", "t2"], "perfil": "supervisor"}
+    outro_professor = {"allowed_turma_ids": ["t1", "t2"], "perfil": "professor"}
+
+    assert main.escopo_cache_key(professor) != main.escopo_cache_key(supervisor)
+    assert main.escopo_cache_key(professor) == main.escopo_cache_key(outro_professor)
+    assert main.escopo_cache_key({"allowed_turma_ids": None, "perfil": "admin"}) == "admin:todas"
+
+
+def test_alteracao_de_usuarios_invalida_o_cache_do_escopo(db):
+    db.tabelas["usuarios"] = [{"id": "adm", "perfil": "admin", "ativo": True}]
+    db.tabelas["turmas"] = [{"id": "t1", "nome": "A", "professor_id": "p1"}]
+    scope = main.compute_user_scope(main.ChatUser(id="p1", perfil="professor"))
+    grupo = f"{main.escopo_cache_key(scope)}:hoje"
+    main.chat_cache.salvar(f"{grupo}:professores", grupo, "Prof. Ana", ["consultar_professores"],
+                           dict(main._versoes_dados), 1.0)
+    main.chat_cache.salvar(f"{grupo}:aulas", grupo, "3 aulas", ["consultar_aulas"], dict(main._versoes_dados), 1.0)
+    assert main.chat_cache.buscar(f"{grupo}:professores") == "Prof. Ana"
+
+    # Professor editado/excluído no frontend: o App.jsx avisa com tables=['usuarios']
+    assert _post("/cache/invalidate", {"tables": ["usuarios"]}, {"X-Usuario-Id": "adm"}).status_code == 200
+
+    assert main.chat_cache.buscar(f"{grupo}:professores") is None
+    assert main.chat_cache.buscar(f"{grupo}:aulas") == "3 aulas"
+    # E o escopo do professor é recalculado
+    db.zerar_contadores()
+    main.compute_user_scope(main.ChatUser(id="p1", perfil="professor"))
+    assert ("select", "turmas") in db.chamadas
+
+
+def _get(path, headers=None, **params):
+    async def enviar():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://teste") as client:
+            return await client.get(path, params=params, headers=headers or {})
+    return asyncio.run(enviar())
+
+
+@pytest.fixture
+def alertas(db, monkeypatch):
+    """alertas_semana falso: uma falta por aluno das turmas pedidas; guarda os parâmetros de cada chamada"""
+    monkeypatch.setattr(main, "_alertas_cache", {})
+    db.tabelas["turmas"] = [
+        {"id": "t1", "nome": "Inglês 1", "professor_id": "p1"},
+        {"id": "t2", "nome": "Inglês 2", "professor_id": "p2"},
+    ]
+    db.tabelas["supervisor_turmas"] = [{"usuario_id": "s1", "turma_id": "t1"}]
+    db.tabelas["faltas"] = [
+        {"aluno_id": "a1", "nome": "Ana", "turma_id": "t1", "total_faltas": 2},
+        {"aluno_id": "a2", "nome": "Bia", "turma_id": "t2", "total_faltas": 1},
+    ]
+    chamadas = []
+
+    def alertas_semana(params):
+        chamadas.append(params)
+        turmas = params["p_turma_ids"]
+        faltas = [f for f in db.tabelas["faltas"] if turmas is None or f["turma_id"] in turmas]
+        return {"faltas": faltas, "inadimplentes": [{"id": "a9", "nome": "Caio"}] if turmas is None else []}
+
+    db.rpcs["alertas_semana"] = alertas_semana
+    return chamadas
+
+
+def test_alertas_em_uma_unica_chamada_ao_banco(db, alertas):
+    resposta = _get("/alertas")
+
+    assert resposta.status_code == 200
+    corpo = resposta.json()
+    assert corpo["resumo"] == {"totalFaltasSemana": 3, "alunosComFalta": 2, "totalInadimplentes": 1}
+    assert db.chamadas == [("rpc", "alertas_semana")]
+    (params,) = alertas
+    assert params["p_turma_ids"] is None
+    assert (params["p_inicio"], params["p_fim"]) == (corpo["periodo"]["inicio"], corpo["periodo"]["fim"])
+
+
+def test_alertas_revalidam_por_etag_e_invalidam_com_presencas(db, alertas):
+    primeira = _get("/alertas")
+    etag = primeira.headers["etag"]
+    assert primeira.headers["cache-control"] == "no-cache"
+
+    # Mesmo snapshot: 304 sem corpo e sem ir ao banco
+    db.zerar_contadores()
+    revalidada = _get("/alertas", {"If-None-Match": f"W/{etag}"})
+    assert revalidada.status_code == 304 and revalidada.content == b""
+    assert _get("/alertas").json() == primeira.json()
+    assert db.chamadas == []
+
+    # Presença lançada: snapshot recalculado, ETag novo
+    db.tabelas["faltas"][0]["total_faltas"] = 3
+    main.notify_data_change(["presencas"])
+    nova = _get("/alertas", {"If-None-Match": etag})
+    assert nova.status_code == 200 and nova.headers["etag"] != etag
+    assert nova.json()["resumo"]["totalFaltasSemana"] == 4
+    assert db.chamadas == [("rpc", "alertas_semana")]
+
+
+def test_alertas_so_das_turmas_do_usuario(db, alertas):
+    professor = _get("/alertas", user_id="p1", perfil="professor").json()
+    supervisor = _get("/alertas", user_id="s1", perfil="supervisor").json()
+    sem_turmas = _get("/alertas", user_id="p9", perfil="professor").json()
+    admin = _get("/alertas").json()
+
+    assert [f["nome"] for f in professor["faltas"]] == ["Ana"]
+    assert [f["nome"] for f in supervisor["faltas"]] == ["Ana"]
+    assert sem_turmas["faltas"] == [] and sem_turmas["resumo"]["totalInadimplentes"] == 0
+    assert len(admin["faltas"]) == 2
+    # Professor e supervisor das mesmas turmas não dividem entrada; sem turmas nem chama o banco
+    assert [a["p_turma_ids"] for a in alertas] == [["t1"], ["t1"], None]
+
+    # Segundo professor da mesma turma reaproveita o snapshot
+    db.tabelas["turmas"].append({"id": "t1", "nome": "Inglês 1", "professor_id": "p3"})
+    assert _get("/alertas", user_id="p3", perfil="professor").json() == professor
+    assert len(alertas) == 3
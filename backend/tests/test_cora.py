@@ -0,0 +1,109 @@
+import asyncio
+import base64
+import time
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+@pytest.fixture
+def cora_com_certificado_invalido(monkeypatch):
+    monkeypatch.setattr(main, "CORA_CLIENT_ID", "cliente")
+    monkeypatch.setattr(main, "CORA_CERT_B64", base64.b64encode(b"nao e um certificado").decode())
+    monkeypatch.setattr(main, "CORA_KEY_B64", base64.b64encode(b"nem uma chave").decode())
+    monkeypatch.setattr(main, "_cora_config_erro", None)
+    monkeypatch.setattr(main, "_http_clients", {})
+
+
+def test_certificado_invalido_desativa_so_a_cora(cora_com_certificado_invalido):
+    for _ in range(2):
+        with pytest.raises(HTTPException) as erro:
+            main.get_cora_client()
+        assert erro.value.status_code == 503
+    assert "certificado" in main._cora_config_erro
+
+
+def test_api_sobe_com_certificado_invalido(cora_com_certificado_invalido, monkeypatch, db):
+    iniciados = []
+
+    async def iniciar_workers_jobs():
+        iniciados.append("jobs")
+
+    async def parar():
+        pass
+
+    monkeypatch.setattr(main, "iniciar_workers_jobs", iniciar_workers_jobs)
+    monkeypatch.setattr(main, "parar_workers_jobs", parar)
+    monkeypatch.setattr(main, "iniciar_ingestao_webhooks", lambda: iniciados.append("webhooks"))
+    monkeypatch.setattr(main, "parar_ingestao_webhooks", parar)
+    monkeypatch.setattr(main, "iniciar_renovacao_token_cora", lambda: iniciados.append("cora"))
+    monkeypatch.setattr(main, "db_executor", type("Executor", (), {"shutdown": lambda self, wait: None})())
+
+    async def subir():
+        async with main.lifespan(main.app):
+            pass
+
+    asyncio.run(subir())
+    assert iniciados == ["jobs", "webhooks"]
+
+
+@pytest.fixture
+def token_cora(monkeypatch):
+    """Cora sem token em cache, com /token lento (as chamadas concorrentes se sobrepõem)"""
+    posts = []
+
+    async def responder(request):
+        assert request.url.path == "/token"
+        posts.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"access_token": f"tok{len(posts)}", "expires_in": 3600})
+
+    monkeypatch.setattr(main, "CORA_CLIENT_ID", "cliente")
+    monkeypatch.setattr(main, "CORA_CERT_B64", "cert")
+    monkeypatch.setattr(main, "CORA_KEY_B64", "chave")
+    monkeypatch.setattr(main, "_cora_config_erro", None)
+    monkeypatch.setattr(main, "_cora_token_cache", {"token": None, "expires_at": 0})
+    monkeypatch.setattr(main, "_cora_token_lock", asyncio.Lock())
+    monkeypatch.setattr(main, "_http_clients", {
+        "cora": httpx.AsyncClient(transport=httpx.MockTransport(responder), base_url="https://cora.teste"),
+    })
+    return posts
+
+
+def _tokens_simultaneos(n):
+    # Cada asyncio.run é um loop novo (em produção o lock vive num loop só); a fixture restaura o original
+    main._cora_token_lock = asyncio.Lock()
+
+    async def rodar():
+        return await asyncio.gather(*(main.cora_get_token() for _ in range(n)))
+    return asyncio.run(rodar())
+
+
+def test_renovacao_do_token_e_single_flight(token_cora):
+    assert set(_tokens_simultaneos(50)) == {"tok1"}
+    assert len(token_cora) == 1
+
+    # Token ainda válido: nenhuma ida nova à Cora
+    assert _tokens_simultaneos(10) == ["tok1"] * 10
+    assert len(token_cora) == 1
+
+
+def test_token_compartilhado_entre_workers_pelo_arquivo(token_cora, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "CORA_TOKEN_STORE", "arquivo")
+    monkeypatch.setattr(main, "CORA_TOKEN_FILE", str(tmp_path / "cora_token.json"))
+    assert set(_tokens_simultaneos(20)) == {"tok1"}
+
+    # Outro worker: cache em memória vazio, mas lê o token salvo em vez de pedir outro
+    monkeypatch.setattr(main, "_cora_token_cache", {"token": None, "expires_at": 0})
+    assert set(_tokens_simultaneos(20)) == {"tok1"}
+    assert len(token_cora) == 1
+
+    # Perto de expirar: um único refresh, e o novo token vai para o arquivo
+    monkeypatch.setattr(main, "_cora_token_cache", {"token": "tok1", "expires_at": time.time() + 10})
+    (tmp_path / "cora_token.json").write_text('{"token": "tok1", "expires_at": %f}' % (time.time() + 10))
+    assert set(_tokens_simultaneos(20)) == {"tok2"}
+    assert len(token_cora) == 2
+    assert "tok2" in (tmp_path / "cora_token.json").read_text()
@@ -0,0 +1,306 @@
+import pytest
+
+import main
+
+
+def _todas_as_paginas(tool, **kwargs):
+    """Segue proximo_cursor até o fim; retorna (itens, número de páginas)"""
+    itens, paginas, cursor = [], 0, None
+    while True:
+        resultado = tool(cursor=cursor, _scope={"allowed_turma_ids": None}, **kwargs)
+        paginas += 1
+        if isinstance(resultado, list):
+            return itens + resultado, paginas
+        itens += resultado["itens"]
+        cursor = resultado["proximo_cursor"]
+
+
+def _com_nome_busca(linha):
+    """Simula a coluna gerada nome_busca (f_unaccent(lower(nome)))"""
+    linha["nome_busca"] = main.normalizar_busca(linha["nome"])
+    return linha
+
+
+def _contar_alunos_por_turma(db):
+    def rpc(params):
+        contagem = {}
+        for m in db.tabelas.get("matriculas", []):
+            if m["status"] == "ativo" and m["turma_id"] in params["p_turma_ids"]:
+                contagem[m["turma_id"]] = contagem.get(m["turma_id"], 0) + 1
+        return [{"turma_id": t, "total_alunos": n} for t, n in contagem.items()]
+    return rpc
+
+
+def _escola(db, n_turmas, alunos_por_turma=3):
+    db.tabelas["turmas"] = [
+        {"id": f"t{i}", "nome": f"Turma {i}", "idioma": "ingles", "professor_id": None, "professor": None}
+        for i in range(n_turmas)
+    ]
+    db.tabelas["matriculas"] = [
+        {"turma_id": f"t{i}", "aluno_id": f"a{i}-{j}", "status": "ativo"}
+        for i in range(n_turmas) for j in range(alunos_por_turma)
+    ]
+    db.rpcs["contar_alunos_por_turma"] = _contar_alunos_por_turma(db)
+
+
+@pytest.mark.parametrize("n_turmas", [1, 10, 200])
+def test_consultar_turmas_faz_duas_idas_ao_banco_por_pagina(db, n_turmas):
+    _escola(db, n_turmas)
+
+    turmas, paginas = _todas_as_paginas(main.tool_consultar_turmas)
+
+    assert sorted(t["id"] for t in turmas) == sorted(f"t{i}" for i in range(n_turmas))
+    assert all(t["total_alunos"] == 3 for t in turmas)
+    # Uma consulta de turmas + uma contagem agregada por página, sem consulta por turma
+    assert db.chamadas == [("select", "turmas"), ("rpc", "contar_alunos_por_turma")] * paginas
+    assert paginas == -(-n_turmas // main.TOOL_PAGE_SIZE)
+
+
+def _professores(db, n_professores, turmas_por_professor=2):
+    db.tabelas["usuarios"] = []
+    db.tabelas["turmas"] = []
+    for p in range(n_professores):
+        turmas = [
+            {"id": f"t{p}-{k}", "nome": f"Turma {p}-{k}", "idioma": "ingles", "horario": "19h", "professor_id": f"p{p}"}
+            for k in range(turmas_por_professor)
+        ]
+        db.tabelas["turmas"].extend(turmas)
+        db.tabelas["usuarios"].append(
+            {"id": f"p{p}", "nome": f"Professor {p}", "perfil": "professor", "ativo": True, "turmas": turmas}
+        )
+
+
+@pytest.mark.parametrize("n_professores", [5, 50, 500])
+def test_consultar_professores_nao_cresce_com_o_numero_de_professores(db, n_professores):
+    _professores(db, n_professores)
+
+    primeira = main.tool_consultar_professores(_scope={"allowed_turma_ids": None})
+    assert db.chamadas == [("select", "usuarios")]
+
+    db.zerar_contadores()
+    professores, paginas = _todas_as_paginas(main.tool_consultar_professores)
+    assert len(professores) == n_professores
+    assert all(p["total_turmas"] == 2 for p in professores)
+    # Uma consulta por página; cada página é limitada, não importa quantos professores existam
+    assert db.chamadas == [("select", "usuarios")] * paginas
+    assert len(primeira if isinstance(primeira, list) else primeira["itens"]) <= main.TOOL_PAGE_SIZE
+
+
+@pytest.mark.parametrize("n_professores", [5, 50, 500])
+def test_consultar_professores_com_escopo_nao_cresce_com_o_numero_de_professores(db, n_professores):
+    _professores(db, n_professores)
+    # Supervisor com a primeira turma de cada professor
+    allowed = [f"t{p}-0" for p in range(n_professores)]
+
+    professores = main.tool_consultar_professores(_scope={"allowed_turma_ids": allowed})
+    if isinstance(professores, dict):
+        assert professores["total_registros"] == n_professores
+        professores = professores["itens"]
+
+    # As turmas embutidas ficam restritas ao escopo
+    assert all([t["id"] for t in p["turmas"]] == [f"{p['id'].replace('p', 't')}-0"] for p in professores)
+    assert db.chamadas == [("select", "turmas"), ("select", "usuarios")]
+
+
+def _turmas_com_professores(db, n_turmas, n_professores):
+    professores = [{"id": f"p{p}", "nome": f"Professor {p}", "email": f"p{p}@escola"} for p in range(n_professores)]
+    professores[7]["nome"] = "Mariana Souza"
+    professores = [_com_nome_busca(p) for p in professores]
+    db.tabelas["turmas"] = [
+        {"id": f"t{i}", "nome": f"Turma {i}", "idioma": "ingles", "professor_id": f"p{i % n_professores}",
+         "professor": professores[i % n_professores]}
+        for i in range(n_turmas)
+    ]
+    db.rpcs["contar_alunos_por_turma"] = lambda params: [{"turma_id": t, "total_alunos": 0} for t in params["p_turma_ids"]]
+
+
+def test_filtro_por_professor_so_transfere_as_turmas_dele(db):
+    _turmas_com_professores(db, n_turmas=500, n_professores=50)
+
+    turmas = main.tool_consultar_turmas(professor_nome="mariana", _scope={"allowed_turma_ids": None})
+
+    assert sorted(t["id"] for t in turmas) == ["t107", "t157", "t207", "t257", "t307", "t357", "t407", "t457", "t57", "t7"]
+    # 10 turmas + 10 contagens, em vez das 500 turmas filtradas no Python
+    assert db.linhas_transferidas == 20
+    assert db.chamadas == [("select", "turmas"), ("rpc", "contar_alunos_por_turma")]
+
+
+def test_filtro_por_aluno_nas_faltas_so_transfere_as_presencas_dele(db):
+    alunos = [{"id": f"a{i}", "nome": f"Aluno {i}"} for i in range(40)]
+    alunos[3]["nome"] = "Joana Prado"
+    alunos = [_com_nome_busca(a) for a in alunos]
+    aulas = [{"id": f"au{d}", "data": f"2026-03-0{d + 2}", "turma_id": "t1", "turma": {"id": "t1", "nome": "Turma 1"}} for d in range(5)]
+    db.tabelas["aulas"] = aulas
+    db.tabelas["presencas"] = [
+        {"id": f"{aula['id']}-{aluno['id']}", "aula_id": aula["id"], "aluno_id": aluno["id"], "presente": False,
+         "observacao": None, "aluno": aluno,
+         "aula": {"data": aula["data"], "turma_id": "t1", "turma": {"nome": "Turma 1"}}}
+        for aula in aulas for aluno in alunos
+    ]
+
+    faltas = main.tool_consultar_faltas(aluno_nome="joana", data_inicio="2026-03-02", data_fim="2026-03-06",
+                                        _scope={"allowed_turma_ids": None})
+
+    assert len(faltas) == 5
+    assert {f["aluno"]["nome"] for f in faltas} == {"Joana Prado"}
+    # Só as 5 presenças dela, numa única query (sem buscar as aulas antes)
+    assert db.linhas_transferidas == 5
+    assert db.chamadas == [("select", "presencas")]
+
+
+def test_faltas_filtram_periodo_e_escopo_pelo_embed_da_aula(postgrest_http):
+    main.tool_consultar_faltas(data_inicio="2026-03-02", data_fim="2026-03-06",
+                               _scope={"allowed_turma_ids": ["t1", "t2"]})
+
+    (request,) = postgrest_http.requests
+    filtros = postgrest_http.parametros()
+    assert request.url.path.endswith("/presencas")
+    assert ("aula.data", "gte.2026-03-02") in filtros and ("aula.data", "lte.2026-03-06") in filtros
+    assert ("aula.turma_id", "in.(t1,t2)") in filtros
+    assert "aulas!inner(" in dict(filtros)["select"]
+    assert not any(chave == "aula_id" for chave, _ in filtros)
+
+
+def test_filtro_por_nome_ignora_acentos_e_nao_tem_limite(db):
+    db.tabelas["alunos"] = [_com_nome_busca({"id": f"a{i}", "nome": f"João {i}"}) for i in range(120)]
+    db.tabelas["alunos"] += [_com_nome_busca({"id": f"b{i}", "nome": f"Maria {i}"}) for i in range(30)]
+
+    alunos, paginas = _todas_as_paginas(main.tool_consultar_alunos, nome="JOAO")
+
+    # Todos os 120 (a busca por trigramas limitava a 50), uma consulta por página
+    assert sorted(a["id"] for a in alunos) == sorted(f"a{i}" for i in range(120))
+    assert db.chamadas == [("select", "alunos")] * paginas
+
+
+def test_resumo_de_faltas_filtra_aluno_pelo_termo_normalizado(db):
+    recebidos = []
+    db.rpcs["resumo_presencas"] = lambda params: recebidos.append(params) or []
+
+    main.tool_consultar_faltas(aluno_nome=" Conceição ", data_inicio="2026-01-01", data_fim="2026-03-31",
+                               _scope={"allowed_turma_ids": None})
+
+    assert recebidos[0]["p_aluno_busca"] == "conceicao"
+    assert db.chamadas == [("rpc", "resumo_presencas")]
+
+
+def test_listas_paginam_na_query_e_nao_trazem_cpf(db):
+    db.tabelas["alunos"] = [{"id": f"a{i:04d}", "nome": f"Aluno {i}", "cpf": "000.000.000-00"} for i in range(3000)]
+
+    pagina = main.tool_consultar_alunos(_scope={"allowed_turma_ids": None})
+
+    # Só a página (+1 linha para saber se há mais) sai do banco
+    assert db.linhas_transferidas == main.TOOL_PAGE_SIZE + 1
+    assert pagina["total_registros"] == 3000
+    assert pagina["proximo_cursor"] == pagina["itens"][-1]["id"]
+    assert "cpf" not in main.ALUNO_COLUNAS_DETALHE
+
+
+def test_cursor_de_aulas_e_estavel_com_datas_repetidas(db, monkeypatch):
+    monkeypatch.setattr(main, "TOOL_PAGE_SIZE", 4)
+    # 3 aulas por dia: a ordem (data desc, id) separa os empates
+    db.tabelas["aulas"] = [
+        {"id": f"au{d}{k}", "data": f"2026-03-{d:02d}", "turma_id": "t1", "turma": {"nome": "A", "idioma": "ingles"}}
+        for d in range(1, 6) for k in range(3)
+    ]
+
+    aulas, paginas = _todas_as_paginas(main.tool_consultar_aulas)
+
+    assert paginas == 4
+    assert [a["id"] for a in aulas] == [f"au{d}{k}" for d in range(5, 0, -1) for k in range(3)]
+
+
+def test_resumo_de_faltas_pagina_por_aluno_e_turma(db, monkeypatch):
+    monkeypatch.setattr(main, "TOOL_PAGE_SIZE", 3)
+    linhas = [
+        {"aluno_id": f"a{a}", "turma_id": f"t{t}", "faltas": (a + t) % 3, "presencas": 1}
+        for a in range(4) for t in range(2)
+    ]
+    db.rpcs["resumo_presencas"] = lambda params: linhas
+
+    itens, _ = _todas_as_paginas(main.tool_consultar_faltas, resumo=True, data_inicio="2026-01-01", data_fim="2026-01-31")
+
+    assert [(l["aluno_id"], l["turma_id"]) for l in itens] == sorted(
+        (l["aluno_id"], l["turma_id"]) for l in linhas if l["faltas"] > 0
+    )
+
+
+def test_cursor_invalido_vira_erro_da_ferramenta(db):
+    with pytest.raises(ValueError):
+        main.tool_consultar_alunos(cursor="a1,id.neq.0", _scope={"allowed_turma_ids": None})
+
+
+@pytest.mark.parametrize("nome", ["Abel", "Débora", "Fábio", "Carla", "Daniel"])
+def test_filtro_por_nome_chega_inteiro_ao_postgrest(postgrest_http, nome):
+    main.tool_consultar_alunos(nome=nome, _scope={"allowed_turma_ids": None})
+    main.tool_consultar_turmas(nome_turma=nome, professor_nome=nome, _scope={"allowed_turma_ids": None})
+
+    termo = main.normalizar_busca(nome)
+    alunos, turmas = postgrest_http.parametros(0), postgrest_http.parametros(1)
+    # Decodificado como o PostgREST faz: nomes que começam com duas letras hexadecimais
+    # ('%ab', '%de', '%fa', '%ca', '%da') não podem virar um byte
+    assert ("nome_busca", f"like.*{termo}*") in alunos
+    assert ("nome_busca", f"like.*{termo}*") in turmas
+    assert ("professor.nome_busca", f"like.*{termo}*") in turmas
+
+
+def test_curingas_digitados_sao_literais(db):
+    db.tabelas["alunos"] = [_com_nome_busca({"id": i, "nome": nome}) for i, nome in
+                            enumerate(["Ana_Maria", "Ana Maria", "100% Inglês", "1000 Inglês"])]
+
+    assert [a["id"] for a in main.tool_consultar_alunos(nome="ana_", _scope={"allowed_turma_ids": None})] == [0]
+    assert [a["id"] for a in main.tool_consultar_alunos(nome="100%", _scope={"allowed_turma_ids": None})] == [2]
+    assert main.padrao_nome("a*b") == "*a_b*"
+
+
+def test_turmas_do_aluno_escolhe_o_melhor_match_dentro_do_escopo(db):
+    db.tabelas["alunos"] = [{"id": "fora", "nome": "Ana Souza"}, {"id": "dentro", "nome": "Ana Souza Lima"}]
+    db.tabelas["matriculas"] = [
+        {"aluno_id": "fora", "turma_id": "t-outra", "status": "ativo", "turma": {"id": "t-outra", "nome": "Outra"}},
+        {"aluno_id": "dentro", "turma_id": "t1", "status": "ativo", "turma": {"id": "t1", "nome": "Minha"}},
+    ]
+    recebidos = []
+
+    def buscar_por_nome(params):
+        recebidos.append(params)
+        # "Ana Souza" é o match exato na escola inteira; no escopo só existe "Ana Souza Lima"
+        ids = params["p_ids"]
+        candidatos = [a for a in db.tabelas["alunos"] if ids is None or a["id"] in ids]
+        candidatos.sort(key=lambda a: a["nome"] != "Ana Souza")
+        return [{"id": a["id"], "nome": a["nome"], "score": 1.0} for a in candidatos][:params["p_limite"]]
+
+    db.rpcs["buscar_por_nome"] = buscar_por_nome
+
+    resultado = main.tool_consultar_turmas_aluno("Ana Souza", _scope={"allowed_turma_ids": ["t1"]})
+
+    assert recebidos[0]["p_ids"] == ["dentro"]
+    assert resultado["aluno"]["id"] == "dentro"
+    assert [t["id"] for t in resultado["turmas"]] == ["t1"]
+
+
+@pytest.mark.parametrize("ferramenta, kwargs", [
+    (main.tool_consultar_turmas, {"professor_nome": "ana"}),
+    (main.tool_consultar_alunos_turma, {"turma_id": "t1"}),
+    (main.tool_consultar_aulas, {}),
+    (main.tool_consultar_professores, {}),
+])
+def test_ferramentas_pedem_colunas_explicitas(postgrest_http, ferramenta, kwargs):
+    # .single() da turma espera um objeto; as demais consultas, listas
+    postgrest_http.resposta = lambda r: {"id": "t1", "nome": "Turma 1"} if "object" in r.headers.get("accept", "") else []
+    ferramenta(**kwargs, _scope={})
+
+    selects = [dict(postgrest_http.parametros(i)).get("select", "") for i in range(len(postgrest_http.requests))]
+    assert selects and all(s and "*" not in s for s in selects)
+
+
+def test_estatisticas_gerais_em_uma_chamada_agregada(db):
+    recebidos = []
+    db.rpcs["estatisticas_escola"] = lambda params: recebidos.append(params) or {"total_turmas": 2, "total_alunos": 7}
+
+    assert main.tool_estatisticas_gerais(_scope={"allowed_turma_ids": None}) == {"total_turmas": 2, "total_alunos": 7}
+    restrito = main.tool_estatisticas_gerais(_scope={"allowed_turma_ids": ["t1", "t2"]})
+    assert restrito["total_alunos"] == 7 and restrito["escopo"].startswith("restrito")
+    # Sem turmas no escopo, nem vai ao banco
+    assert main.tool_estatisticas_gerais(_scope={"allowed_turma_ids": []})["total_alunos"] == 0
+
+    assert db.chamadas == [("rpc", "estatisticas_escola")] * 2
+    assert recebidos == [{"p_turma_ids": None}, {"p_turma_ids": ["t1", "t2"]}]
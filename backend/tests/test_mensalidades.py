@@ -0,0 +1,252 @@
+import asyncio
+import json
+import os
+import time
+
+import httpx
+import pytest
+
+import main
+
+
+class FakeCora:
+    """API de invoices da Cora: mesma Idempotency-Key devolve a mesma invoice"""
+
+    def __init__(self):
+        self.posts = 0
+        self.invoices = {}  # Idempotency-Key -> invoice
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        assert request.url.path == "/v2/invoices/"
+        self.posts += 1
+        chave = request.headers["Idempotency-Key"]
+        if chave not in self.invoices:
+            corpo = json.loads(request.content)
+            self.invoices[chave] = {
+                "id": f"inv_{len(self.invoices) + 1}",
+                "code": corpo["code"],
+                "payment_options": {"bank_slip": {"url": "https://boleto", "digitable": "123"}},
+                "pix": {"emv": "000201"},
+            }
+        return httpx.Response(200, json=self.invoices[chave])
+
+
+@pytest.fixture
+def cora(monkeypatch):
+    fake = FakeCora()
+    monkeypatch.setattr(main, "CORA_CLIENT_ID", "cliente")
+    monkeypatch.setattr(main, "CORA_CERT_B64", "cert")
+    monkeypatch.setattr(main, "CORA_KEY_B64", "chave")
+    monkeypatch.setattr(main, "_cora_config_erro", None)
+    monkeypatch.setattr(main, "_cora_token_cache", {"token": "tok", "expires_at": time.time() + 3600})
+    monkeypatch.setattr(main, "cora_rate_limiter", main.TokenBucket(10_000, 10_000))
+    monkeypatch.setattr(main, "_http_clients", {
+        "cora": httpx.AsyncClient(transport=httpx.MockTransport(fake), base_url="https://cora.teste"),
+    })
+    return fake
+
+
+def _cobranca(i):
+    return {"aluno_id": f"a{i}", "cora_invoice_id": f"inv_{i}", "valor": 10000, "vencimento": "2026-11-10", "status": "aberto"}
+
+
+def _falhar_lote_e_aluno(aluno_id):
+    """Falha todo insert em lote e o insert individual do aluno informado"""
+    def falhar(query):
+        if query.tabela != "cobrancas" or query.operacao != "insert":
+            return False
+        return isinstance(query.payload, list) or query.payload["aluno_id"] == aluno_id
+    return falhar
+
+
+def test_lote_com_falha_e_salvo_linha_a_linha(db):
+    db.falhar = _falhar_lote_e_aluno("a3")
+
+    falhas = main.salvar_cobrancas([_cobranca(i) for i in range(5)])
+
+    assert sorted(c["aluno_id"] for c in db.tabelas["cobrancas"]) == ["a0", "a1", "a2", "a4"]
+    assert [(f["aluno_id"], f["cora_invoice_id"]) for f in falhas] == [("a3", "inv_3")]
+    assert "falha simulada" in falhas[0]["erro"]
+
+
+def test_boleto_nao_salvo_vira_falha_no_resultado_do_lote(db, monkeypatch):
+    db.falhar = _falhar_lote_e_aluno("a1")
+
+    async def emitir_boleto(aluno, referencia=None):
+        return _cobranca(aluno["id"][1:])
+    monkeypatch.setattr(main, "emitir_boleto", emitir_boleto)
+
+    alunos = [{"id": f"a{i}", "nome": f"Aluno {i}"} for i in range(3)]
+    progresso = {"gerados": 0, "falhas": 0}
+    resultado = asyncio.run(main.gerar_boletos_em_lote(alunos, progresso=progresso))
+
+    assert sorted(g["aluno_id"] for g in resultado["gerados"]) == ["a0", "a2"]
+    assert [(e["aluno_id"], e["nome"]) for e in resultado["erros"]] == [("a1", "Aluno 1")]
+    assert "não salvo" in resultado["erros"][0]["erro"]
+    assert progresso == {"gerados": 2, "falhas": 1}
+
+
+def test_carga_do_job_passa_do_limite_de_1000_linhas(db):
+    db.tabelas["alunos"] = [
+        {"id": f"a{i:05d}", "nome": f"Aluno {i}", "status_pedagogico": "ativo", "valor_mensalidade": 300, "dia_vencimento": 10}
+        for i in range(2500)
+    ]
+    db.tabelas["alunos"].append({"id": "sem-valor", "nome": "X", "status_pedagogico": "ativo", "valor_mensalidade": None})
+    referencia = main.date(2026, 11, 1)
+    db.tabelas["cobrancas"] = [
+        {"id": f"c{i}", "aluno_id": f"a{i:05d}", "vencimento": "2026-11-10", "status": "aberto"} for i in range(1200)
+    ]
+
+    alunos = main.carregar_alunos_mensalidade()
+    pendentes = main.filtrar_alunos_ja_cobrados(alunos, referencia)
+
+    assert len(alunos) == 2500
+    assert [a["id"] for a in pendentes] == [f"a{i:05d}" for i in range(1200, 2500)]
+    assert db.chamadas == [("select", "alunos")] * 3 + [("select", "cobrancas")] * 2
+
+
+class ViolacaoUnica(Exception):
+    code = "23505"
+
+
+def test_cobranca_ja_salva_nao_conta_como_falha(db):
+    # a1 já tem cobrança no vencimento: o lote e a linha dele violam o índice único
+    def falhar(query):
+        if isinstance(query.payload, list) or query.payload["aluno_id"] == "a1":
+            raise ViolacaoUnica("duplicate key value violates unique constraint")
+        return False
+    db.falhar = falhar
+
+    falhas = main.salvar_cobrancas([_cobranca(0), _cobranca(1)])
+
+    assert falhas == []
+    assert [c["aluno_id"] for c in db.tabelas["cobrancas"]] == ["a0"]
+
+
+def _alunos_ativos(db, n):
+    # Ids com o mesmo prefixo de 8 caracteres: o code não pode colidir entre eles
+    db.tabelas["alunos"] = [
+        {"id": f"00000000-0000-0000-0000-{i:012d}", "nome": f"Aluno {i}", "cpf": "123.456.789-00",
+         "status_pedagogico": "ativo", "valor_mensalidade": 300, "desconto": 0, "dia_vencimento": 10}
+        for i in range(n)
+    ]
+
+
+def _rodar_job(referencia="2026-11-01"):
+    job = {"id": "job-1", "parametros": {"referencia": referencia}}
+    progresso = {"total": 0, "gerados": 0, "falhas": 0, "erros": []}
+    asyncio.run(main._executar_job_mensalidades(job, progresso))
+    return progresso
+
+
+def test_rodar_o_job_duas_vezes_nao_duplica_boletos(db, cora):
+    _alunos_ativos(db, 30)
+
+    primeira = _rodar_job()
+    segunda = _rodar_job()
+
+    assert primeira["gerados"] == 30 and primeira["falhas"] == 0
+    assert segunda["gerados"] == 30 and segunda["falhas"] == 0
+    # A segunda execução pula todos pela pré-checagem em cobrancas
+    assert cora.posts == 30
+    assert len(cora.invoices) == 30
+    chaves = [(c["aluno_id"], c["vencimento"]) for c in db.tabelas["cobrancas"]]
+    assert len(chaves) == len(set(chaves)) == 30
+
+
+def test_job_interrompido_retoma_sem_duplicar_na_cora(db, cora):
+    _alunos_ativos(db, 10)
+    # Primeira execução: a Cora emite, mas o banco recusa salvar três cobranças
+    perdidos = {f"00000000-0000-0000-0000-{i:012d}" for i in (2, 5, 7)}
+    db.falhar = lambda q: q.tabela == "cobrancas" and q.operacao == "insert" and (
+        isinstance(q.payload, list) or q.payload["aluno_id"] in perdidos
+    )
+
+    primeira = _rodar_job()
+    db.falhar = None
+    segunda = _rodar_job()
+
+    assert primeira["falhas"] == 3
+    assert segunda["gerados"] == 10 and segunda["falhas"] == 0
+    # Os três são reenviados com a mesma Idempotency-Key e recebem a mesma invoice
+    assert cora.posts == 13
+    assert len(cora.invoices) == 10
+    assert sorted(c["cora_invoice_id"] for c in db.tabelas["cobrancas"]) == sorted(i["id"] for i in cora.invoices.values())
+
+
+def test_gerar_boleto_avulso_reaproveita_cobranca_existente(db, cora):
+    _alunos_ativos(db, 1)
+    aluno_id = db.tabelas["alunos"][0]["id"]
+
+    async def chamar():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://teste") as client:
+            corpo = {"aluno_id": aluno_id, "vencimento": "2026-11-10"}
+            return [(await client.post("/cora/gerar-boleto", json=corpo)).json() for _ in range(2)]
+
+    primeira, segunda = asyncio.run(chamar())
+
+    assert primeira["invoice_id"] == segunda["invoice_id"]
+    assert segunda["existente"] is True
+    assert cora.posts == 1
+    assert list(cora.invoices.values())[0]["code"] == f"EDLNG-{aluno_id}-2026-11-10"
+
+
+class FakeCoraLenta(FakeCora):
+    """Cora local com latência por request; mede quantos POSTs ficaram em voo ao mesmo tempo"""
+
+    def __init__(self, latencia: float):
+        super().__init__()
+        self.latencia = latencia
+        self.em_voo = 0
+        self.pico = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.em_voo += 1
+        self.pico = max(self.pico, self.em_voo)
+        try:
+            await asyncio.sleep(self.latencia)
+            return super().__call__(request)
+        finally:
+            self.em_voo -= 1
+
+
+# Ajustável por ambiente para rodar como benchmark (ex.: CORA_BENCH_ALUNOS=1500 python -m pytest -s -k benchmark)
+BENCH_ALUNOS = int(os.getenv("CORA_BENCH_ALUNOS", "60"))
+
+
+@pytest.mark.parametrize("concorrencia, latencia, taxa", [
+    (1, 0.005, None),
+    (4, 0.02, None),
+    (16, 0.02, None),
+    (8, 0.001, 200.0),
+])
+def test_benchmark_geracao_em_lote_respeita_concorrencia_e_taxa(db, cora, monkeypatch, concorrencia, latencia, taxa):
+    lenta = FakeCoraLenta(latencia)
+    monkeypatch.setattr(main, "_http_clients", {
+        "cora": httpx.AsyncClient(transport=httpx.MockTransport(lenta), base_url="https://cora.teste"),
+    })
+    monkeypatch.setattr(main, "CORA_BATCH_CONCURRENCY", concorrencia)
+    rajada = 10
+    if taxa:
+        monkeypatch.setattr(main, "cora_rate_limiter", main.TokenBucket(taxa, rajada))
+    _alunos_ativos(db, BENCH_ALUNOS)
+
+    inicio = time.perf_counter()
+    resultado = asyncio.run(main.gerar_boletos_em_lote(db.tabelas["alunos"], referencia=main.date(2026, 11, 1)))
+    decorrido = time.perf_counter() - inicio
+    print(f"\n{BENCH_ALUNOS} boletos, concorrência {concorrencia}, latência {latencia * 1000:.0f}ms, "
+          f"taxa {taxa or '∞'}/s: {decorrido:.2f}s ({BENCH_ALUNOS / decorrido:.0f} boletos/s)")
+
+    assert len(resultado["gerados"]) == BENCH_ALUNOS and resultado["erros"] == []
+    assert lenta.posts == BENCH_ALUNOS
+    # Nunca passa do limite, e com alunos suficientes chega nele
+    assert lenta.pico == min(concorrencia, BENCH_ALUNOS)
+    # Tempo limitado por baixo pelas "ondas" de requests e, se houver, pela taxa do token bucket
+    ondas = -(-BENCH_ALUNOS // concorrencia)
+    assert decorrido >= ondas * latencia * 0.9
+    if taxa:
+        assert decorrido >= (BENCH_ALUNOS - rajada) / taxa * 0.9
+    elif concorrencia > 1:
+        # E a concorrência de fato paraleliza: bem abaixo do tempo em série
+        assert decorrido < BENCH_ALUNOS * latencia / 2
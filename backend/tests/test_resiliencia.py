@@ -0,0 +1,121 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def _dependencia(**kwargs):
+    opcoes = {"max_tentativas": 3, "backoff_base": 0.001, "falhas_para_abrir": 2, "reset_seconds": 0.05}
+    opcoes.update(kwargs)
+    return main.Dependencia("Teste", 1.0, **opcoes)
+
+
+def test_5xx_em_chamada_nao_idempotente_conta_como_falha():
+    dep = _dependencia()
+    chamadas = []
+
+    async def post(timeout):
+        chamadas.append(timeout)
+        return httpx.Response(502)
+
+    async def rodar():
+        for _ in range(2):
+            resposta = await dep.executar(post, idempotente=False)
+            assert resposta.status_code == 502
+        with pytest.raises(HTTPException):
+            await dep.executar(post, idempotente=False)
+
+    asyncio.run(rodar())
+    # Sem retry (POST sem chave), mas duas falhas seguidas abrem o circuito
+    assert len(chamadas) == 2
+    assert dep.estado == "aberto"
+    assert dep.contadores["falhas"] == 2 and dep.contadores["sucessos"] == 0
+
+
+def test_meio_aberto_deixa_passar_uma_unica_sonda():
+    dep = _dependencia()
+    dep.estado, dep.aberto_em = "aberto", 0.0
+
+    async def rodar():
+        sinal = asyncio.Event()
+        chamadas = []
+
+        async def lenta(timeout):
+            chamadas.append(1)
+            await sinal.wait()
+            return httpx.Response(200)
+
+        sonda = asyncio.create_task(dep.executar(lenta))
+        await asyncio.sleep(0)
+        # Enquanto a sonda não termina, as demais falham rápido
+        for _ in range(5):
+            with pytest.raises(HTTPException) as erro:
+                await dep.executar(lenta)
+            assert erro.value.status_code == 503
+        sinal.set()
+        assert (await sonda).status_code == 200
+        # Sonda bem-sucedida fecha o circuito
+        assert (await asyncio.gather(*(dep.executar(lenta) for _ in range(3))))[0].status_code == 200
+        return chamadas
+
+    assert len(asyncio.run(rodar())) == 4
+    assert dep.estado == "fechado"
+    assert dep.contadores["rejeitadas"] == 5
+
+
+def test_sonda_que_falha_reabre_e_libera_a_proxima():
+    dep = _dependencia(reset_seconds=0.01)
+    dep.estado, dep.aberto_em = "aberto", 0.0
+
+    async def fora(timeout):
+        raise httpx.ConnectError("recusada")
+
+    async def ok(timeout):
+        return httpx.Response(200)
+
+    async def rodar():
+        with pytest.raises(httpx.ConnectError):
+            await dep.executar(fora)
+        assert dep.estado == "aberto"
+        with pytest.raises(HTTPException):
+            await dep.executar(ok)
+        await asyncio.sleep(0.02)
+        return await dep.executar(ok)
+
+    assert asyncio.run(rodar()).status_code == 200
+    assert dep.estado == "fechado" and dep.sonda_em_andamento is False
+
+
+def test_erro_nao_transitorio_na_sonda_nao_trava_o_meio_aberto():
+    dep = _dependencia()
+    dep.estado, dep.aberto_em = "aberto", 0.0
+
+    async def invalida(timeout):
+        raise ValueError("payload inválido")
+
+    async def rodar():
+        with pytest.raises(ValueError):
+            await dep.executar(invalida)
+        return await dep.executar(lambda timeout: asyncio.sleep(0, httpx.Response(200)))
+
+    assert asyncio.run(rodar()).status_code == 200
+
+
+def test_chat_com_openai_em_circuito_aberto_responde_503(monkeypatch):
+    dep = _dependencia(reset_seconds=60)
+    dep.estado, dep.aberto_em = "aberto", main.time.monotonic()
+    monkeypatch.setattr(main, "openai_dependencia", dep)
+    monkeypatch.setattr(main, "chat_cache", main.ChatCache(main.CHAT_CACHE_MAX_ENTRIES))
+
+    async def rodar():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://teste") as cliente:
+            return await cliente.post("/chat", json={"message": "quantos alunos?"})
+
+    resposta = asyncio.run(rodar())
+    # Fail-fast do breaker, não um 500 genérico
+    assert resposta.status_code == 503
+    assert dep.contadores["rejeitadas"] == 1
@@ -0,0 +1,157 @@
+import asyncio
+import random
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture
+def ingestao(monkeypatch, db):
+    """Dedup e diretório novos; sem fila, cada mensagem da UAZAPI é gravada na hora"""
+    monkeypatch.setattr(main, "dedup_webhooks", main.DedupEventos(main.WEBHOOK_DEDUP_LRU_SIZE))
+    monkeypatch.setattr(main, "diretorio_telefones", main.DiretorioTelefones())
+    monkeypatch.setattr(main, "_webhook_fila", None)
+    monkeypatch.setattr(main, "print", lambda *a, **k: None, raising=False)
+    db.tabelas["alunos"] = []
+    return db
+
+
+def _cobranca(i, status="aberto"):
+    return {"id": f"cob-{i}", "aluno_id": f"aluno-{i}", "cora_invoice_id": f"inv_{i}", "status": status}
+
+
+def _enviar(eventos):
+    async def rodar():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://teste") as cliente:
+            return [await cliente.post(url, **kwargs) for url, kwargs in eventos]
+
+    return asyncio.run(rodar())
+
+
+def _evento_cora(i, status="PAID", com_id=True):
+    headers = {"webhook-event-id": f"ev{i}"} if com_id else {}
+    return "/cora/webhook", {"json": {"id": f"inv_{i}", "status": status}, "headers": headers}
+
+
+def _evento_uazapi(i):
+    return "/whatsapp/webhook", {"json": {"event": "message", "data": {
+        "id": f"m{i}", "from": "5511988887777@s.whatsapp.net", "body": f"mensagem {i}",
+        "messageTimestamp": 1767261600 + i,
+    }}}
+
+
+def test_replay_de_10k_eventos_com_30_por_cento_duplicados(ingestao):
+    db = ingestao
+    unicos = [_evento_cora(i) if i % 2 else _evento_uazapi(i) for i in range(7000)]
+    db.tabelas["cobrancas"] = [_cobranca(i) for i in range(1, 7000, 2)]
+    aleatorio = random.Random(20)
+    eventos = unicos + aleatorio.sample(unicos, 3000)
+    aleatorio.shuffle(eventos)
+
+    async def rodar():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://teste") as cliente:
+            duplicados, idas_em_duplicados = 0, 0
+            for url, kwargs in eventos:
+                antes = len(db.chamadas)
+                resposta = await cliente.post(url, **kwargs)
+                assert resposta.status_code == 200
+                if resposta.json().get("duplicado"):
+                    duplicados += 1
+                    idas_em_duplicados += len(db.chamadas) - antes
+            return duplicados, idas_em_duplicados
+
+    duplicados, idas_em_duplicados = asyncio.run(rodar())
+
+    # Toda redelivery é rejeitada pelo LRU, sem nenhuma ida ao banco
+    assert duplicados == 3000
+    assert idas_em_duplicados == 0
+    # Cada evento único foi aplicado exatamente uma vez
+    assert db.chamadas.count(("update", "cobrancas")) == 3500
+    assert all(c["status"] == "pago" for c in db.tabelas["cobrancas"])
+    assert len(db.tabelas["webhook_eventos"]) == 3500
+    mensagens = db.tabelas["whatsapp_mensagens"]
+    assert len(mensagens) == 3500 and len({m["message_id"] for m in mensagens}) == 3500
+
+
+def test_evento_de_boleto_ainda_nao_gravado_pede_reenvio(ingestao):
+    db = ingestao
+    # Webhook antes da cobrança existir: 503 para a Cora reenviar, e nada fica registrado
+    assert _enviar([_evento_cora(1)])[0].status_code == 503
+    assert db.tabelas["webhook_eventos"] == []
+
+    db.tabelas["cobrancas"] = [_cobranca(1)]
+    resposta = _enviar([_evento_cora(1)])[0]
+    assert resposta.status_code == 200 and resposta.json() == {"status": "ok"}
+    assert db.tabelas["cobrancas"][0]["status"] == "pago"
+    assert [e["event_id"] for e in db.tabelas["webhook_eventos"]] == ["ev1"]
+
+
+def test_evento_atrasado_sem_efeito_e_confirmado(ingestao):
+    db = ingestao
+    db.tabelas["cobrancas"] = [_cobranca(1, status="pago")]
+    # OPEN depois de PAID não muda nada, mas é uma entrega válida: 200 e registrado
+    assert _enviar([_evento_cora(1, "OPEN")])[0].status_code == 200
+    assert db.tabelas["cobrancas"][0]["status"] == "pago"
+    assert [e["event_id"] for e in db.tabelas["webhook_eventos"]] == ["ev1"]
+
+
+def test_falha_ao_aplicar_responde_503_e_libera_o_evento(ingestao):
+    db = ingestao
+    db.tabelas["cobrancas"] = [_cobranca(1)]
+    db.falhar = lambda q: q.tabela == "cobrancas"
+    assert _enviar([_evento_cora(1)])[0].status_code == 503
+    assert db.tabelas["webhook_eventos"] == []
+
+    db.falhar = None
+    assert _enviar([_evento_cora(1)])[0].status_code == 200
+    assert db.tabelas["cobrancas"][0]["status"] == "pago"
+
+
+def test_copia_concorrente_nao_e_confirmada_antes_da_primeira_terminar(ingestao):
+    db = ingestao
+    db.tabelas["cobrancas"] = [_cobranca(1)]
+    falhas = [True]
+
+    def falhar_a_primeira(query):
+        # A primeira tentativa de aplicar falha; a cópia que esperava precisa aplicar de novo
+        if query.tabela == "cobrancas" and query.operacao == "update" and falhas:
+            falhas.pop()
+            return True
+        return False
+
+    db.falhar = falhar_a_primeira
+
+    async def rodar():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://teste") as cliente:
+            url, kwargs = _evento_cora(1)
+            return await asyncio.gather(cliente.post(url, **kwargs), cliente.post(url, **kwargs))
+
+    respostas = asyncio.run(rodar())
+
+    assert sorted(r.status_code for r in respostas) == [200, 503]
+    assert not any(r.status_code == 200 and r.json().get("duplicado") for r in respostas)
+    assert db.tabelas["cobrancas"][0]["status"] == "pago"
+    assert [e["event_id"] for e in db.tabelas["webhook_eventos"]] == ["ev1"]
+
+
+def test_chave_sem_event_id_expira_com_a_janela(ingestao, monkeypatch):
+    db = ingestao
+    db.tabelas["cobrancas"] = [_cobranca(1)]
+    agora = [1_000_000.0]
+    monkeypatch.setattr(main.time, "time", lambda: agora[0])
+
+    respostas = _enviar([_evento_cora(1, "OVERDUE", com_id=False)] * 2)
+    assert [r.json().get("duplicado") for r in respostas] == [None, True]
+    assert db.tabelas["cobrancas"][0]["status"] == "vencido"
+
+    # Boleto reaberto e vencido de novo dias depois: a mesma transição volta a valer
+    db.tabelas["cobrancas"][0]["status"] = "aberto"
+    agora[0] += main.CORA_DEDUP_JANELA_SECONDS
+    assert _enviar([_evento_cora(1, "OVERDUE", com_id=False)])[0].json() == {"status": "ok"}
+    assert db.tabelas["cobrancas"][0]["status"] == "vencido"
+    assert len(db.tabelas["webhook_eventos"]) == 2
@@ -0,0 +1,288 @@
+import asyncio
+import json
+import os
+import time
+
+import httpx
+import pytest
+
+import main
+
+
+def _aluno(i, telefone):
+    """Linha de alunos com as colunas geradas telefone_digits/telefone_sufixo do supabase-setup.sql"""
+    digitos = main.normalizar_telefone(telefone)
+    return {
+        "id": f"aluno-{i}", "nome": f"Aluno {i}", "telefone": telefone, "email": None,
+        "status_pedagogico": "ativo", "updated_at": "2026-01-01T00:00:00+00:00",
+        "telefone_digits": digitos, "telefone_sufixo": digitos[-10:],
+    }
+
+
+def _alunos(n):
+    return [_aluno(i, f"(11) 9{i:08d}") for i in range(n)]
+
+
+@pytest.fixture
+def diretorio(monkeypatch):
+    novo = main.DiretorioTelefones()
+    monkeypatch.setattr(main, "diretorio_telefones", novo)
+    return novo
+
+
+def _melhor_tempo_por_consulta(diretorio, telefones, rodadas=3):
+    melhor = float("inf")
+    for _ in range(rodadas):
+        inicio = time.perf_counter()
+        for telefone in telefones:
+            assert diretorio.por_telefone(telefone) is not None
+        melhor = min(melhor, (time.perf_counter() - inicio) / len(telefones))
+    return melhor
+
+
+def test_custo_por_mensagem_constante_com_50k_alunos(db, diretorio):
+    telefones = [f"55119{i:08d}@s.whatsapp.net" for i in range(0, 500, 5)] * 50
+
+    db.tabelas["alunos"] = _alunos(500)
+    diretorio.atualizar(forcar=True)
+    pequeno = _melhor_tempo_por_consulta(diretorio, telefones)
+
+    db.tabelas["alunos"] = _alunos(50_000)
+    diretorio.atualizar(forcar=True)
+    assert diretorio.completo and len(diretorio._por_id) == 50_000
+    grande = _melhor_tempo_por_consulta(diretorio, telefones)
+
+    # Dicionário por sufixo: 100x mais alunos não muda o custo por mensagem
+    assert grande < pequeno * 3
+
+    # E nenhuma mensagem vai ao banco enquanto o diretório está fresco
+    db.zerar_contadores()
+
+    async def rodar():
+        for telefone in telefones[:200]:
+            assert await main.aluno_por_telefone(telefone) is not None
+
+    asyncio.run(rodar())
+    assert db.chamadas == []
+
+
+def test_lote_de_webhooks_faz_um_unico_insert(db, diretorio):
+    db.tabelas["alunos"] = _alunos(50_000)
+    diretorio.atualizar(forcar=True)
+    db.zerar_contadores()
+
+    mensagens = [
+        {"message_id": f"m{i}", "phone": f"55119{i:08d}", "message": "oi", "direction": "incoming",
+         "timestamp": "2026-01-01T10:00:00+00:00"}
+        for i in range(0, 50_000, 250)
+    ]
+    main._inserir_mensagens(mensagens)
+
+    assert db.chamadas == [("upsert", "whatsapp_mensagens")]
+    gravadas = db.tabelas["whatsapp_mensagens"]
+    assert all(m["aluno_id"] == f"aluno-{int(m['phone'][-8:])}" for m in gravadas)
+
+
+def test_telefone_cadastrado_sem_ddd(db, diretorio):
+    db.tabelas["alunos"] = [_aluno(1, "8765-4321"), _aluno(2, "98765-1234")]
+    diretorio.atualizar(forcar=True)
+
+    # Recebido completo, cadastro com 8 ou 9 dígitos: o cadastro é o final do recebido
+    assert diretorio.por_telefone("551187654321")["id"] == "aluno-1"
+    assert diretorio.por_telefone("5511987651234@s.whatsapp.net")["id"] == "aluno-2"
+    assert main.buscar_aluno_por_telefone("551187654321")["id"] == "aluno-1"
+    assert main.buscar_aluno_por_telefone("5511987651234")["id"] == "aluno-2"
+
+
+def test_telefone_recebido_sem_ddd_cai_no_banco(db, diretorio):
+    db.tabelas["alunos"] = [_aluno(1, "+55 (11) 98765-4321")]
+    diretorio.atualizar(forcar=True)
+    db.zerar_contadores()
+
+    assert diretorio.por_telefone("987654321") is None
+    assert not diretorio.cobre("987654321")
+
+    async def rodar():
+        return await main.aluno_por_telefone("987654321")
+
+    assert asyncio.run(rodar())["id"] == "aluno-1"
+    assert db.chamadas == [("select", "alunos")]
+
+
+def test_telefone_curto_demais_nao_vincula(db, diretorio):
+    db.tabelas["alunos"] = [_aluno(1, "4321"), _aluno(2, "(11) 98765-4321")]
+    diretorio.atualizar(forcar=True)
+
+    assert diretorio.por_telefone("5511900004321") is None
+    assert main.buscar_aluno_por_telefone("4321") is None
+    assert main.buscar_aluno_por_telefone("1234567") is None
+
+
+def test_troca_de_telefone_nao_desvincula_irmao(db, diretorio):
+    irmaos = [_aluno(1, "(11) 98765-4321"), _aluno(2, "(11) 98765-4321")]
+    db.tabelas["alunos"] = irmaos
+    diretorio.atualizar(forcar=True)
+    assert diretorio.por_telefone("5511987654321")["id"] == "aluno-1"
+
+    # Aluno 1 troca de telefone: o 2 continua vinculado ao número compartilhado
+    irmaos[0].update(_aluno(1, "(21) 91111-2222"), updated_at="2026-01-02T00:00:00+00:00")
+    diretorio.atualizar(forcar=True)
+
+    assert diretorio.por_telefone("5511987654321")["id"] == "aluno-2"
+    assert diretorio.por_telefone("5521911112222")["id"] == "aluno-1"
+
+    # Sem ninguém no número antigo, o grupo some
+    irmaos[1].update(_aluno(2, "(31) 93333-4444"), updated_at="2026-01-03T00:00:00+00:00")
+    diretorio.atualizar(forcar=True)
+    assert diretorio.por_telefone("5511987654321") is None
+    assert "1187654321" not in diretorio._por_sufixo
+
+
+def _webhook(payload):
+    async def rodar():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://teste") as cliente:
+            return await cliente.post("/whatsapp/webhook", json=payload)
+
+    return asyncio.run(rodar())
+
+
+def test_webhook_malformado_responde_4xx_ou_ok(monkeypatch):
+    enfileiradas = []
+
+    async def enfileirar(mensagem):
+        enfileiradas.append(mensagem)
+
+    monkeypatch.setattr(main, "enfileirar_mensagem", enfileirar)
+
+    for data in ("texto", ["lista"], 42):
+        resposta = _webhook({"event": "message", "data": data})
+        assert resposta.status_code == 400
+    assert _webhook(["não", "é", "objeto"]).status_code == 422
+
+    # key que não é objeto: sem id, mas a mensagem segue (id derivado do timestamp)
+    resposta = _webhook({"event": "message", "data": {
+        "from": "5511987654321@s.whatsapp.net", "body": "oi", "key": "abc", "messageTimestamp": 1767261600,
+    }})
+    assert resposta.status_code == 200 and resposta.json() == {"status": "ok"}
+    assert len(enfileiradas) == 1 and enfileiradas[0]["phone"] == "5511987654321"
+
+    # Timestamp absurdo não derruba o endpoint
+    resposta = _webhook({"event": "message", "data": {"from": "5511987654321", "body": "oi", "t": 1e30}})
+    assert resposta.status_code == 200 and len(enfileiradas) == 2
+
+
+def test_flusher_sobrevive_a_falha_do_disco(monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_FLUSH_INTERVAL_SECONDS", 0.01)
+    monkeypatch.setattr(main, "_webhook_tasks", [])
+    gravadas, spills = [], []
+
+    def inserir(mensagens):
+        if mensagens[0]["message_id"] == "falha":
+            raise RuntimeError("banco fora")
+        gravadas.extend(mensagens)
+
+    def spill(mensagens):
+        spills.append(mensagens)
+        raise OSError("disco cheio")
+
+    monkeypatch.setattr(main, "_inserir_mensagens", inserir)
+    monkeypatch.setattr(main, "_spill_para_disco", spill)
+
+    async def rodar():
+        main.iniciar_ingestao_webhooks()
+        try:
+            await main.enfileirar_mensagem({"message_id": "falha", "phone": "1"})
+            await asyncio.sleep(0.1)
+            await main.enfileirar_mensagem({"message_id": "depois", "phone": "2"})
+            await asyncio.wait_for(main._webhook_fila.join(), timeout=2)
+        finally:
+            await main.parar_ingestao_webhooks()
+
+    asyncio.run(rodar())
+    assert len(spills) == 1
+    assert [m["message_id"] for m in gravadas] == ["depois"]
+
+
+def test_reenvio_interrompido_volta_para_o_disco_na_partida(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "WEBHOOK_SPILL_DIR", str(tmp_path))
+    processo_morto = 2 ** 22 + 1  # acima do pid_max padrão
+    (tmp_path / f"1-1-a.jsonl.{processo_morto}.reenviando").write_text('{"message_id": "a"}\n')
+    (tmp_path / f"2-1-b.jsonl.{os.getpid()}.reenviando").write_text('{"message_id": "b"}\n')
+    vivo = tmp_path / f"3-1-c.jsonl.{os.getppid()}.reenviando"
+    vivo.write_text('{"message_id": "c"}\n')
+
+    assert main._recuperar_reenvios_orfaos() == 2
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(["1-1-a.jsonl", "2-1-b.jsonl", vivo.name])
+
+
+def test_busca_sem_ddd_chega_inteira_ao_postgrest(postgrest_http):
+    main.buscar_aluno_por_telefone("987654321")
+
+    filtros = postgrest_http.parametros()
+    assert ("telefone_digits", "like.*987654321") in filtros
+    assert "%98" not in str(postgrest_http.requests[-1].url)
+
+
+@pytest.fixture
+def spill(monkeypatch, tmp_path, db, diretorio):
+    monkeypatch.setattr(main, "WEBHOOK_SPILL_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "print", lambda *a, **k: None, raising=False)
+    db.tabelas["alunos"] = []
+    return tmp_path
+
+
+def _arquivo(diretorio, nome, ids):
+    main._gravar_jsonl(str(diretorio / nome), [
+        {"message_id": i, "phone": "5511987654321", "message": "oi", "direction": "incoming"} for i in ids
+    ])
+
+
+def _recusar_envenenada(query):
+    """O banco recusa qualquer insert que contenha a mensagem 'veneno' (ex.: violação de constraint)"""
+    return query.operacao == "upsert" and any(m["message_id"] == "veneno" for m in query.payload)
+
+
+def test_arquivo_envenenado_nao_trava_os_seguintes(db, spill):
+    _arquivo(spill, "1-1-a.jsonl", ["a1", "veneno", "a2"])
+    _arquivo(spill, "2-1-b.jsonl", ["b1", "b2"])
+    db.falhar = _recusar_envenenada
+
+    assert main._reenviar_spill() == 4
+    gravadas = {m["message_id"] for m in db.tabelas["whatsapp_mensagens"]}
+    assert gravadas == {"a1", "a2", "b1", "b2"}
+
+    # Só a linha recusada volta ao disco, no mesmo arquivo, com a tentativa contada
+    assert sorted(p.name for p in spill.iterdir()) == ["1-1-a.jsonl"]
+    restante = [json.loads(linha) for linha in (spill / "1-1-a.jsonl").read_text().splitlines()]
+    assert [(m["message_id"], m["_tentativas"]) for m in restante] == [("veneno", 1)]
+
+
+def test_linha_recusada_vai_para_quarentena_apos_n_tentativas(db, spill, monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_SPILL_MAX_TENTATIVAS", 3)
+    _arquivo(spill, "1-1-a.jsonl", ["veneno"])
+    db.falhar = _recusar_envenenada
+
+    for _ in range(3):
+        assert main._reenviar_spill() == 0
+    assert [p.name for p in spill.iterdir()] == ["quarentena"]
+    (linha,) = (spill / "quarentena" / "1-1-a.jsonl").read_text().splitlines()
+    assert json.loads(linha)["_tentativas"] == 3
+    # Quarentena não é reenviada nem conta como pendente
+    assert main._reenviar_spill() == 0
+    assert asyncio.run(main.health_webhooks())["arquivos_em_disco"] == 0
+    # Colunas de controle nunca chegam ao banco
+    db.falhar = None
+    _arquivo(spill, "2-1-b.jsonl", ["b1"])
+    main._reenviar_spill()
+    assert all("_tentativas" not in m for m in db.tabelas["whatsapp_mensagens"])
+
+
+def test_banco_fora_devolve_os_arquivos_intactos(db, spill):
+    _arquivo(spill, "1-1-a.jsonl", ["a1"])
+    _arquivo(spill, "2-1-b.jsonl", ["b1"])
+    antes = {p.name: p.read_text() for p in spill.iterdir()}
+    db.falhar = lambda q: q.tabela == "whatsapp_mensagens"
+
+    assert main._reenviar_spill() == 0
+    assert {p.name: p.read_text() for p in spill.iterdir()} == antes
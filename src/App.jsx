@@ -14,6 +14,11 @@ const supabaseKey = import.meta.env.VITE_SUPABASE_ANON_KEY || 'SUA_CHAVE_ANON'
 const API_URL = import.meta.env.VITE_ASSISTANT_API_URL || 'http://localhost:8000'
 const supabase = createClient(supabaseUrl, supabaseKey)
 
+// Avisa o backend que tabelas foram alteradas direto no Supabase (invalida caches)
+function notifyDataChange(tables, usuario) {
+  return fetch(`${API_URL}/cache/invalidate`, { method: 'POST', headers: { 'Content-Type': 'application/json', 'X-Usuario-Id': usuario?.id || '' }, body: JSON.stringify({ tables }) }).catch(() => {})
+}
+
 // ========================================
 // THEME TOGGLE COMPONENT
 // ========================================
@@ -177,6 +182,7 @@ function AssistenteIA({ usuario }) {
   ])
   const [inputMsg, setInputMsg] = useState('')
   const [isLoadingChat, setIsLoadingChat] = useState(false)
+  const [chatStatus, setChatStatus] = useState(null)
   const [chatError, setChatError] = useState(null)
   const messagesEndRef = useRef(null)
   const inputRef = useRef(null)
@@ -194,10 +200,11 @@ function AssistenteIA({ usuario }) {
     setChatError(null)
     setMessages(prev => [...prev, { role: 'user', content: userMessage }])
     setIsLoadingChat(true)
+    setChatStatus('Pensando...')
 
     try {
       const history = messages.slice(1).map(m => ({ role: m.role, content: m.content }))
-      const response = await fetch(`${API_URL}/chat`, {
+      const response = await fetch(`${API_URL}/chat/stream`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -207,14 +214,45 @@ function AssistenteIA({ usuario }) {
         })
       })
 
-      if (!response.ok) throw new Error(`Erro ${response.status}`)
-      const data = await response.json()
-      setMessages(prev => [...prev, { role: 'assistant', content: data.response }])
+      if (!response.ok || !response.body) throw new Error(`Erro ${response.status}`)
+
+      // Lê os eventos SSE: tool_start/tool_end (progresso), token (resposta), error, done
+      const reader = response.body.getReader()
+      const decoder = new TextDecoder()
+      let buffer = ''
+      let answer = ''
+      while (true) {
+        const { done, value } = await reader.read()
+        if (done) break
+        buffer += decoder.decode(value, { stream: true })
+        const events = buffer.split('\n\n')
+        buffer = events.pop()
+        for (const raw of events) {
+          const dataLine = raw.split('\n').find(l => l.startsWith('data: '))
+          if (!dataLine) continue
+          const evt = JSON.parse(dataLine.slice(6))
+          if (evt.type === 'token') {
+            const started = answer === ''
+            answer += evt.content
+            const text = answer
+            setChatStatus(null)
+            setMessages(prev => started ? [...prev, { role: 'assistant', content: text }] : [...prev.slice(0, -1), { role: 'assistant', content: text }])
+          } else if (evt.type === 'tool_start') {
+            setChatStatus('Consultando dados...')
+          } else if (evt.type === 'tool_end') {
+            setChatStatus('Analisando resultados...')
+          } else if (evt.type === 'error') {
+            throw new Error(evt.detail || 'Erro no servidor')
+          }
+        }
+      }
+      if (!answer) setMessages(prev => [...prev, { role: 'assistant', content: 'Não consegui gerar uma resposta. Tente reformular a pergunta.' }])
     } catch (err) {
       setChatError(err.message)
       setMessages(prev => [...prev, { role: 'assistant', content: '❌ Erro ao processar. Tente novamente.' }])
     } finally {
       setIsLoadingChat(false)
+      setChatStatus(null)
     }
   }
 
@@ -255,14 +293,14 @@ function AssistenteIA({ usuario }) {
               </div>
             </div>
           ))}
-          {isLoadingChat && (
+          {isLoadingChat && chatStatus && (
             <div className="flex gap-3">
               <div className="w-8 h-8 sm:w-10 sm:h-10 rounded-xl flex items-center justify-center bg-gradient-to-br from-violet-500 to-purple-600 text-white">
                 <Bot className="w-4 h-4 sm:w-5 sm:h-5" />
               </div>
               <div className="bg-surface-100 rounded-2xl rounded-tl-md px-4 py-3">
                 <div className="flex items-center gap-2 text-surface-500">
-                  <Loader2 className="w-4 h-4 animate-spin" /><span className="text-sm">Pensando...</span>
+                  <Loader2 className="w-4 h-4 animate-spin" /><span className="text-sm">{chatStatus}</span>
                 </div>
               </div>
             </div>
@@ -820,6 +858,7 @@ function App() {
   const [coraStatus, setCoraStatus] = useState(null)
   const [cobrancas, setCobrancas] = useState([])
   const [gerandoBoletos, setGerandoBoletos] = useState(false)
+  const [progressoBoletos, setProgressoBoletos] = useState(null)
   const [supervisorTurmaIds, setSupervisorTurmaIds] = useState([])
   const [aulaExpandidaId, setAulaExpandidaId] = useState(null)
 
@@ -908,7 +947,7 @@ function App() {
       // Carrega alertas e Cora em paralelo (não bloqueia se falhar)
       try {
         const [alertasRes, coraRes, cobrancasRes] = await Promise.all([
-          fetch(`${API_URL}/alertas`).then(r => r.json()).catch(() => null),
+          fetch(`${API_URL}/alertas?${new URLSearchParams({ user_id: usuario?.id || '', perfil: usuario?.perfil || '' })}`).then(r => r.json()).catch(() => null),
           fetch(`${API_URL}/cora/status`).then(r => r.json()).catch(() => null),
           fetch(`${API_URL}/cora/boletos`).then(r => r.json()).catch(() => null),
         ])
@@ -925,6 +964,29 @@ function App() {
 
   function showToast(message, type = 'info') { setToast({ message, type }) }
 
+  async function gerarMensalidades() {
+    setGerandoBoletos(true)
+    try {
+      const r = await fetch(`${API_URL}/cora/gerar-mensalidades`, { method: 'POST' })
+      if (!r.ok) throw new Error(`Erro ${r.status}`)
+      const { job_id } = await r.json()
+      // O lote roda em background no backend: acompanha o progresso do job
+      let job = null
+      while (!job || !['concluido', 'erro'].includes(job.status)) {
+        await new Promise(resolve => setTimeout(resolve, 2000))
+        const jr = await fetch(`${API_URL}/jobs/${job_id}`)
+        if (!jr.ok) throw new Error(`Erro ${jr.status}`)
+        job = await jr.json()
+        setProgressoBoletos(job)
+      }
+      if (job.gerados > 0) showToast(`${job.gerados} boleto(s) gerado(s)!`, 'success')
+      else showToast(job.erros?.[0]?.erro || 'Nenhum boleto gerado', 'error')
+      loadData()
+    } catch { showToast('Erro ao gerar boletos', 'error') }
+    setGerandoBoletos(false)
+    setProgressoBoletos(null)
+  }
+
   const minhasTurmas = usuario?.perfil === 'professor'
     ? turmas.filter(t => t.professor_id === usuario.id)
     : usuario?.perfil === 'supervisor'
@@ -957,6 +1019,7 @@ function App() {
         if (error) throw error
         showToast('Turma criada!', 'success')
       }
+      notifyDataChange(['turmas'], usuario)
       setModalTurma({ open: false, data: null })
       resetFormTurma()
       loadData()
@@ -968,6 +1031,7 @@ function App() {
     try {
       const { error } = await supabase.from('turmas').delete().eq('id', id)
       if (error) throw error
+      notifyDataChange(['turmas', 'matriculas'], usuario)
       showToast('Turma excluída!', 'success')
       loadData()
     } catch (error) { console.error('Erro ao excluir turma:', error); showToast('Erro ao excluir turma', 'error') }
@@ -999,6 +1063,7 @@ function App() {
         if (error) throw error
         showToast('Aluno cadastrado!', 'success')
       }
+      await notifyDataChange(['alunos'], usuario)
       setModalAluno({ open: false, data: null })
       resetFormAluno()
       loadData()
@@ -1021,6 +1086,7 @@ function App() {
         const { error: matError } = await supabase.from('matriculas').insert([{ turma_id: wizTurmaId, aluno_id: alunoData.id }])
         if (matError && matError.code !== '23505') throw matError
       }
+      notifyDataChange(wizTurmaId ? ['alunos', 'matriculas'] : ['alunos'], usuario)
       showToast(wizTurmaId ? 'Aluno cadastrado e matriculado!' : 'Aluno cadastrado!', 'success')
       setModalAluno({ open: false, data: null })
       resetFormAluno()
@@ -1033,6 +1099,7 @@ function App() {
     try {
       const { error } = await supabase.from('alunos').delete().eq('id', id)
       if (error) throw error
+      await notifyDataChange(['alunos', 'matriculas', 'presencas'], usuario)
       showToast('Aluno excluído!', 'success')
       loadData()
     } catch (error) { console.error('Erro ao excluir aluno:', error); showToast('Erro ao excluir aluno', 'error') }
@@ -1072,6 +1139,7 @@ function App() {
         if (error) throw error
         showToast('Professor cadastrado!', 'success')
       }
+      notifyDataChange(['usuarios'], usuario)
       setModalProfessor({ open: false, data: null })
       setFormProfessor({ nome: '', email: '', senha: '' })
       loadData()
@@ -1086,6 +1154,7 @@ function App() {
     try {
       const { error } = await supabase.from('usuarios').delete().eq('id', id)
       if (error) throw error
+      notifyDataChange(['usuarios'], usuario)
       showToast('Professor excluído!', 'success')
       loadData()
     } catch (error) { console.error('Erro ao excluir professor:', error); showToast('Erro ao excluir professor', 'error') }
@@ -1103,6 +1172,7 @@ function App() {
         if (error.code === '23505') { showToast('Aluno já matriculado', 'error'); return }
         throw error
       }
+      notifyDataChange(['matriculas'], usuario)
       showToast('Aluno matriculado!', 'success')
       setModalMatricula({ open: false, turmaId: null })
       loadData()
@@ -1114,6 +1184,7 @@ function App() {
     try {
       const { error } = await supabase.from('matriculas').delete().eq('turma_id', turmaId).eq('aluno_id', alunoId)
       if (error) throw error
+      notifyDataChange(['matriculas'], usuario)
       showToast('Matrícula cancelada', 'success')
       loadData()
     } catch (error) { console.error('Erro ao cancelar matrícula:', error); showToast('Erro ao cancelar', 'error') }
@@ -1151,6 +1222,7 @@ function App() {
         const { error } = await supabase.from('presencas').insert(presencasToInsert)
         if (error) throw error
       }
+      await notifyDataChange(['aulas', 'presencas'], usuario)
       showToast(modalAula.data ? 'Aula atualizada!' : 'Aula registrada!', 'success')
       setModalAula({ open: false, turma: null, data: null })
       loadData()
@@ -1162,6 +1234,7 @@ function App() {
     try {
       const { error } = await supabase.from('aulas').delete().eq('id', aulaId)
       if (error) throw error
+      await notifyDataChange(['aulas', 'presencas'], usuario)
       showToast('Aula excluída!', 'success')
       loadData()
     } catch (error) { console.error('Erro ao excluir aula:', error); showToast('Erro ao excluir aula', 'error') }
@@ -1863,9 +1936,9 @@ function App() {
                           <span className={`badge text-xs flex items-center gap-1 ${coraStatus?.authenticated ? 'bg-emerald-100 text-emerald-700' : coraStatus?.configured ? 'bg-amber-100 text-amber-700' : 'bg-surface-100 text-surface-600'}`}>
                             {coraStatus?.authenticated ? <><Wifi className="w-3 h-3" />Cora Conectada</> : coraStatus?.configured ? <><AlertCircle className="w-3 h-3" />Erro Auth</> : 'Cora Não Configurada'}
                           </span>
-                          <button onClick={async () => { setGerandoBoletos(true); try { const r = await fetch(`${API_URL}/cora/gerar-mensalidades`, { method: 'POST' }); const d = await r.json(); if (d.gerados > 0) showToast(`${d.gerados} boleto(s) gerado(s)!`, 'success'); else showToast(d.detalhes_erros?.[0]?.erro || 'Nenhum boleto gerado', 'error'); loadData() } catch { showToast('Erro ao gerar boletos', 'error') } setGerandoBoletos(false) }} disabled={gerandoBoletos || !coraStatus?.authenticated} className="flex items-center gap-2 px-4 py-2.5 bg-emerald-600 text-white rounded-xl font-medium hover:bg-emerald-700 disabled:opacity-50 text-sm">
+                          <button onClick={gerarMensalidades} disabled={gerandoBoletos || !coraStatus?.authenticated} className="flex items-center gap-2 px-4 py-2.5 bg-emerald-600 text-white rounded-xl font-medium hover:bg-emerald-700 disabled:opacity-50 text-sm">
                             {gerandoBoletos ? <Loader2 className="w-4 h-4 animate-spin" /> : <DollarSign className="w-4 h-4" />}
-                            Gerar Mensalidades
+                            {progressoBoletos?.total ? `Gerando ${progressoBoletos.gerados + progressoBoletos.falhas}/${progressoBoletos.total}` : 'Gerar Mensalidades'}
                           </button>
                         </div>
                       </div>
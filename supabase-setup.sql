@@ -248,6 +248,10 @@ CREATE TABLE IF NOT EXISTS cobrancas (
 CREATE INDEX IF NOT EXISTS idx_cobrancas_aluno ON cobrancas(aluno_id);
 CREATE INDEX IF NOT EXISTS idx_cobrancas_status ON cobrancas(status);
 CREATE INDEX IF NOT EXISTS idx_cobrancas_vencimento ON cobrancas(vencimento);
+-- Uma cobrança ativa por aluno/vencimento (também serve à pré-checagem de boletos existentes).
+-- Canceladas ficam de fora para permitir reemitir. Se a criação falhar, há duplicadas a cancelar.
+DROP INDEX IF EXISTS idx_cobrancas_aluno_vencimento;
+CREATE UNIQUE INDEX IF NOT EXISTS uq_cobrancas_aluno_vencimento ON cobrancas(aluno_id, vencimento) WHERE status <> 'cancelado';
 
 -- =============================================
 -- TABELA DE MENSAGENS WHATSAPP (cache)
@@ -262,3 +266,468 @@ CREATE TABLE IF NOT EXISTS whatsapp_mensagens (
 );
 
 CREATE INDEX IF NOT EXISTS idx_whatsapp_phone ON whatsapp_mensagens(phone);
+
+-- =============================================
+-- FUNÇÕES DE AGREGAÇÃO (Assistente IA)
+-- =============================================
+
+CREATE INDEX IF NOT EXISTS idx_matriculas_turma_status ON matriculas(turma_id, status);
+
+-- Total de alunos com matrícula ativa por turma (NULL = todas as turmas)
+CREATE OR REPLACE FUNCTION contar_alunos_por_turma(p_turma_ids UUID[] DEFAULT NULL)
+RETURNS TABLE(turma_id UUID, total_alunos INTEGER) AS $$
+    SELECT m.turma_id, COUNT(*)::INTEGER
+    FROM matriculas m
+    WHERE m.status = 'ativo'
+      AND (p_turma_ids IS NULL OR m.turma_id = ANY(p_turma_ids))
+    GROUP BY m.turma_id;
+$$ LANGUAGE sql STABLE;
+
+-- Estatísticas gerais da escola em uma única chamada.
+-- p_turma_ids restringe turmas/alunos/professores ao escopo (supervisor/professor).
+CREATE OR REPLACE FUNCTION estatisticas_escola(p_turma_ids UUID[] DEFAULT NULL)
+RETURNS JSON AS $$
+    WITH t AS (
+        SELECT
+            COUNT(*) AS total,
+            COUNT(*) FILTER (WHERE idioma = 'Inglês') AS ingles,
+            COUNT(*) FILTER (WHERE idioma = 'Espanhol') AS espanhol,
+            COUNT(*) FILTER (WHERE idioma = 'Francês') AS frances,
+            COUNT(DISTINCT professor_id) AS professores
+        FROM turmas
+        WHERE p_turma_ids IS NULL OR id = ANY(p_turma_ids)
+    ),
+    a AS (
+        SELECT
+            COUNT(*) AS total,
+            COUNT(*) FILTER (WHERE status_pedagogico = 'ativo') AS ativos,
+            COUNT(*) FILTER (WHERE status_pedagogico = 'trancado') AS trancados,
+            COUNT(*) FILTER (WHERE status_financeiro = 'em_dia') AS em_dia,
+            COUNT(*) FILTER (WHERE status_financeiro = 'pendente') AS pendentes,
+            COUNT(*) FILTER (WHERE status_financeiro = 'inadimplente') AS inadimplentes,
+            COUNT(*) FILTER (WHERE usa_transporte) AS transporte
+        FROM alunos
+        WHERE p_turma_ids IS NULL
+           OR id IN (SELECT aluno_id FROM matriculas WHERE turma_id = ANY(p_turma_ids))
+    )
+    SELECT json_build_object(
+        'total_turmas', t.total,
+        'total_alunos', a.total,
+        'alunos_ativos', a.ativos,
+        'alunos_trancados', a.trancados,
+        'alunos_em_dia', a.em_dia,
+        'alunos_pendentes', a.pendentes,
+        'alunos_inadimplentes', a.inadimplentes,
+        'total_professores', CASE
+            WHEN p_turma_ids IS NULL THEN (SELECT COUNT(*) FROM usuarios WHERE perfil = 'professor' AND ativo = true)
+            ELSE t.professores
+        END,
+        'turmas_ingles', t.ingles,
+        'turmas_espanhol', t.espanhol,
+        'turmas_frances', t.frances,
+        'alunos_transporte', a.transporte
+    )
+    FROM t, a;
+$$ LANGUAGE sql STABLE;
+
+-- =============================================
+-- BUSCA POR NOME (sem acento, por trigramas)
+-- =============================================
+CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA extensions;
+CREATE EXTENSION IF NOT EXISTS unaccent WITH SCHEMA extensions;
+
+-- unaccent() não é IMMUTABLE; o wrapper permite usá-la em índices
+CREATE OR REPLACE FUNCTION f_unaccent(TEXT)
+RETURNS TEXT AS $$
+    SELECT extensions.unaccent('extensions.unaccent', $1)
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT;
+
+-- Nome sem acento e em minúsculas: filtros de lista usam nome_busca LIKE '%termo%'
+-- (o termo é normalizado do mesmo jeito no backend), servidos pelo índice de trigramas
+ALTER TABLE alunos ADD COLUMN IF NOT EXISTS nome_busca TEXT GENERATED ALWAYS AS (f_unaccent(lower(nome))) STORED;
+ALTER TABLE turmas ADD COLUMN IF NOT EXISTS nome_busca TEXT GENERATED ALWAYS AS (f_unaccent(lower(nome))) STORED;
+ALTER TABLE usuarios ADD COLUMN IF NOT EXISTS nome_busca TEXT GENERATED ALWAYS AS (f_unaccent(lower(nome))) STORED;
+
+DROP INDEX IF EXISTS idx_alunos_nome_trgm;
+DROP INDEX IF EXISTS idx_turmas_nome_trgm;
+DROP INDEX IF EXISTS idx_usuarios_nome_trgm;
+CREATE INDEX IF NOT EXISTS idx_alunos_nome_busca_trgm ON alunos USING gin (nome_busca extensions.gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_turmas_nome_busca_trgm ON turmas USING gin (nome_busca extensions.gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_usuarios_nome_busca_trgm ON usuarios USING gin (nome_busca extensions.gin_trgm_ops);
+
+-- Melhor registro para um nome em alunos/turmas/usuarios, ignorando acentos e maiúsculas.
+-- Aceita trecho do nome ("joao" acha "João Pedro") ou nome aproximado (trigramas).
+-- Resultados ordenados por relevância; p_ids restringe ao escopo do usuário.
+-- Filtros de lista não usam esta função: eles filtram nome_busca direto, sem limite.
+CREATE OR REPLACE FUNCTION buscar_por_nome(
+    p_tabela TEXT,
+    p_busca TEXT,
+    p_ids UUID[] DEFAULT NULL,
+    p_limite INTEGER DEFAULT 10
+)
+RETURNS TABLE(id UUID, nome TEXT, score REAL) AS $$
+DECLARE
+    v_termo TEXT := f_unaccent(lower(trim(p_busca)));
+BEGIN
+    IF p_tabela NOT IN ('alunos', 'turmas', 'usuarios') THEN
+        RAISE EXCEPTION 'Tabela não suportada na busca: %', p_tabela;
+    END IF;
+
+    RETURN QUERY EXECUTE format(
+        'SELECT t.id, t.nome::TEXT,
+                ((t.nome_busca LIKE ''%%'' || $1 || ''%%'')::INTEGER
+                 + word_similarity($1, t.nome_busca))::REAL AS score
+         FROM %I t
+         WHERE ($2 IS NULL OR t.id = ANY($2))
+           AND (t.nome_busca LIKE ''%%'' || $1 || ''%%''
+                OR $1 <%% t.nome_busca)
+         ORDER BY score DESC, length(t.nome)
+         LIMIT $3',
+        p_tabela
+    ) USING v_termo, p_ids, p_limite;
+END;
+$$ LANGUAGE plpgsql STABLE SET search_path = public, extensions;
+
+-- =============================================
+-- TABELA DE JOBS (lotes em background)
+-- =============================================
+CREATE TABLE IF NOT EXISTS jobs (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    tipo VARCHAR(50) NOT NULL, -- gerar_mensalidades
+    status VARCHAR(20) DEFAULT 'pendente', -- pendente, executando, concluido, erro
+    parametros JSONB DEFAULT '{}',
+    total INTEGER DEFAULT 0,
+    gerados INTEGER DEFAULT 0,
+    falhas INTEGER DEFAULT 0,
+    erros JSONB DEFAULT '[]',
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW(),
+    concluido_em TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+
+DROP TRIGGER IF EXISTS update_jobs_updated_at ON jobs;
+CREATE TRIGGER update_jobs_updated_at
+    BEFORE UPDATE ON jobs
+    FOR EACH ROW
+    EXECUTE FUNCTION update_updated_at_column();
+
+-- =============================================
+-- TOKENS DE INTEGRAÇÃO (compartilhados entre workers)
+-- =============================================
+CREATE TABLE IF NOT EXISTS integracao_tokens (
+    servico VARCHAR(50) PRIMARY KEY, -- cora
+    access_token TEXT NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- RLS sem políticas: só a service key do backend lê os tokens
+ALTER TABLE integracao_tokens ENABLE ROW LEVEL SECURITY;
+
+DROP TRIGGER IF EXISTS update_integracao_tokens_updated_at ON integracao_tokens;
+CREATE TRIGGER update_integracao_tokens_updated_at
+    BEFORE UPDATE ON integracao_tokens
+    FOR EACH ROW
+    EXECUTE FUNCTION update_updated_at_column();
+
+-- =============================================
+-- TELEFONE NORMALIZADO (vínculo WhatsApp → aluno)
+-- =============================================
+-- Só dígitos e os últimos 10 dígitos (DDD + número), mesma regra de normalizar_telefone() no backend
+ALTER TABLE alunos ADD COLUMN IF NOT EXISTS telefone_digits TEXT
+    GENERATED ALWAYS AS (regexp_replace(coalesce(telefone, ''), '\D', '', 'g')) STORED;
+ALTER TABLE alunos ADD COLUMN IF NOT EXISTS telefone_sufixo TEXT
+    GENERATED ALWAYS AS (right(regexp_replace(coalesce(telefone, ''), '\D', '', 'g'), 10)) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_alunos_telefone_sufixo ON alunos(telefone_sufixo) WHERE telefone_sufixo <> '';
+-- Telefones cadastrados sem DDD (igualdade) e números recebidos sem DDD (LIKE '%digitos')
+CREATE INDEX IF NOT EXISTS idx_alunos_telefone_digits ON alunos(telefone_digits) WHERE telefone_digits <> '';
+CREATE INDEX IF NOT EXISTS idx_alunos_telefone_digits_trgm ON alunos USING gin (telefone_digits extensions.gin_trgm_ops);
+
+-- =============================================
+-- DEDUPLICAÇÃO DE WEBHOOKS
+-- =============================================
+-- Eventos da Cora já processados (redeliveries são ignoradas)
+CREATE TABLE IF NOT EXISTS webhook_eventos (
+    origem VARCHAR(20) NOT NULL, -- cora
+    event_id TEXT NOT NULL,
+    recebido_em TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (origem, event_id)
+);
+
+-- recebido_em permite expurgar eventos antigos (ex.: DELETE ... WHERE recebido_em < NOW() - INTERVAL '90 days')
+CREATE INDEX IF NOT EXISTS idx_webhook_eventos_recebido ON webhook_eventos(recebido_em);
+
+ALTER TABLE webhook_eventos ENABLE ROW LEVEL SECURITY;
+
+-- Id da mensagem na UAZAPI: o flusher faz upsert ignorando duplicatas
+ALTER TABLE whatsapp_mensagens ADD COLUMN IF NOT EXISTS message_id TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_whatsapp_message_id ON whatsapp_mensagens(message_id);
+CREATE INDEX IF NOT EXISTS idx_whatsapp_phone_timestamp ON whatsapp_mensagens(phone, timestamp);
+
+-- =============================================
+-- ROLLUP SEMANAL DE PRESENÇAS (faltas/presenças por aluno, turma e semana ISO)
+-- =============================================
+-- Mantido por triggers em presencas e aulas; consultas de períodos longos
+-- somam semanas em vez de varrer presencas. Recarga: SELECT backfill_presencas_semanais();
+CREATE TABLE IF NOT EXISTS presencas_semanais (
+    aluno_id UUID NOT NULL REFERENCES alunos(id) ON DELETE CASCADE,
+    turma_id UUID NOT NULL REFERENCES turmas(id) ON DELETE CASCADE,
+    semana DATE NOT NULL, -- segunda-feira da semana ISO
+    faltas INTEGER NOT NULL DEFAULT 0,
+    presencas INTEGER NOT NULL DEFAULT 0,
+    datas_faltas DATE[] NOT NULL DEFAULT '{}', -- datas das aulas com falta (alertas da semana)
+    atualizado_em TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (aluno_id, turma_id, semana)
+);
+
+ALTER TABLE presencas_semanais ADD COLUMN IF NOT EXISTS datas_faltas DATE[] NOT NULL DEFAULT '{}';
+
+CREATE INDEX IF NOT EXISTS idx_presencas_semanais_semana ON presencas_semanais(semana, turma_id);
+
+-- Recalcula uma chave (aluno, turma, semana) a partir das presenças dessa semana
+CREATE OR REPLACE FUNCTION recalcular_presencas_semana(p_aluno_id UUID, p_turma_id UUID, p_semana DATE)
+RETURNS VOID AS $$
+BEGIN
+    IF p_aluno_id IS NULL OR p_turma_id IS NULL OR p_semana IS NULL THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO presencas_semanais (aluno_id, turma_id, semana, faltas, presencas, datas_faltas, atualizado_em)
+    SELECT p_aluno_id, p_turma_id, p_semana,
+           COUNT(*) FILTER (WHERE NOT p.presente),
+           COUNT(*) FILTER (WHERE p.presente),
+           COALESCE(array_agg(a.data ORDER BY a.data) FILTER (WHERE NOT p.presente), '{}'),
+           NOW()
+    FROM presencas p
+    JOIN aulas a ON a.id = p.aula_id
+    WHERE p.aluno_id = p_aluno_id
+      AND a.turma_id = p_turma_id
+      AND a.data >= p_semana AND a.data < p_semana + 7
+    ON CONFLICT (aluno_id, turma_id, semana)
+    DO UPDATE SET faltas = EXCLUDED.faltas, presencas = EXCLUDED.presencas,
+                  datas_faltas = EXCLUDED.datas_faltas, atualizado_em = NOW();
+
+    DELETE FROM presencas_semanais
+    WHERE aluno_id = p_aluno_id AND turma_id = p_turma_id AND semana = p_semana
+      AND faltas = 0 AND presencas = 0;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trg_presencas_semanais()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_aula RECORD;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        -- Aula já excluída (cascade): o trigger de aulas recalcula a semana
+        SELECT turma_id, data INTO v_aula FROM aulas WHERE id = OLD.aula_id;
+        IF FOUND THEN
+            PERFORM recalcular_presencas_semana(OLD.aluno_id, v_aula.turma_id, date_trunc('week', v_aula.data)::date);
+        END IF;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT turma_id, data INTO v_aula FROM aulas WHERE id = NEW.aula_id;
+        IF FOUND THEN
+            PERFORM recalcular_presencas_semana(NEW.aluno_id, v_aula.turma_id, date_trunc('week', v_aula.data)::date);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS presencas_semanais_sync ON presencas;
+CREATE TRIGGER presencas_semanais_sync
+    AFTER INSERT OR UPDATE OR DELETE ON presencas
+    FOR EACH ROW
+    EXECUTE FUNCTION trg_presencas_semanais();
+
+-- Aula remarcada (data/turma) ou excluída: recalcula as semanas afetadas
+CREATE OR REPLACE FUNCTION trg_aulas_presencas_semanais()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM recalcular_presencas_semana(ps.aluno_id, ps.turma_id, ps.semana)
+        FROM presencas_semanais ps
+        WHERE ps.turma_id = OLD.turma_id AND ps.semana = date_trunc('week', OLD.data)::date;
+    ELSIF NEW.data IS DISTINCT FROM OLD.data OR NEW.turma_id IS DISTINCT FROM OLD.turma_id THEN
+        PERFORM recalcular_presencas_semana(p.aluno_id, OLD.turma_id, date_trunc('week', OLD.data)::date),
+                recalcular_presencas_semana(p.aluno_id, NEW.turma_id, date_trunc('week', NEW.data)::date)
+        FROM presencas p
+        WHERE p.aula_id = NEW.id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS aulas_presencas_semanais_sync ON aulas;
+CREATE TRIGGER aulas_presencas_semanais_sync
+    AFTER UPDATE OR DELETE ON aulas
+    FOR EACH ROW
+    EXECUTE FUNCTION trg_aulas_presencas_semanais();
+
+-- Reconstrói o rollup (todo o histórico ou a partir de p_desde); retorna as linhas geradas
+CREATE OR REPLACE FUNCTION backfill_presencas_semanais(p_desde DATE DEFAULT NULL)
+RETURNS INTEGER AS $$
+DECLARE
+    v_semana DATE := date_trunc('week', p_desde)::date;
+    v_linhas INTEGER;
+BEGIN
+    DELETE FROM presencas_semanais WHERE v_semana IS NULL OR semana >= v_semana;
+
+    INSERT INTO presencas_semanais (aluno_id, turma_id, semana, faltas, presencas, datas_faltas)
+    SELECT p.aluno_id, a.turma_id, date_trunc('week', a.data)::date,
+           COUNT(*) FILTER (WHERE NOT p.presente),
+           COUNT(*) FILTER (WHERE p.presente),
+           COALESCE(array_agg(a.data ORDER BY a.data) FILTER (WHERE NOT p.presente), '{}')
+    FROM presencas p
+    JOIN aulas a ON a.id = p.aula_id
+    WHERE p.aluno_id IS NOT NULL AND a.turma_id IS NOT NULL
+      AND (v_semana IS NULL OR a.data >= v_semana)
+    GROUP BY 1, 2, 3;
+
+    GET DIAGNOSTICS v_linhas = ROW_COUNT;
+    RETURN v_linhas;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Linhas do rollup anteriores à coluna datas_faltas: preenche a partir de presencas
+-- (só onde falta; nas execuções seguintes deste script não atualiza nada)
+UPDATE presencas_semanais ps
+SET datas_faltas = ARRAY(
+    SELECT a.data
+    FROM presencas p
+    JOIN aulas a ON a.id = p.aula_id
+    WHERE p.aluno_id = ps.aluno_id AND a.turma_id = ps.turma_id
+      AND a.data >= ps.semana AND a.data < ps.semana + 7
+      AND NOT p.presente
+    ORDER BY a.data
+)
+WHERE ps.faltas > 0 AND cardinality(ps.datas_faltas) = 0;
+
+-- Linhas de faltas/presenças do período: semanas inteiras vêm do rollup, só as semanas
+-- parciais das pontas leem presencas. p_aluno_busca filtra por trecho do nome já
+-- normalizado (mesmo formato de alunos.nome_busca). Base de resumo_presencas e alertas_semana.
+CREATE OR REPLACE FUNCTION presencas_periodo(
+    p_inicio DATE,
+    p_fim DATE,
+    p_turma_ids UUID[] DEFAULT NULL,
+    p_aluno_busca TEXT DEFAULT NULL
+)
+RETURNS TABLE (aluno_id UUID, turma_id UUID, faltas INTEGER, presencas INTEGER, datas_faltas DATE[]) AS $$
+    WITH limites AS (
+        SELECT
+            -- primeira segunda-feira >= p_inicio e segunda-feira seguinte à última semana completa
+            CASE WHEN date_trunc('week', p_inicio)::date = p_inicio THEN p_inicio
+                 ELSE date_trunc('week', p_inicio)::date + 7 END AS ini_cheia,
+            date_trunc('week', p_fim + 1)::date AS fim_cheia
+    ),
+    alunos_busca AS (
+        SELECT id FROM alunos WHERE nome_busca LIKE '%' || p_aluno_busca || '%'
+    )
+    SELECT ps.aluno_id, ps.turma_id, ps.faltas, ps.presencas, ps.datas_faltas
+    FROM presencas_semanais ps, limites l
+    WHERE ps.semana >= l.ini_cheia AND ps.semana < l.fim_cheia
+      AND (p_turma_ids IS NULL OR ps.turma_id = ANY(p_turma_ids))
+      AND (p_aluno_busca IS NULL OR ps.aluno_id IN (SELECT id FROM alunos_busca))
+    UNION ALL
+    SELECT p.aluno_id, a.turma_id, (NOT p.presente)::int, p.presente::int,
+           CASE WHEN p.presente THEN '{}'::date[] ELSE ARRAY[a.data] END
+    FROM presencas p
+    JOIN aulas a ON a.id = p.aula_id, limites l
+    WHERE a.data BETWEEN p_inicio AND p_fim
+      AND (a.data < l.ini_cheia OR a.data >= GREATEST(l.fim_cheia, l.ini_cheia))
+      AND (p_turma_ids IS NULL OR a.turma_id = ANY(p_turma_ids))
+      AND (p_aluno_busca IS NULL OR p.aluno_id IN (SELECT id FROM alunos_busca));
+$$ LANGUAGE sql STABLE;
+
+-- Faltas/presenças por aluno e turma no período
+DROP FUNCTION IF EXISTS resumo_presencas(DATE, DATE, UUID[], UUID[]);
+CREATE OR REPLACE FUNCTION resumo_presencas(
+    p_inicio DATE,
+    p_fim DATE,
+    p_turma_ids UUID[] DEFAULT NULL,
+    p_aluno_busca TEXT DEFAULT NULL
+)
+RETURNS TABLE (aluno_id UUID, aluno_nome TEXT, turma_id UUID, turma_nome TEXT, faltas BIGINT, presencas BIGINT, frequencia NUMERIC) AS $$
+    SELECT
+        x.aluno_id,
+        al.nome::text,
+        x.turma_id,
+        t.nome::text,
+        SUM(x.faltas) AS faltas,
+        SUM(x.presencas) AS presencas,
+        ROUND(100.0 * SUM(x.presencas) / NULLIF(SUM(x.faltas) + SUM(x.presencas), 0), 1) AS frequencia
+    FROM presencas_periodo(p_inicio, p_fim, p_turma_ids, p_aluno_busca) x
+    JOIN alunos al ON al.id = x.aluno_id
+    LEFT JOIN turmas t ON t.id = x.turma_id
+    GROUP BY x.aluno_id, al.nome, x.turma_id, t.nome
+    ORDER BY SUM(x.faltas) DESC, al.nome;
+$$ LANGUAGE sql STABLE;
+
+-- =============================================
+-- ALERTAS DA SEMANA (dashboard)
+-- =============================================
+-- Faltas por aluno (total, turmas, datas) + inadimplentes em uma única chamada
+CREATE INDEX IF NOT EXISTS idx_aulas_data ON aulas(data);
+CREATE INDEX IF NOT EXISTS idx_presencas_aula_faltas ON presencas(aula_id) WHERE presente = false;
+
+CREATE OR REPLACE FUNCTION alertas_semana(p_inicio DATE, p_fim DATE, p_turma_ids UUID[] DEFAULT NULL)
+RETURNS JSON AS $$
+    WITH linhas AS (
+        -- Totais, turmas e datas vêm do rollup semanal (presencas só nas semanas parciais)
+        SELECT * FROM presencas_periodo(p_inicio, p_fim, p_turma_ids)
+    ),
+    totais AS (
+        SELECT
+            x.aluno_id,
+            SUM(x.faltas) AS total_faltas,
+            COALESCE(array_agg(DISTINCT t.nome) FILTER (WHERE x.faltas > 0 AND t.nome IS NOT NULL), '{}') AS turmas
+        FROM linhas x
+        LEFT JOIN turmas t ON t.id = x.turma_id
+        GROUP BY x.aluno_id
+        HAVING SUM(x.faltas) > 0
+    ),
+    datas AS (
+        SELECT x.aluno_id, array_agg(d.data ORDER BY d.data) AS datas
+        FROM linhas x, unnest(x.datas_faltas) AS d(data)
+        GROUP BY x.aluno_id
+    ),
+    por_aluno AS (
+        SELECT t.aluno_id, t.total_faltas, t.turmas, COALESCE(d.datas, '{}') AS datas
+        FROM totais t
+        LEFT JOIN datas d ON d.aluno_id = t.aluno_id
+    )
+    SELECT json_build_object(
+        'faltas', COALESCE((
+            SELECT json_agg(json_build_object(
+                'aluno_id', al.id,
+                'nome', al.nome,
+                'telefone', COALESCE(al.telefone, ''),
+                'total_faltas', pa.total_faltas,
+                'turmas', pa.turmas,
+                'datas', pa.datas
+            ) ORDER BY pa.total_faltas DESC, al.nome)
+            FROM por_aluno pa
+            JOIN alunos al ON al.id = pa.aluno_id
+        ), '[]'::json),
+        'inadimplentes', COALESCE((
+            SELECT json_agg(json_build_object(
+                'aluno_id', al.id,
+                'nome', al.nome,
+                'telefone', COALESCE(al.telefone, ''),
+                'email', COALESCE(al.email, ''),
+                'status', al.status_financeiro,
+                'valor_mensalidade', al.valor_mensalidade,
+                'dia_vencimento', al.dia_vencimento
+            ) ORDER BY al.nome)
+            FROM alunos al
+            WHERE al.status_financeiro IN ('pendente', 'inadimplente')
+              AND al.status_pedagogico = 'ativo'
+              AND (p_turma_ids IS NULL
+                   OR al.id IN (SELECT aluno_id FROM matriculas WHERE turma_id = ANY(p_turma_ids)))
+        ), '[]'::json)
+    );
+$$ LANGUAGE sql STABLE;